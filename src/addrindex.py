@@ -0,0 +1,331 @@
+#!/usr/bin/python3
+
+from block import Block
+from opcodes import *
+
+import argparse
+import base58
+import bisect
+import heapq
+import json
+import mmap
+import os
+import struct
+import utils
+
+# An inverted index from addresses (or scripts) to their history. Postings are
+# buffered in memory, sorted and written as immutable "runs" of fixed-size
+# records. Runs are compacted in size tiers, as in an LSM tree: a flush writes
+# a run of level 0, and once merge_factor runs share a level, they are merged
+# into one run of the next level. So every record is rewritten once per level,
+# i.e. O(log n) times, and there are at most merge_factor - 1 runs per level.
+# A lookup is a binary search in each run, so it does not depend on the size
+# of the chain.
+#
+# There are two kinds of postings:
+#   funding: key | height | txid | vout | value   -- an output paying to key
+#   spend:   prev txid | prev vout | txid | input index | height   -- an input
+# An address's history is its funding postings, each joined with the spend
+# posting of the same outpoint (if it has been spent).
+#
+# A key is 1 byte of address version + 20 bytes of hash, i.e., exactly the
+# payload of a Base58Check address: 0x00 + HASH160(pubkey) for P2PKH and P2PK
+# outputs, 0x05 + script hash for P2SH outputs. Other scripts are keyed by
+# OTHER_SCRIPT_KEY_PREFIX + HASH160(scriptPubKey).
+# Integers are big-endian so that sorting records as bytes sorts them by
+# height (or vout) too.
+
+FUNDING = 'funding'
+SPEND = 'spend'
+
+KEY_SIZE = 21
+OUTPOINT_SIZE = 36
+OTHER_SCRIPT_KEY_PREFIX = b'\xff'
+
+funding_struct = struct.Struct('>21sI32sIQ')
+spend_struct = struct.Struct('>32sI32sII')
+RECORD_STRUCTS = {FUNDING: funding_struct, SPEND: spend_struct}
+SEARCH_KEY_SIZES = {FUNDING: KEY_SIZE, SPEND: OUTPOINT_SIZE}
+
+DEFAULT_BUFFER_SIZE = 1000000
+DEFAULT_MERGE_FACTOR = 8
+META_FILE_NAME = 'meta.json'
+
+
+def get_script_key(script_pubkey: bytes) -> bytes:
+	script_type, payload = utils.classify_script_pubkey(script_pubkey)
+	if script_type == TX_PUBKEYHASH:
+		return b'\x00' + bytes(payload)
+	if script_type == TX_SCRIPTHASH:
+		return b'\x05' + bytes(payload)
+	if script_type == TX_PUBKEY:
+		return b'\x00' + utils.hash160(bytes(payload))
+	return OTHER_SCRIPT_KEY_PREFIX + utils.hash160(bytes(script_pubkey))
+
+
+def get_address_key(address: str) -> bytes:
+	"""
+	Base58Check-decode an address into its key, e.g. '1A1zP1...' -> 0x00 + hash
+	"""
+	key = base58.b58decode_check(address)
+	if len(key) != KEY_SIZE:
+		raise ValueError(f'[{address}] is not a P2PKH/P2SH address')
+	return key
+
+
+class RunKeys:
+	"""
+	A read-only sequence of the search keys of a run, so that bisect can search
+	the mmap-ed run without loading it.
+	"""
+
+	def __init__(self, buffer, record_size: int, key_size: int):
+		self.buffer = buffer
+		self.record_size = record_size
+		self.key_size = key_size
+
+	def __len__(self):
+		return len(self.buffer) // self.record_size
+
+	def __getitem__(self, i: int) -> bytes:
+		start = i * self.record_size
+		return self.buffer[start:start + self.key_size]
+
+
+class AddressIndex:
+
+	def __init__(self, index_dir: str, buffer_size: int = DEFAULT_BUFFER_SIZE,
+		merge_factor: int = DEFAULT_MERGE_FACTOR):
+		assert merge_factor >= 2
+		os.makedirs(index_dir, exist_ok=True)
+		self.index_dir = index_dir
+		self.buffer_size = buffer_size
+		self.merge_factor = merge_factor
+		self.buffers = {FUNDING: [], SPEND: []}
+		self.meta = {'next_run': 0, 'runs': {FUNDING: [], SPEND: []}, 'levels': {}, 'height': -1}
+		"""
+		height is the last height whose postings have been flushed to runs,
+		levels maps the name of every run to its level.
+		"""
+		meta_path = os.path.join(index_dir, META_FILE_NAME)
+		if os.path.isfile(meta_path):
+			with open(meta_path, 'r') as f:
+				self.meta = json.load(f)
+			# Indexes written before levels were recorded start at level 0
+			self.meta.setdefault('levels', {})
+		self.pending_height = self.meta['height']
+		# Runs of a flush that did not complete, and merged runs that were not
+		# deleted yet, are not referenced by meta.json
+		referenced_runs = set(self.meta['runs'][FUNDING] + self.meta['runs'][SPEND])
+		for name in os.listdir(index_dir):
+			if name.endswith(('.run', '.run.tmp')) and name not in referenced_runs:
+				os.remove(os.path.join(index_dir, name))
+
+	def save_meta(self):
+		meta_path = os.path.join(self.index_dir, META_FILE_NAME)
+		with open(meta_path + '.tmp', 'w') as f:
+			json.dump(self.meta, f)
+		os.replace(meta_path + '.tmp', meta_path)
+
+	def add_block(self, block: Block, height: int):
+		for transaction in block.transactions:
+			txid = utils.convert_endianness(bytes.fromhex(transaction.tx_hash))
+			for i, tx_input in enumerate(transaction.inputs):
+				if tx_input.txOutId == 0xffffffff:  # Coinbase
+					continue
+				self.buffers[SPEND].append(spend_struct.pack(
+					tx_input.prev_tx_hash, tx_input.txOutId, txid, i, height
+				))
+			for vout, tx_output in enumerate(transaction.outputs):
+				self.buffers[FUNDING].append(funding_struct.pack(
+					get_script_key(tx_output.pubkey), height, txid, vout, tx_output.value
+				))
+		self.pending_height = height
+		if len(self.buffers[FUNDING]) + len(self.buffers[SPEND]) >= self.buffer_size:
+			self.flush()
+
+	def flush(self):
+		"""
+		Write the buffered postings as runs of level 0 and compact the levels.
+		meta.json is saved once, after every run is complete, so that it never
+		lists a run without the height the run covers. Merged runs are deleted
+		only after that, as the previous meta.json still lists them.
+		"""
+		merged_runs = []
+		for kind, records in self.buffers.items():
+			if len(records) == 0:
+				continue
+			records.sort()
+			self.write_run(kind, records, 0)
+			records.clear()
+			merged_runs += self.compact(kind)
+		self.meta['height'] = self.pending_height
+		self.save_meta()
+		for name in merged_runs:
+			os.remove(os.path.join(self.index_dir, name))
+
+	def write_run(self, kind: str, records, level: int):
+		name = f"{kind}-{self.meta['next_run']:06d}.run"
+		self.meta['next_run'] += 1
+		path = os.path.join(self.index_dir, name)
+		with open(path + '.tmp', 'wb') as f:
+			for record in records:
+				f.write(record)
+		os.replace(path + '.tmp', path)
+		self.meta['runs'][kind].append(name)
+		self.meta['levels'][name] = level
+
+	def iterate_run(self, name: str, record_size: int):
+		with open(os.path.join(self.index_dir, name), 'rb') as f:
+			while True:
+				chunk = f.read(record_size * 4096)
+				if len(chunk) == 0:
+					return
+				for pos in range(0, len(chunk), record_size):
+					yield chunk[pos:pos + record_size]
+
+	def compact(self, kind: str):
+		"""
+		Merge the runs of kind, lowest level first, while merge_factor runs
+		share a level. Return the names of the merged runs, for the caller to
+		delete once the new runs are recorded in meta.json.
+		"""
+		merged_runs = []
+		level = 0
+		while True:
+			runs = [name for name in self.meta['runs'][kind] if self.meta['levels'].get(name, 0) == level]
+			if len(runs) >= self.merge_factor:
+				merged_runs += self.merge_runs(kind, runs[:self.merge_factor], level + 1)
+			elif any(self.meta['levels'].get(name, 0) > level for name in self.meta['runs'][kind]):
+				level += 1
+			else:
+				return merged_runs
+
+	def merge_runs(self, kind: str, names: list, level: int):
+		"""
+		Merge the runs names of kind into a single sorted run of level,
+		streaming from disk. Return names.
+		"""
+		record_size = RECORD_STRUCTS[kind].size
+		self.write_run(kind, heapq.merge(*[self.iterate_run(name, record_size) for name in names]), level)
+		self.meta['runs'][kind] = [name for name in self.meta['runs'][kind] if name not in names]
+		for name in names:
+			self.meta['levels'].pop(name, None)
+		return names
+
+	def map_runs(self, kind: str) -> list:
+		"""
+		Return a read-only mmap of every non-empty run of kind. The caller
+		closes them.
+		"""
+		runs = []
+		for name in self.meta['runs'][kind]:
+			with open(os.path.join(self.index_dir, name), 'rb') as f:
+				if os.fstat(f.fileno()).st_size > 0:
+					runs.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+		return runs
+
+	def search_runs(self, kind: str, runs: list, search_key: bytes):
+		"""
+		Yield every record of kind in runs (see map_runs()) whose search key
+		equals search_key.
+		"""
+		record_struct = RECORD_STRUCTS[kind]
+		for run in runs:
+			keys = RunKeys(run, record_struct.size, SEARCH_KEY_SIZES[kind])
+			i = bisect.bisect_left(keys, search_key)
+			while i < len(keys) and keys[i] == search_key:
+				yield record_struct.unpack_from(run, i * record_struct.size)
+				i += 1
+
+	def search(self, kind: str, search_key: bytes):
+		"""
+		Yield every flushed record of kind whose search key equals search_key.
+		"""
+		runs = self.map_runs(kind)
+		try:
+			yield from self.search_runs(kind, runs, search_key)
+		finally:
+			for run in runs:
+				run.close()
+
+	def get_history(self, key: bytes):
+		"""
+		Return a list of dicts (txid, vout, height, value, spent_by) sorted by
+		height, where txids are shown in big-endian order as bitcoin-cli does.
+		"""
+		history = []
+		# Mapped once for all the funding postings of key
+		spend_runs = self.map_runs(SPEND)
+		try:
+			for _, height, txid, vout, value in self.search(FUNDING, key):
+				spent_by = None
+				for _, _, spending_txid, input_index, spending_height in self.search_runs(
+					SPEND, spend_runs, txid + struct.pack('>I', vout)):
+					spent_by = {
+						'txid': utils.convert_endianness(spending_txid).hex(),
+						'input': input_index, 'height': spending_height
+					}
+				history.append({
+					'txid': utils.convert_endianness(txid).hex(), 'vout': vout,
+					'height': height, 'value': value, 'spent_by': spent_by
+				})
+		finally:
+			for run in spend_runs:
+				run.close()
+		history.sort(key=lambda posting: (posting['height'], posting['txid'], posting['vout']))
+		return history
+
+
+def build(blocks_dir: str, index_dir: str, buffer_size: int):
+	"""
+	Index the active chain in height order, continuing after the last height
+	already indexed.
+	"""
+	from blockindex import BlockIndex
+
+	block_index = BlockIndex(blocks_dir)
+	address_index = AddressIndex(index_dir, buffer_size)
+	start_height = address_index.meta['height'] + 1
+	for height in range(start_height, block_index.get_height() + 1):
+		address_index.add_block(block_index.read_block(block_index.get_by_height(height)), height)
+		if height % 1000 == 0:
+			print(f"Indexed height {height}")
+	address_index.flush()
+	print(f"Indexed up to height {block_index.get_height()}")
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument('--index-dir', dest='index-dir', required=True, help="Directory of the address index.")
+	ap.add_argument(
+		'--blocks-dir', dest='blocks-dir', default=None,
+		help="The blocks/ directory as managed by Bitcoin Core. Build or update the index from it."
+	)
+	ap.add_argument('--address', dest='address', default=None, help="Print the history of this address.")
+	ap.add_argument(
+		'--script', dest='script', default=None,
+		help="Print the history of this scriptPubKey (in hex), e.g. for non-standard scripts."
+	)
+	ap.add_argument(
+		'--buffer-size', dest='buffer-size', default=DEFAULT_BUFFER_SIZE,
+		help="Number of postings kept in memory before a sorted run is written."
+	)
+	args = vars(ap.parse_args())
+	index_dir = str(args['index-dir'])
+
+	if args['blocks-dir'] is not None:
+		build(str(args['blocks-dir']), index_dir, int(args['buffer-size']))
+	key = None
+	if args['address'] is not None:
+		key = get_address_key(str(args['address']))
+	elif args['script'] is not None:
+		key = get_script_key(bytes.fromhex(str(args['script'])))
+	if key is not None:
+		for posting in AddressIndex(index_dir).get_history(key):
+			print(json.dumps(posting))
+
+
+if __name__ == '__main__':
+	main()
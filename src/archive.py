@@ -0,0 +1,463 @@
+#!/usr/bin/python3
+
+from block import Block
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
+import collections
+import io
+import lzma
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import utils
+import zlib
+
+# Read blocks straight from compressed copies of blk*.dat files (gzip, xz or
+# zstd), e.g. from `zstd -T0 blk00000.dat` or `curl ... |`, without expanding
+# them first. Nothing seeks: the compressed input is read front to back, every
+# block is cut out of the decompressed stream by its magic number and size and
+# decoded with Block.from_bytes(), so Block.has_length() never runs.
+#
+# Decompression runs in background threads (zlib, lzma and zstandard release
+# the GIL) and stays ahead of the parser through a bounded queue. Inputs that
+# consist of independently compressed frames, i.e. zstd frames (multi-threaded
+# zstd, pzstd, the seekable format) and BGZF gzip members (bgzip), are split
+# into frames without decompressing them, and the frames are decompressed by a
+# pool of threads. Plain gzip and xz streams can only be decompressed in
+# order, by one background thread.
+
+DEFAULT_WORKERS = os.cpu_count()
+CHUNK_SIZE = 1024 * 1024
+"""
+Compressed bytes read at a time from inputs that are decompressed in order.
+"""
+MAX_CHUNKS_IN_FLIGHT = 16
+"""
+Decompressed chunks (or frames) buffered ahead of the parser.
+"""
+
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+ZSTD_SKIPPABLE_MAGIC = 0x184d2a50
+"""
+Skippable zstd frames have magic numbers 0x184d2a50 to 0x184d2a5f.
+"""
+non_zero_pattern = re.compile(b'[^\0]')
+
+
+def read_exactly(reader, size: int) -> bytes:
+	data = reader.read(size)
+	if len(data) != size:
+		raise ValueError(f'Truncated input: {size} bytes expected but {len(data)} bytes read')
+	return data
+
+
+class PrefixedReader:
+	"""
+	Return prefix, i.e. bytes already read from reader (e.g. to detect the
+	format), before the rest of reader.
+	"""
+
+	def __init__(self, prefix: bytes, reader):
+		self.prefix = prefix
+		self.prefix_pos = 0
+		self.reader = reader
+
+	def read(self, size: int = -1) -> bytes:
+		if self.prefix_pos == len(self.prefix):
+			return self.reader.read(size)
+		if size < 0:
+			data = self.prefix[self.prefix_pos:] + self.reader.read()
+			self.prefix_pos = len(self.prefix)
+			return data
+		data = self.prefix[self.prefix_pos:self.prefix_pos + size]
+		self.prefix_pos += len(data)
+		if len(data) < size:
+			data += self.reader.read(size - len(data))
+		return data
+
+
+def detect_format(head: bytes, magic_numbers=utils.NETWORK_MAGICS) -> str:
+	"""
+	Return 'zstd', 'bgzf', 'gzip', 'xz' or 'raw' (an uncompressed blk*.dat
+	file) from the first bytes of the input.
+	"""
+	if head.startswith(ZSTD_MAGIC) or (len(head) >= 4 and
+		int.from_bytes(head[:4], byteorder='little') & 0xfffffff0 == ZSTD_SKIPPABLE_MAGIC):
+		return 'zstd'
+	if head.startswith(GZIP_MAGIC):
+		# BGZF members set FEXTRA and carry their size in a 'BC' subfield
+		if len(head) >= 14 and head[3] & 0x04 and head[12:14] == b'BC':
+			return 'bgzf'
+		return 'gzip'
+	if head.startswith(XZ_MAGIC):
+		return 'xz'
+	if len(head) >= 4 and int.from_bytes(head[:4], byteorder='little') in magic_numbers:
+		return 'raw'
+	raise ValueError(f'Unknown input format (first bytes: {head[:8].hex()})')
+
+
+def iterate_zstd_frames(reader):
+	"""
+	Yield every zstd frame of reader as bytes. Frames are delimited by walking
+	the frame and block headers (RFC 8878), without decompressing anything.
+	Skippable frames are dropped.
+	"""
+	while True:
+		magic = reader.read(4)
+		if len(magic) == 0:
+			return
+		if len(magic) < 4:
+			raise ValueError('Truncated zstd frame')
+		if int.from_bytes(magic, byteorder='little') & 0xfffffff0 == ZSTD_SKIPPABLE_MAGIC:
+			size = int.from_bytes(read_exactly(reader, 4), byteorder='little')
+			read_exactly(reader, size)
+			continue
+		if magic != ZSTD_MAGIC:
+			raise ValueError(f'Not a zstd frame: {magic.hex()}')
+
+		descriptor = read_exactly(reader, 1)
+		flags = descriptor[0]
+		single_segment = (flags & 0x20) != 0
+		header_size = ((0 if single_segment else 1) +  # Window_Descriptor
+			(0, 1, 2, 4)[flags & 0x03] +  # Dictionary_ID
+			(1 if single_segment else 0, 2, 4, 8)[flags >> 6])  # Frame_Content_Size
+		parts = [magic, descriptor, read_exactly(reader, header_size)]
+		while True:
+			block_header = read_exactly(reader, 3)
+			value = int.from_bytes(block_header, byteorder='little')
+			block_type = (value >> 1) & 0x03
+			if block_type == 3:
+				raise ValueError('Reserved zstd block type')
+			parts.append(block_header)
+			# An RLE block stores its byte once, whatever the block size
+			parts.append(read_exactly(reader, 1 if block_type == 1 else value >> 3))
+			if value & 0x01:
+				break
+		if flags & 0x04:
+			parts.append(read_exactly(reader, 4))  # Content_Checksum
+		yield b''.join(parts)
+
+
+def iterate_bgzf_members(reader):
+	"""
+	Yield every member of a BGZF file (a gzip file as written by bgzip) as
+	bytes. Every member states its own compressed size in the 'BC' subfield.
+	"""
+	while True:
+		header = reader.read(12)
+		if len(header) == 0:
+			return
+		if len(header) < 12 or header[:2] != GZIP_MAGIC or (header[3] & 0x04) == 0:
+			raise ValueError('Not a BGZF member')
+		extra = read_exactly(reader, int.from_bytes(header[10:12], byteorder='little'))
+		member_size = None
+		pos = 0
+		while pos + 4 <= len(extra):
+			subfield_size = int.from_bytes(extra[pos + 2:pos + 4], byteorder='little')
+			if extra[pos:pos + 2] == b'BC' and subfield_size == 2:
+				member_size = int.from_bytes(extra[pos + 4:pos + 6], byteorder='little') + 1
+			pos += 4 + subfield_size
+		if member_size is None:
+			raise ValueError('BGZF member without BC subfield')
+		yield header + extra + read_exactly(reader, member_size - len(header) - len(extra))
+
+
+def decompress_zstd_frame(frame: bytes) -> bytes:
+	# zstandard is only needed for .zst inputs
+	import zstandard
+
+	# A decompression object also handles frames that do not state their
+	# content size, e.g. those written by `zstd` from a pipe
+	return zstandard.ZstdDecompressor().decompressobj().decompress(frame)
+
+
+def decompress_gzip_member(member: bytes) -> bytes:
+	return zlib.decompress(member, wbits=31)
+
+
+def iterate_stream_chunks(reader, format_name: str):
+	"""
+	Yield the decompressed data of a plain gzip or xz input in order. A new
+	decompressor picks up where the previous one reached the end of its member
+	or stream, so concatenated inputs (`cat a.gz b.gz`) are read completely.
+	"""
+	def new_decompressor():
+		if format_name == 'gzip':
+			return zlib.decompressobj(wbits=31)
+		return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+
+	decompressor = new_decompressor()
+	while True:
+		data = reader.read(CHUNK_SIZE)
+		if len(data) == 0:
+			break
+		while len(data) > 0:
+			chunk = decompressor.decompress(data)
+			if len(chunk) > 0:
+				yield chunk
+			if decompressor.eof is False:
+				break
+			data = decompressor.unused_data
+			if format_name == 'xz':
+				# xz streams may be followed by stream padding
+				data = data.lstrip(b'\0')
+			decompressor = new_decompressor()
+	if format_name == 'gzip':
+		chunk = decompressor.flush()
+		if len(chunk) > 0:
+			yield chunk
+
+
+def iterate_raw_chunks(reader):
+	while True:
+		chunk = reader.read(CHUNK_SIZE)
+		if len(chunk) == 0:
+			return
+		yield chunk
+
+
+def map_in_order(executor: ThreadPoolExecutor, function, items, window: int):
+	"""
+	Like executor.map(), but keep at most window items in flight instead of
+	submitting every item up front.
+	"""
+	pending = collections.deque()
+	try:
+		for item in items:
+			pending.append(executor.submit(function, item))
+			if len(pending) >= window:
+				yield pending.popleft().result()
+		while len(pending) > 0:
+			yield pending.popleft().result()
+	finally:
+		for future in pending:
+			future.cancel()
+
+
+class DecompressingReader:
+	"""
+	A forward-only reader over the decompressed data of a compressed blk*.dat
+	file. A background thread decompresses the input into a bounded queue of
+	chunks that read() consumes.
+	"""
+
+	def __init__(self, compressed_reader: io.BufferedReader, workers: int = DEFAULT_WORKERS,
+		magic_numbers=utils.NETWORK_MAGICS):
+		assert isinstance(compressed_reader, io.BufferedReader)
+		# Unlike peek(), read() only returns fewer bytes at the end of the input,
+		# e.g. a pipe may deliver the first bytes one at a time
+		head = compressed_reader.read(18)
+		self.format_name = detect_format(head, magic_numbers)
+		compressed_reader = PrefixedReader(head, compressed_reader)
+		self.queue = queue.Queue(MAX_CHUNKS_IN_FLIGHT)
+		self.closed = threading.Event()
+		self.chunk = b''
+		self.chunk_pos = 0
+		self.position = 0
+		"""
+		Decompressed bytes consumed so far, i.e. the offset in the original file
+		"""
+		self.finished = False
+		self.executor = None
+
+		if self.format_name == 'zstd':
+			chunks = self.decompress_frames(iterate_zstd_frames(compressed_reader), decompress_zstd_frame, workers)
+		elif self.format_name == 'bgzf':
+			chunks = self.decompress_frames(iterate_bgzf_members(compressed_reader), decompress_gzip_member, workers)
+		elif self.format_name == 'raw':
+			chunks = iterate_raw_chunks(compressed_reader)
+		else:
+			chunks = iterate_stream_chunks(compressed_reader, self.format_name)
+		self.thread = threading.Thread(target=self.produce, args=(chunks,), daemon=True)
+		self.thread.start()
+
+	def decompress_frames(self, frames, function, workers: int):
+		if workers <= 1:
+			return map(function, frames)
+		self.executor = ThreadPoolExecutor(workers)
+		return map_in_order(self.executor, function, frames, max(MAX_CHUNKS_IN_FLIGHT, workers * 2))
+
+	def put(self, item) -> bool:
+		while self.closed.is_set() is False:
+			try:
+				self.queue.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def produce(self, chunks):
+		try:
+			for chunk in chunks:
+				if self.put(chunk) is False:
+					return
+		except BaseException as ex:
+			# Raised again by read() in the consumer's thread
+			self.put(ex)
+			return
+		finally:
+			if self.executor is not None:
+				self.executor.shutdown(wait=False, cancel_futures=True)
+		self.put(None)
+
+	def next_chunk(self) -> bool:
+		if self.finished:
+			return False
+		item = self.queue.get()
+		if item is None:
+			self.finished = True
+			return False
+		if isinstance(item, BaseException):
+			self.finished = True
+			raise item
+		self.chunk = item
+		self.chunk_pos = 0
+		return True
+
+	def read(self, size: int) -> bytes:
+		"""
+		Read size bytes, or fewer at the end of the input.
+		"""
+		if self.chunk_pos + size <= len(self.chunk):
+			data = self.chunk[self.chunk_pos:self.chunk_pos + size]
+			self.chunk_pos += size
+			self.position += size
+			return data
+		parts = [self.chunk[self.chunk_pos:]]
+		remaining = size - len(parts[0])
+		self.chunk = b''
+		self.chunk_pos = 0
+		while remaining > 0 and self.next_chunk():
+			part = self.chunk[:remaining]
+			self.chunk_pos = len(part)
+			parts.append(part)
+			remaining -= len(part)
+		data = b''.join(parts)
+		self.position += len(data)
+		return data
+
+	def skip_zeros(self) -> int:
+		"""
+		Skip zero bytes, e.g. the preallocated tail of a blk*.dat file, and
+		return how many were skipped.
+		"""
+		skipped = 0
+		while True:
+			if self.chunk_pos == len(self.chunk) and self.next_chunk() is False:
+				break
+			match = non_zero_pattern.search(self.chunk, self.chunk_pos)
+			end = len(self.chunk) if match is None else match.start()
+			skipped += end - self.chunk_pos
+			self.chunk_pos = end
+			if match is not None:
+				break
+		self.position += skipped
+		return skipped
+
+	def tell(self) -> int:
+		return self.position
+
+	def close(self):
+		self.closed.set()
+		self.thread.join()
+
+
+def iterate_blocks(reader: DecompressingReader, magic_numbers=utils.NETWORK_MAGICS):
+	"""
+	Yield (offset, block) for every block of the decompressed stream, where
+	offset is the block's offset in the original blk*.dat file. Zero-filled
+	gaps and tails are skipped; unlike scan.iterate_blocks(), we cannot search
+	past damaged data without seeking, so anything else that is not a block
+	raises a ValueError.
+	"""
+	assert isinstance(reader, DecompressingReader)
+	while True:
+		reader.skip_zeros()
+		offset = reader.tell()
+		prefix = reader.read(8)
+		if len(prefix) == 0:
+			return
+		if len(prefix) < 8:
+			raise ValueError(f'Truncated block at offset {offset}')
+		magic_number, block_size = utils.magic_and_size_struct.unpack(prefix)
+		if magic_number not in magic_numbers or not 80 < block_size <= utils.MAX_BLOCK_SERIALIZED_SIZE:
+			raise ValueError(f'No block at offset {offset} (magic number {magic_number:#010x}, size {block_size})')
+		body = reader.read(block_size)
+		if len(body) < block_size:
+			raise ValueError(f'Truncated block at offset {offset}: {block_size} bytes expected but {len(body)} bytes read')
+		block = Block.from_bytes(body)
+		if block.block_size != block_size:
+			raise ValueError(f'Block size is {block_size} but {block.block_size} bytes are parsed')
+		block.magic_number = magic_number
+		yield offset, block
+
+
+def iterate_archive_blocks(file_path: str, workers: int = DEFAULT_WORKERS, magic_numbers=utils.NETWORK_MAGICS):
+	"""
+	Yield (offset, block) for every block of a compressed blk*.dat file, or of
+	stdin if file_path is '-'.
+	"""
+	if file_path == '-':
+		compressed_reader = sys.stdin.buffer
+	else:
+		compressed_reader = open(file_path, 'rb')
+	reader = DecompressingReader(compressed_reader, workers, magic_numbers)
+	try:
+		yield from iterate_blocks(reader, magic_numbers)
+	finally:
+		reader.close()
+		if compressed_reader is not sys.stdin.buffer:
+			compressed_reader.close()
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument(
+		'--file-path', dest='file-path', required=True,
+		help="A blk*.dat file compressed with gzip, bgzip, xz or zstd, or - for stdin."
+	)
+	ap.add_argument(
+		'--workers', dest='workers', default=DEFAULT_WORKERS,
+		help="Number of threads that decompress independently compressed frames (zstd, bgzip)."
+	)
+	ap.add_argument(
+		'--network', dest='network', default=None,
+		choices=sorted(utils.NETWORK_MAGICS.values()),
+		help="Only accept blocks of this network."
+	)
+	ap.add_argument(
+		'--verbose', dest='verbose', action='store_true',
+		help="Print the offset and hash of every block."
+	)
+	args = vars(ap.parse_args())
+	file_path = str(args['file-path'])
+	magic_numbers = utils.NETWORK_MAGICS
+	if args['network'] is not None:
+		magic_numbers = [m for m, n in utils.NETWORK_MAGICS.items() if n == args['network']]
+
+	if file_path != '-' and os.path.isfile(file_path) is False:
+		raise FileNotFoundError(f"[{file_path}] does not exist")
+	start = time.perf_counter()
+	block_count = 0
+	transaction_count = 0
+	size = 0
+	for offset, block in iterate_archive_blocks(file_path, int(args['workers']), magic_numbers):
+		block_count += 1
+		transaction_count += block.transaction_count
+		size = offset + 8 + block.block_size
+		if args['verbose']:
+			print(f"{offset}\t{utils.convert_endianness(block.curr_block_hash).hex()}")
+	elapsed = time.perf_counter() - start
+	print(f"Parsed {block_count} blocks ({transaction_count} transactions, {size / 1e6:.1f} MB) "
+		f"in {elapsed:.2f} seconds", file=sys.stderr)
+
+
+if __name__ == '__main__':
+	main()
@@ -1,10 +1,15 @@
-from opcode import *
+from opcodes import *
 from datetime import datetime
 
-import copy
+import interning
 import io
+import merkle
 import utils
 
+WITNESS_SCALE_FACTOR = 4
+"""
+As defined in BIP141 and in Bitcoin Core's src/consensus/consensus.h
+"""
 
 class BlockHeader:
 
@@ -27,16 +32,13 @@ class BlockHeader:
 	Ref: https://en.bitcoin.it/wiki/Target.
 	"""
 
-	def __init__(self, block_reader: io.BufferedReader):
-		assert isinstance(block_reader, io.BufferedReader)
+	def __init__(self, block_reader: utils.Reader):
+		assert isinstance(block_reader, utils.READER_TYPES)
 		# The following is also the order of bytes of a blk*.dat file.
 
-		self.version = utils.read_4bytes_as_uint(block_reader)
-		self.hash_prev_blk = utils.read_32bytes(block_reader)
-		self.hash_merkle_root = utils.read_32bytes(block_reader)
-		self.timestamp = utils.read_4bytes_as_uint(block_reader)
-		self.bits = utils.read_4bytes_as_uint(block_reader)
-		self.nonce = utils.read_4bytes_as_uint(block_reader)
+		# The header has a fixed 80-byte layout, so it is decoded in one go.
+		(self.version, self.hash_prev_blk, self.hash_merkle_root,
+			self.timestamp, self.bits, self.nonce) = utils.read_struct(block_reader, utils.block_header_struct)
 		self.target_hash = utils.get_target_hash_by_difficulty(self.bits.to_bytes(4, byteorder='little'))
 
 	def get_bytes(self) -> bytes:
@@ -62,12 +64,8 @@ class BlockHeader:
 		# variable-length integers. As a result, the current design, albeit a bit
 		# awkward at the first glance, is actually not that bad.
 
-		array = (self.version.to_bytes(4, byteorder='little') +
-							self.hash_prev_blk +
-							self.hash_merkle_root +
-							self.timestamp.to_bytes(4, byteorder='little') +
-							self.bits.to_bytes(4, byteorder='little') +
-							self.nonce.to_bytes(4, byteorder='little'))
+		array = utils.block_header_struct.pack(self.version, self.hash_prev_blk,
+								self.hash_merkle_root, self.timestamp, self.bits, self.nonce)
 		return array
 
 
@@ -96,18 +94,29 @@ class BlockHeader:
 
 
 class Block:
-	def __init__(self, block_reader: io.BufferedReader):
-		assert isinstance(block_reader, io.BufferedReader)
+	def __init__(self, block_reader: utils.Reader, has_prefix: bool = True):
+		"""
+		Blocks in blk*.dat files are prefixed with the magic number and block
+		size. Raw blocks from other sources (e.g., ZMQ rawblock, RPC getblock with
+		verbosity 0) are not, pass has_prefix=False for them.
+		"""
+		assert isinstance(block_reader, utils.READER_TYPES)
 		self.continue_parsing = True
 		self.magic_number = 0
 		self.block_size = 0
-		self.blockheader = ''
+		self.block_header = None
 		self.transaction_count = 0
 		self.transactions = []
+		self.merkle_tree = None
+
+		if has_prefix is False:
+			start = block_reader.tell()
+			self.parse_body(block_reader)
+			self.block_size = block_reader.tell() - start
+			return
 
 		if self.has_length(block_reader, 8):	
-			self.magic_number = utils.read_4bytes_as_uint(block_reader)
-			self.block_size = utils.read_4bytes_as_uint(block_reader)
+			self.magic_number, self.block_size = utils.magic_and_size_struct.unpack(block_reader.read(8))
 			# For example, after reading the magic number, the next 4 bytes from the 
 			# 1st block in file blk00003.dat (hash 0000000000000a21907a50af01d3eb8bb52cc0b18edea7facf0dce4b31d8932a)
 			# are 48 28 00 00:
@@ -120,18 +129,47 @@ class Block:
 			# If has_length() returns false, there is no next block in the file
 			self.continue_parsing = False
 			return
+
+		if self.magic_number == 0:
+			# Bitcoin Core preallocates blk*.dat files, so a zero magic number means
+			# we have reached the zero-filled tail and there is no next block.
+			self.continue_parsing = False
+			return
 		
 		if self.has_length(block_reader, self.block_size):
-			self.set_header(block_reader)
-			self.transaction_count = utils.read_bytes_as_variable_int(block_reader)
-			self.transactions = []
-
-			for i in range(0, self.transaction_count):
-				transaction = Transaction(block_reader)
-				transaction.seq = i 
-				self.transactions.append(transaction)
+			if type(block_reader) is not utils.BytesReader:
+				# Read the block in one go and decode it from memory, see
+				# utils.read_struct()
+				block_reader = utils.BytesReader(block_reader.read(self.block_size))
+			start = block_reader.tell()
+			self.parse_body(block_reader)
+			if block_reader.tell() - start != self.block_size:
+				# Trailing bytes that no transaction covers, e.g. a damaged block
+				raise ValueError(f'Block size is {self.block_size} but {block_reader.tell() - start} bytes are parsed')
 		else:
+			# The last block of a file that is still being written by Bitcoin Core
+			# can be incomplete. It will be parsed once it is complete.
 			self.continue_parsing = False
+			return
+
+	@staticmethod
+	def from_bytes(buffer, offset: int = 0, has_prefix: bool = False):
+		"""
+		Decode a block from bytes, bytearray or memoryview starting at offset.
+		By default, buffer is a raw block without magic number and block size.
+		"""
+		return Block(utils.BytesReader(buffer, offset), has_prefix)
+
+	def parse_body(self, block_reader: utils.Reader):
+		self.set_header(block_reader)
+		self.transaction_count = utils.read_bytes_as_variable_int(block_reader)
+		self.transactions = []
+		self.merkle_tree = None
+
+		for i in range(0, self.transaction_count):
+			transaction = Transaction(block_reader)
+			transaction.seq = i 
+			self.transactions.append(transaction)
 
 		if self.get_merkle_root() != self.block_header.hash_merkle_root:
 			raise ValueError("\n" + self.get_merkle_root().hex() + "\n" + self.block_header.hash_merkle_root.hex())
@@ -170,9 +208,8 @@ class Block:
 
 	def stdout(self):
 		print("")
-		print(f"  Magic No:          {hex(self.magic_number).upper()}") 
-		assert hex(self.magic_number).upper() == "0XD9B4BEF9"
-		# seems this is something hard-coded		
+		print(f"  Magic No:          {hex(self.magic_number).upper()} ({utils.NETWORK_MAGICS.get(self.magic_number, 'unknown network')})")
+		# The magic number is hard-coded per network, see utils.NETWORK_MAGICS
 		
 		print(f"  Blocksize (bytes): {self.block_size}")
 		print(f"  Curr. Block Hash:  {utils.convert_endianness(self.curr_block_hash).hex()} (Derived from header)")
@@ -187,35 +224,93 @@ class Block:
 			t.stdout()
 		print("  ########## Transaction Data END ##########")
 	
+	def get_merkle_tree(self) -> merkle.MerkleTree:
+		"""
+		The merkle tree of the block's transactions, built on the first request
+		for a branch or proof and cached, so that merkle branches and proofs for
+		many transactions of the same block do not rebuild it.
+		"""
+		if self.merkle_tree is None:
+			self.merkle_tree = merkle.MerkleTree(self.get_raw_txids())
+		return self.merkle_tree
+
+	def get_raw_txids(self) -> list:
+		return [utils.convert_endianness(bytes.fromhex(t.tx_hash)) for t in self.transactions]
+
 	def get_merkle_root(self):
-		digests = []
-		for t in self.transactions:
-			digests.append(utils.double_sha256(t.get_bytes()))
+		# Parsing checks the root of every block, most of which never need a
+		# branch, so the levels are only kept once get_merkle_tree() is called
+		if self.merkle_tree is not None:
+			return self.merkle_tree.get_root()
+		return merkle.get_root(self.get_raw_txids())
 
-		while True:
-			digests_copy = copy.copy(digests)			
+	def get_transaction_index(self, txid: str) -> int:
+		"""
+		Return the position of txid (in big-endian hex, as bitcoin-cli shows it)
+		in the block. Raise ValueError if the block does not contain it.
+		"""
+		for i, transaction in enumerate(self.transactions):
+			if transaction.tx_hash == txid:
+				return i
+		raise ValueError(f'Transaction [{txid}] not found in block')
 
-			if len(digests_copy) == 1:
-				return digests_copy[0]
-			if len(digests_copy) % 2 != 0:
-				digests_copy.append(digests[-1])
+	def get_merkle_branch(self, txid: str) -> list:
+		"""
+		Return the raw sibling hashes from txid up to the merkle root, see
+		merkle.get_root_from_branch() for the reverse.
+		"""
+		return self.get_merkle_tree().get_branch(self.get_transaction_index(txid))
 
-			digests.clear()
-			pos = 0
-			while pos + 1 < len(digests_copy):
-				digests.append(utils.double_sha256(digests_copy[pos] + digests_copy[pos+1]))
-				pos += 2
-			if pos == 0:
-				break
+	def get_tx_out_proof(self, txids: list) -> bytes:
+		"""
+		Return a proof that the block contains txids (in big-endian hex), in the
+		same format as Bitcoin Core's gettxoutproof RPC.
+		"""
+		matches = [False] * self.transaction_count
+		for txid in txids:
+			matches[self.get_transaction_index(txid)] = True
+		hashes, bits = self.get_merkle_tree().get_partial_tree(matches)
+		return merkle.serialize_tx_out_proof(self.block_header.get_bytes(), self.transaction_count, hashes, bits)
 
 
 class Transaction:
 
-	def __init__(self, blockchain: io.BufferedReader):
-		assert isinstance(blockchain, io.BufferedReader)
+	fee: int = None
+	"""
+	Fee in Satoshi. A block does not store it, it is only set after the spent
+	outputs are known, e.g. by undo.attach_undo().
+	"""
+	flags: int = 0
+	"""
+	The flag byte of the witness serialization defined in BIP144, 0 for legacy
+	transactions. Flag 1 means that every input is followed by its witness.
+	"""
+	size: int = 0
+	"""
+	Size in bytes of the transaction as stored in blk*.dat, witnesses included.
+	"""
+	base_size: int = 0
+	"""
+	Size in bytes of the serialization without marker, flag and witnesses,
+	i.e., of the bytes hashed by the txid.
+	"""
+
+	def __init__(self, blockchain: utils.Reader):
+		assert isinstance(blockchain, utils.READER_TYPES)
 
+		start = blockchain.tell()
 		self.version = utils.read_4bytes_as_uint(blockchain)
+		inputs_start = blockchain.tell()
 		self.input_count = utils.read_bytes_as_variable_int(blockchain)
+		if self.input_count == 0:
+			# An empty input list is the marker of BIP144's witness serialization.
+			# It is followed by the flag byte and then the real input list, see
+			# UnserializeTransaction() in Bitcoin Core's src/primitives/transaction.h
+			self.flags = blockchain.read(1)[0]
+			if self.flags != 1:
+				raise ValueError(f'Unknown transaction optional data (flag: {self.flags})')
+			inputs_start = blockchain.tell()
+			self.input_count = utils.read_bytes_as_variable_int(blockchain)
 		self.inputs = []
 		self.seq = 1
 		for i in range(0, self.input_count):
@@ -227,15 +322,71 @@ class Transaction:
 			for i in range(0, self.outCount):
 				output = txOutput(blockchain)
 				self.outputs.append(output)	
+		witness_start = blockchain.tell()
+		if self.flags == 1:
+			for input in self.inputs:
+				input.read_witness(blockchain)
+			if all(len(input.witness) == 0 for input in self.inputs):
+				raise ValueError('Superfluous witness record')
+		witness_end = blockchain.tell()
 		self.lockTime = utils.read_4bytes_as_uint(blockchain)
+		self.size = blockchain.tell() - start
+
+		# The txid does not commit to witnesses, so that they cannot be used to
+		# malleate it
+		if type(blockchain) is not utils.BytesReader:
+			raw_bytes = self.get_bytes(include_witness=False)
+		elif self.flags == 0:
+			raw_bytes = blockchain.buffer[start:blockchain.pos].tobytes()
+		else:
+			raw_bytes = (blockchain.buffer[start:start + 4].tobytes() +
+				blockchain.buffer[inputs_start:witness_start].tobytes() +
+				blockchain.buffer[witness_end:blockchain.pos].tobytes())
+		self.base_size = len(raw_bytes)
+		self.tx_hash = utils.convert_endianness(utils.double_sha256(raw_bytes)).hex()
+
+	@staticmethod
+	def from_bytes(buffer, offset: int = 0):
+		"""
+		Decode a raw transaction (e.g., ZMQ rawtx, RPC getrawtransaction) from
+		bytes, bytearray or memoryview starting at offset.
+		"""
+		return Transaction(utils.BytesReader(buffer, offset))
 
-		self.tx_hash = utils.convert_endianness(utils.double_sha256(self.get_bytes())).hex()
+	def has_witness(self) -> bool:
+		return self.flags != 0
 
+	def get_weight(self) -> int:
+		"""
+		The weight as defined in BIP141: witness bytes count once, all other bytes
+		count WITNESS_SCALE_FACTOR times.
+		"""
+		return self.base_size * (WITNESS_SCALE_FACTOR - 1) + self.size
+
+	def get_vsize(self) -> int:
+		"""
+		The virtual size, i.e. the weight divided by WITNESS_SCALE_FACTOR and
+		rounded up, which fee rates are based on.
+		"""
+		return (self.get_weight() + WITNESS_SCALE_FACTOR - 1) // WITNESS_SCALE_FACTOR
+
+	def get_wtxid(self) -> str:
+		"""
+		The hash of the whole serialization (witnesses included) in big-endian hex,
+		as committed to by the witness commitment of the coinbase transaction.
+		It is the same as the txid for legacy transactions.
+		"""
+		if self.has_witness() is False:
+			return self.tx_hash
+		return utils.convert_endianness(utils.double_sha256(self.get_bytes())).hex()
 		
 	def stdout(self):
 		print(f"    ##### Transactions[{self.seq}] #####")
 		print(f"      Transaction Version:     {self.version}")
 		print(f"      Curr. Tx Hash:           {self.tx_hash} (Derived from block and unverified)")
+		if self.has_witness():
+			print(f"      Witness Tx Hash:         {self.get_wtxid()}")
+			print(f"      Size / Weight:           {self.size} bytes / {self.get_weight()} WU")
 		print(f"      Input Count:             {self.input_count}")
 		for i in range(len(self.inputs)):
 			self.inputs[i].stdout(i)
@@ -246,23 +397,30 @@ class Transaction:
 		print(f"        Lock Time:             {self.lockTime}")
 
 
-	def get_bytes(self):
+	def get_bytes(self, include_witness: bool = True):
 		"""
 		Get original bytes of the transaction section of a block.
 		The bytes returns by this method are supposed to be exactly the
-		same as those ones stored in blk*.dat file
+		same as those ones stored in blk*.dat file. With include_witness=False,
+		return the legacy serialization the txid is computed from.
 		"""
 
 		# The basic idea here is the same as BlockHeader.get_bytes()
 
-
-		array = (self.version.to_bytes(4, byteorder='little') + utils.get_bytes_from_variable_int(self.input_count))
+		include_witness = include_witness and self.has_witness()
+		array = self.version.to_bytes(4, byteorder='little')
+		if include_witness:
+			array += b'\x00' + self.flags.to_bytes(1, byteorder='little')
+		array += utils.get_bytes_from_variable_int(self.input_count)
 		for i in range(len(self.inputs)):
 			array += self.inputs[i].get_bytes()
 
 		array += utils.get_bytes_from_variable_int(self.outCount)
 		for i in range(len(self.outputs)):
 			array += self.outputs[i].get_bytes()
+		if include_witness:
+			for i in range(len(self.inputs)):
+				array += self.inputs[i].get_witness_bytes()
 		array += self.lockTime.to_bytes(4, byteorder='little')	
 		return array
 
@@ -276,11 +434,20 @@ class txInput:
 	"""
 	signature = None
 	pubkey = None
+	prev_output = None
+	"""
+	The output spent by this input as an undo.SpentOutput. A block does not
+	store it, it is only set after undo.attach_undo().
+	"""
+	witness: list = ()
+	"""
+	The witness stack items (bytes) of this input. Empty unless the input's
+	transaction uses the witness serialization, see Transaction.flags.
+	"""
 
-	def __init__(self, block_reader: io.BufferedReader):
-		assert isinstance(block_reader, io.BufferedReader)
-		self.prev_tx_hash = utils.read_32bytes(block_reader)
-		self.txOutId = utils.read_4bytes_as_uint(block_reader)
+	def __init__(self, block_reader: utils.Reader):
+		assert isinstance(block_reader, utils.READER_TYPES)
+		self.prev_tx_hash, self.txOutId = utils.read_struct(block_reader, utils.outpoint_struct)
 		self.script_length = utils.read_bytes_as_variable_int(block_reader)
 		self.script_sig = block_reader.read(self.script_length)
 		# According to https://en.bitcoin.it/wiki/Transaction#Pay-to-PubkeyHash,
@@ -288,6 +455,8 @@ class txInput:
 		# a <pubkey> field (i.e, a public key).
 		self.seqNo = utils.read_4bytes_as_uint(block_reader)
 		self.parse_script_sig()
+		if interning.active_interner is not None:
+			interning.active_interner.intern_input(self)
 
 	def get_bytes(self):
 		"""
@@ -296,14 +465,31 @@ class txInput:
 		same as those ones stored in blk*.dat file
 		"""
 		# The basic idea here is the same as BlockHeader.get_bytes()	
-		array = (self.prev_tx_hash +
-							self.txOutId.to_bytes(4, byteorder='little') +
+		array = (utils.outpoint_struct.pack(self.prev_tx_hash, self.txOutId) +
 							utils.get_bytes_from_variable_int(self.script_length) +
 							self.script_sig +
 							self.seqNo.to_bytes(4, byteorder='little'))
 
 		return array
 
+	def read_witness(self, block_reader: utils.Reader):
+		item_count = utils.read_bytes_as_variable_int(block_reader)
+		self.witness = []
+		for i in range(item_count):
+			item_length = utils.read_bytes_as_variable_int(block_reader)
+			item = block_reader.read(item_length)
+			if len(item) != item_length:
+				raise ValueError(f'Witness item of {item_length} bytes is cut short at {len(item)} bytes')
+			self.witness.append(item)
+		if interning.active_interner is not None:
+			interning.active_interner.intern_witness(self)
+
+	def get_witness_bytes(self):
+		array = utils.get_bytes_from_variable_int(len(self.witness))
+		for item in self.witness:
+			array += utils.get_bytes_from_variable_int(len(item)) + item
+		return array
+
 
 	def stdout(self, idx):
 		print(f"      ## Inputs[{idx}] ##")
@@ -319,20 +505,31 @@ class txInput:
 			print(f"        Address:               {utils.Pubkey2Address.PubkeyToAddress(self.pubkey)} (HASH160: {utils.get_pubkey_hash(self.pubkey).hex()} Pubkey: {self.pubkey})")
 		else:
 			print(" Script op_code is not SIGHASH_ALL")
+		for i, item in enumerate(self.witness):
+			print(f"        Witness[{i}]:            {item.hex()}")
 		
 		
 	  #	assert self.seqNo == 4294967295
 		print(f"        Sequence:              {self.seqNo} (== ffffffff, not in use)")
 
 	def parse_script_sig(self):
-		hexstr = self.script_sig.hex()
 		if 0xffffffff == self.txOutId: #Coinbase
 			return
+		# Only scriptSigs that start with a DER signature push (<sig> <pubkey>,
+		# <sig>) are dissected. Segwit inputs have an empty scriptSig or push a
+		# redeem script, and P2SH multi-signature ones start with OP_0.
+		if len(self.script_sig) < 2 or self.script_sig[1] != 0x30:
+			return
+		hexstr = self.script_sig.hex()
 		script_length = int(hexstr[0:2], 16) * 2
 		# Why x2? My understanding is that in dat file length meansures the number
 		# of bytes but here we need the number of char and two hex chars are used
 		# to represent one byte.
-		r, s, ht = utils.SignatureParser.dissect_signature(hexstr[2:2+script_length])
+		try:
+			r, s, ht = utils.SignatureParser.dissect_signature(hexstr[2:2+script_length])
+		except (AssertionError, ValueError):
+			# Not a strictly DER-encoded signature, e.g. before BIP66
+			return
 		self.signature = r[2:] + s
 		
 		if SIGHASH_ALL != int(hexstr[script_length:script_length+2],16): # should be 0x01
@@ -344,10 +541,30 @@ class txInput:
 		
 
 class txOutput:
+
+	template_id: int = None
+	"""
+	The id of the scriptPubKey's template in interning.TEMPLATES if the output
+	was parsed while an interning.ScriptInterner was active. Then payload only
+	holds the part of the script that identifies its owner, otherwise payload
+	is the whole scriptPubKey.
+	"""
+
 	def __init__(self, blockchain):	
 		self.value = utils.uint8(blockchain)
 		self.scriptLen = utils.read_bytes_as_variable_int(blockchain)
-		self.pubkey = blockchain.read(self.scriptLen)
+		self.payload = blockchain.read(self.scriptLen)
+		if interning.active_interner is not None:
+			interning.active_interner.intern_output(self)
+
+	@property
+	def pubkey(self) -> bytes:
+		"""
+		The scriptPubKey
+		"""
+		if self.template_id is None:
+			return self.payload
+		return interning.expand_script_pubkey(self.template_id, self.payload)
 
 	def get_bytes(self):
 		array = (self.value.to_bytes(8, byteorder='little')+
@@ -357,6 +574,14 @@ class txOutput:
 		return array
 
 
+	def get_script_type(self):
+		"""
+		Return (type, payload) as defined by utils.classify_script_pubkey()
+		"""
+		if self.template_id is not None:
+			return interning.TEMPLATES[self.template_id], self.payload
+		return utils.classify_script_pubkey(self.payload)
+
 	def stdout(self, idx):
 		print(f"      ## Outputs[{idx}] ##")
 		print(f"        Value:                 {self.value:,} Satoshi ({self.value / 100_000_000} Bitcoin)")
@@ -366,6 +591,14 @@ class txOutput:
 
 	def decodeScriptPubkey(self,data):
 		hexstr = data.hex()
+		if len(data) == 0:
+			print("        Transaction Type:      Empty script (anyone can spend)")
+			return hexstr
+		script_type, payload = utils.classify_script_pubkey(data)
+		if script_type in (TX_WITNESS_V0_KEYHASH, TX_WITNESS_V0_SCRIPTHASH, TX_WITNESS_V1_TAPROOT, TX_WITNESS_UNKNOWN):
+			print(f"        Transaction Type:      Witness program ({script_type})")
+			print(f"        Witness Program:       {payload.hex()}")
+			return hexstr
 		op_idx = int(hexstr[0:2], base=16)
 		try: 
 			op_code1 = OPCODE_NAMES[op_idx]
@@ -393,6 +626,10 @@ class txOutput:
 					"tail_op_code:" +  op_codeTail + " " )
 			print("        Pure Pubkey:          %s" % hexstr[4:4+keylen*2])
 			return hexstr
+		elif op_code1 == "OP_RETURN": # Null data, see extract.py to save the payload
+			print("        Transaction Type:      Null data (OP_RETURN)")
+			print(f"        Data Size:             {len(data) - 1} bytes")
+			return hexstr
 		else: #TODO extend for multi-signature parsing 
 			print("\t Need to extend multi-signatuer parsing %x" % int(hexstr[0:2],16) + op_code1)
 			return hexstr
@@ -0,0 +1,189 @@
+from block import Block
+from leveldb import LevelDBReader
+
+import io
+import os
+import utils
+
+# Flags of CBlockIndex::nStatus as defined in Bitcoin Core's src/chain.h
+BLOCK_VALID_MASK = 0x07
+BLOCK_VALID_SCRIPTS = 5
+BLOCK_HAVE_DATA = 8
+BLOCK_HAVE_UNDO = 16
+BLOCK_FAILED_VALID = 32
+BLOCK_FAILED_CHILD = 64
+BLOCK_FAILED_MASK = BLOCK_FAILED_VALID | BLOCK_FAILED_CHILD
+
+BLOCK_INDEX_PREFIX = b'b'
+
+
+def get_block_proof(bits: int) -> int:
+	"""
+	The expected number of hashes to mine a block of compact target bits, as
+	GetBlockProof() in Bitcoin Core's src/chain.cpp. Negative, zero and
+	overflowing targets have no work.
+	"""
+	exponent = bits >> 24
+	mantissa = bits & 0x007fffff
+	if mantissa == 0 or bits & 0x00800000 or (exponent > 34 or
+		(mantissa > 0xff and exponent > 33) or (mantissa > 0xffff and exponent > 32)):
+		return 0
+	if exponent <= 3:
+		target = mantissa >> (8 * (3 - exponent))
+	else:
+		target = mantissa << (8 * (exponent - 3))
+	if target == 0:
+		return 0
+	return 2 ** 256 // (target + 1)
+
+
+class BlockIndexEntry:
+
+	hash: bytes = None
+	"""
+	The raw (i.e. little-endian) hash of the block, the same as
+	Block.curr_block_hash.
+	"""
+	data_pos: int = None
+	"""
+	Offset of the block header in blk{file_number}.dat. Note that the magic
+	number and block size are stored in the 8 bytes BEFORE this offset.
+	"""
+	undo_pos: int = None
+	"""
+	Offset of the block's undo data in rev{file_number}.dat.
+	"""
+	chain_work: int = None
+	"""
+	Total work of the chain up to and including this block, i.e.
+	nChainWork. Set by BlockIndex.build_active_chain().
+	"""
+
+	def __init__(self, block_hash: bytes, value: bytes):
+		# The layout is CDiskBlockIndex's serialization in src/chain.h
+		self.hash = block_hash
+		_, pos = utils.read_core_varint(value, 0)  # client version
+		self.height, pos = utils.read_core_varint(value, pos)
+		self.status, pos = utils.read_core_varint(value, pos)
+		self.transaction_count, pos = utils.read_core_varint(value, pos)
+		self.file_number = None
+		if self.status & (BLOCK_HAVE_DATA | BLOCK_HAVE_UNDO):
+			self.file_number, pos = utils.read_core_varint(value, pos)
+		if self.status & BLOCK_HAVE_DATA:
+			self.data_pos, pos = utils.read_core_varint(value, pos)
+		if self.status & BLOCK_HAVE_UNDO:
+			self.undo_pos, pos = utils.read_core_varint(value, pos)
+		(self.version, self.hash_prev_blk, self.hash_merkle_root,
+			self.timestamp, self.bits, self.nonce) = utils.block_header_struct.unpack_from(value, pos)
+
+	def has_data(self) -> bool:
+		return self.status & BLOCK_HAVE_DATA != 0
+
+	def is_valid(self) -> bool:
+		return (self.status & BLOCK_FAILED_MASK == 0 and
+			self.status & BLOCK_VALID_MASK >= BLOCK_VALID_SCRIPTS)
+
+
+class BlockIndex:
+	"""
+	Read Bitcoin Core's block index (i.e., blocks/index/) so that a block can be
+	located by its height or hash without scanning blk*.dat files.
+	"""
+
+	def __init__(self, blocks_dir: str):
+		self.blocks_dir = blocks_dir
+		self.entries = {}
+		"""
+		Raw (i.e. little-endian) block hash -> BlockIndexEntry, including blocks
+		on stale branches.
+		"""
+		self.active_chain = []
+		"""
+		Height -> raw block hash of the blocks on the active chain.
+		"""
+
+		reader = LevelDBReader(os.path.join(blocks_dir, 'index'))
+		for key, value in reader.items(prefix=BLOCK_INDEX_PREFIX).items():
+			entry = BlockIndexEntry(key[1:], value)
+			self.entries[entry.hash] = entry
+		self.build_active_chain()
+
+	def compute_chain_work(self):
+		"""
+		Set chain_work of every entry. An entry whose ancestors are not all in
+		the index gets the work of the ancestors that are.
+		"""
+		for entry in self.entries.values():
+			entry.chain_work = None
+		for entry in self.entries.values():
+			# Walk back to the first ancestor with known work, then add up forward
+			path = []
+			ancestor = entry
+			while ancestor is not None and ancestor.chain_work is None:
+				path.append(ancestor)
+				ancestor = self.entries.get(ancestor.hash_prev_blk)
+			chain_work = 0 if ancestor is None else ancestor.chain_work
+			for descendant in reversed(path):
+				chain_work += get_block_proof(descendant.bits)
+				descendant.chain_work = chain_work
+
+	def build_active_chain(self):
+		"""
+		The active chain ends at the fully-validated block with the most chain
+		work that does not descend from a block that failed validation. Walk the
+		hash_prev_blk links back from it to the genesis block. Like Bitcoin Core
+		when it loads the index, a failed ancestor disqualifies a tip even if
+		the tip itself is not marked BLOCK_FAILED_CHILD on disk.
+
+		Among tips of equal work, Bitcoin Core keeps the one it received first
+		(the lowest nSequenceId). That order is not stored in the index, so the
+		position of the block in the blk*.dat files, which are written in the
+		order blocks arrive, stands in for it.
+		"""
+		self.compute_chain_work()
+		candidates = sorted(
+			(entry for entry in self.entries.values() if entry.is_valid()),
+			key=lambda entry: (-entry.chain_work, entry.has_data() is False, entry.file_number or 0, entry.data_pos or 0)
+		)
+		self.active_chain = []
+		for tip in candidates:
+			active_chain = [None] * (tip.height + 1)
+			entry = tip
+			while entry is not None and entry.status & BLOCK_FAILED_MASK == 0:
+				active_chain[entry.height] = entry.hash
+				entry = self.entries.get(entry.hash_prev_blk)
+			if entry is None and active_chain[0] is not None:
+				self.active_chain = active_chain
+				return
+
+	def get_height(self) -> int:
+		return len(self.active_chain) - 1
+
+	def get_by_height(self, height: int) -> BlockIndexEntry:
+		if height < 0 or height >= len(self.active_chain):
+			raise IndexError(f'Height {height} is not on the active chain (tip: {self.get_height()})')
+		return self.entries[self.active_chain[height]]
+
+	def get_by_hash(self, block_hash: bytes) -> BlockIndexEntry:
+		"""
+		block_hash is in raw (i.e. little-endian) order. To look up a hash as
+		shown by bitcoin-cli, call get_by_hash(bytes.fromhex(hex_str)[::-1]).
+		"""
+		if block_hash not in self.entries:
+			raise KeyError(f'Block {block_hash[::-1].hex()} is not in the block index')
+		return self.entries[block_hash]
+
+	def get_block_file_path(self, entry: BlockIndexEntry) -> str:
+		return os.path.join(self.blocks_dir, f'blk{entry.file_number:05d}.dat')
+
+	def get_undo_file_path(self, entry: BlockIndexEntry) -> str:
+		return os.path.join(self.blocks_dir, f'rev{entry.file_number:05d}.dat')
+
+	def read_block(self, entry: BlockIndexEntry) -> Block:
+		if entry.has_data() is False:
+			raise ValueError(f'Block {entry.hash[::-1].hex()} is not stored on disk')
+		with open(self.get_block_file_path(entry), 'rb') as block_reader:
+			# data_pos points to the header, Block() expects to start from the
+			# magic number and block size before it.
+			block_reader.seek(entry.data_pos - 8, io.SEEK_SET)
+			return Block(block_reader)
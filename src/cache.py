@@ -0,0 +1,264 @@
+from block import Block
+from opcodes import *
+
+import hashlib
+import io
+import os
+import re
+import stat
+import struct
+import utils
+
+# An optional on-disk cache of decoded blocks. There is one cache file per
+# blk*.dat file, named after the data file's path, mtime and size, so that any
+# change to the data file makes its old cache file unreachable. A cache file
+# is a sequence of records:
+#   record length (4 bytes) | block offset (8 bytes) | BlockRecord
+# A record with length 0 marks the end of the blocks in the data file.
+# Whole cache files are evicted in least-recently-used order once they grow
+# beyond the size limit of the cache.
+
+SCRIPT_TYPES = (
+	TX_NONSTANDARD, TX_PUBKEY, TX_PUBKEYHASH, TX_SCRIPTHASH, TX_MULTISIG, TX_NULLDATA,
+	TX_WITNESS_V0_KEYHASH, TX_WITNESS_V0_SCRIPTHASH, TX_WITNESS_V1_TAPROOT,
+	TX_WITNESS_UNKNOWN
+)
+"""
+The index of a script type in this tuple is its id in the cache. Only append
+to it, otherwise existing cache files will be misread.
+"""
+SCRIPT_TYPE_IDS = {script_type: i for i, script_type in enumerate(SCRIPT_TYPES)}
+
+record_prefix_struct = struct.Struct('<IQ')
+block_struct = struct.Struct('<I32sI')
+transaction_struct = struct.Struct('<32sII')
+input_struct = struct.Struct('<32sIB')
+output_struct = struct.Struct('<QBB')
+
+DEFAULT_MAX_CACHE_SIZE = 1024 * 1024 * 1024
+CACHE_FILE_NAME_PATTERN = re.compile(r'.+\.[0-9a-f]{16}\.cache')
+"""
+Names of the files written by BlockCache.get_cache_path(). evict() leaves
+everything else in the cache directory alone.
+"""
+
+
+class InputRecord:
+	def __init__(self, prev_tx_hash: bytes, tx_out_id: int, address: str):
+		self.prev_tx_hash = prev_tx_hash
+		self.tx_out_id = tx_out_id
+		self.address = address
+
+
+class OutputRecord:
+	def __init__(self, value: int, script_type: str, payload: bytes, address: str):
+		self.value = value
+		self.script_type = script_type
+		self.payload = payload
+		self.address = address
+
+
+class TransactionRecord:
+	def __init__(self, tx_hash: bytes, inputs: list, outputs: list):
+		self.tx_hash = tx_hash
+		"""
+		The raw (i.e. little-endian) txid
+		"""
+		self.inputs = inputs
+		self.outputs = outputs
+
+
+class BlockRecord:
+	"""
+	The parts of a Block that are expensive to derive: hashes (SHA256),
+	script classifications and addresses (RIPEMD160 and Base58).
+	"""
+
+	def __init__(self, offset: int, block_size: int, block_hash: bytes, transactions: list):
+		self.offset = offset
+		self.block_size = block_size
+		self.block_hash = block_hash
+		"""
+		The raw (i.e. little-endian) block hash, the same as Block.curr_block_hash
+		"""
+		self.transactions = transactions
+
+	@staticmethod
+	def from_block(block: Block, offset: int):
+		transactions = []
+		for transaction in block.transactions:
+			inputs = []
+			for tx_input in transaction.inputs:
+				address = None
+				if tx_input.pubkey is not None:
+					address = utils.Pubkey2Address.PubkeyToAddress(tx_input.pubkey).decode()
+				inputs.append(InputRecord(tx_input.prev_tx_hash, tx_input.txOutId, address))
+			outputs = []
+			for tx_output in transaction.outputs:
+				script_type, payload = tx_output.get_script_type()
+				# Payloads of multi-signature and non-standard scripts are not kept
+				payload = bytes(payload) if payload is not None and len(payload) <= 0xff else b''
+				address = utils.get_address_from_script_type(script_type, payload)
+				outputs.append(OutputRecord(tx_output.value, script_type, payload, address))
+			tx_hash = utils.convert_endianness(bytes.fromhex(transaction.tx_hash))
+			transactions.append(TransactionRecord(tx_hash, inputs, outputs))
+		return BlockRecord(offset, block.block_size, block.curr_block_hash, transactions)
+
+	def to_bytes(self) -> bytes:
+		parts = [block_struct.pack(self.block_size, self.block_hash, len(self.transactions))]
+		for transaction in self.transactions:
+			parts.append(transaction_struct.pack(
+				transaction.tx_hash, len(transaction.inputs), len(transaction.outputs)
+			))
+			for tx_input in transaction.inputs:
+				address = tx_input.address.encode() if tx_input.address is not None else b''
+				parts.append(input_struct.pack(tx_input.prev_tx_hash, tx_input.tx_out_id, len(address)))
+				parts.append(address)
+			for tx_output in transaction.outputs:
+				address = tx_output.address.encode() if tx_output.address is not None else b''
+				parts.append(output_struct.pack(
+					tx_output.value, SCRIPT_TYPE_IDS[tx_output.script_type], len(tx_output.payload)
+				))
+				parts.append(tx_output.payload)
+				parts.append(bytes([len(address)]))
+				parts.append(address)
+		return b''.join(parts)
+
+	@staticmethod
+	def from_bytes(buffer, offset: int):
+		pos = 0
+		block_size, block_hash, tx_count = block_struct.unpack_from(buffer, pos)
+		pos += block_struct.size
+		transactions = []
+		for i in range(tx_count):
+			tx_hash, input_count, output_count = transaction_struct.unpack_from(buffer, pos)
+			pos += transaction_struct.size
+			inputs = []
+			for j in range(input_count):
+				prev_tx_hash, tx_out_id, address_length = input_struct.unpack_from(buffer, pos)
+				pos += input_struct.size
+				address = bytes(buffer[pos:pos + address_length]).decode() if address_length > 0 else None
+				pos += address_length
+				inputs.append(InputRecord(prev_tx_hash, tx_out_id, address))
+			outputs = []
+			for j in range(output_count):
+				value, script_type_id, payload_length = output_struct.unpack_from(buffer, pos)
+				pos += output_struct.size
+				payload = bytes(buffer[pos:pos + payload_length])
+				pos += payload_length
+				address_length = buffer[pos]
+				pos += 1
+				address = bytes(buffer[pos:pos + address_length]).decode() if address_length > 0 else None
+				pos += address_length
+				outputs.append(OutputRecord(value, SCRIPT_TYPES[script_type_id], payload, address))
+			transactions.append(TransactionRecord(tx_hash, inputs, outputs))
+		return BlockRecord(offset, block_size, block_hash, transactions)
+
+
+class BlockCache:
+
+	def __init__(self, cache_dir: str, max_size: int = DEFAULT_MAX_CACHE_SIZE):
+		os.makedirs(cache_dir, exist_ok=True)
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+
+	def get_cache_path(self, file_path: str) -> str:
+		file_path = os.path.abspath(file_path)
+		file_stat = os.stat(file_path)
+		key = f'{file_path}|{file_stat.st_mtime_ns}|{file_stat.st_size}'.encode()
+		name = os.path.basename(file_path) + '.' + hashlib.sha256(key).hexdigest()[:16] + '.cache'
+		return os.path.join(self.cache_dir, name)
+
+	def load_records(self, cache_path: str):
+		"""
+		Return block offset -> BlockRecord bytes, and whether the end of the data
+		file has been reached.
+		"""
+		records = {}
+		reached_end = False
+		if os.path.isfile(cache_path) is False:
+			return records, reached_end
+		with open(cache_path, 'rb') as f:
+			data = f.read()
+		pos = 0
+		while pos + record_prefix_struct.size <= len(data):
+			length, offset = record_prefix_struct.unpack_from(data, pos)
+			pos += record_prefix_struct.size
+			if length == 0:
+				reached_end = True
+				break
+			if pos + length > len(data):
+				# A record cut short by a crash. Drop it so that new records are
+				# appended right after the last complete one.
+				os.truncate(cache_path, pos - record_prefix_struct.size)
+				break
+			records[offset] = memoryview(data)[pos:pos + length]
+			pos += length
+		# Mark the file as recently used for evict()
+		os.utime(cache_path)
+		return records, reached_end
+
+	def iterate_blocks(self, file_path: str):
+		"""
+		Yield a BlockRecord for every block of a blk*.dat file. Records are read
+		from the cache if possible, otherwise blocks are parsed and the records
+		are appended to the cache.
+		"""
+		cache_path = self.get_cache_path(file_path)
+		records, reached_end = self.load_records(cache_path)
+		offset = 0
+		block_reader = None
+		cache_writer = None
+		try:
+			while True:
+				if offset in records:
+					record = BlockRecord.from_bytes(records[offset], offset)
+					yield record
+					offset += 8 + record.block_size
+					continue
+				if reached_end:
+					break
+				if block_reader is None:
+					block_reader = open(file_path, 'rb')
+					cache_writer = open(cache_path, 'ab')
+				block_reader.seek(offset, io.SEEK_SET)
+				block = Block(block_reader)
+				if block.continue_parsing is False:
+					# The cache file is only valid for the current size of the data file,
+					# so even an incomplete last block is the end as far as it is concerned.
+					cache_writer.write(record_prefix_struct.pack(0, offset))
+					break
+				record = BlockRecord.from_block(block, offset)
+				record_bytes = record.to_bytes()
+				cache_writer.write(record_prefix_struct.pack(len(record_bytes), offset))
+				cache_writer.write(record_bytes)
+				yield record
+				offset = block_reader.tell()
+		finally:
+			if block_reader is not None:
+				block_reader.close()
+				cache_writer.close()
+				self.evict()
+
+	def evict(self):
+		"""
+		Delete the least recently used cache files until they take no more than
+		max_size. Only regular files named like cache files are counted and
+		deleted, so the cache directory can be shared with other files.
+		"""
+		entries = []
+		total_size = 0
+		for name in os.listdir(self.cache_dir):
+			if CACHE_FILE_NAME_PATTERN.fullmatch(name) is None:
+				continue
+			path = os.path.join(self.cache_dir, name)
+			file_stat = os.lstat(path)
+			if stat.S_ISREG(file_stat.st_mode) is False:
+				continue
+			entries.append((file_stat.st_mtime_ns, file_stat.st_size, path))
+			total_size += file_stat.st_size
+		for _, size, path in sorted(entries):
+			if total_size <= self.max_size:
+				break
+			os.remove(path)
+			total_size -= size
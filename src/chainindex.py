@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+from block import Block
+from blockindex import BlockIndex, BlockIndexEntry
+
+import abc
+import argparse
+import json
+import os
+import sqlite3
+import stats
+import sys
+import time
+import utils
+
+# Keep indexes derived from blk*.dat files in step with the active chain. An
+# index remembers the hash of every block it has connected, by height. On an
+# update we walk back from the new tip along hash_prev_blk links until we reach
+# a block that the index has at the same height. That block is the fork point:
+# the blocks the index has above it were on a branch that is stale now and are
+# disconnected from the top down, then the new branch is connected from the
+# bottom up. So a reorg only costs its own depth, not a rebuild, and a normal
+# tip update is a reorg of depth 0.
+
+DEFAULT_COMMIT_INTERVAL = 1000
+
+
+class ChainIndex(abc.ABC):
+	"""
+	An index that can be rolled back block by block. Blocks are connected and
+	disconnected in chain order, i.e., connect_block() always gets the block at
+	get_tip_height() + 1 and disconnect_block() the one at get_tip_height().
+	What has been connected or disconnected must only become durable in
+	commit(), together with the hashes returned by get_block_hash().
+	"""
+
+	@abc.abstractmethod
+	def get_tip_height(self) -> int:
+		"""
+		Height of the last connected block, or -1 if the index is empty.
+		"""
+
+	@abc.abstractmethod
+	def get_block_hash(self, height: int) -> bytes:
+		"""
+		The raw (i.e. little-endian) hash of the connected block at height.
+		"""
+
+	@abc.abstractmethod
+	def connect_block(self, block: Block, entry: BlockIndexEntry):
+		pass
+
+	@abc.abstractmethod
+	def disconnect_block(self, block: Block, entry: BlockIndexEntry):
+		"""
+		block is None if the stale block is not stored on disk any more (e.g.,
+		after pruning); entry is None if it is not in the block index either.
+		"""
+
+	def commit(self):
+		pass
+
+	def close(self):
+		pass
+
+
+class BlockTxIndex(ChainIndex):
+	"""
+	A SQLite index of the blocks of the active chain (location and statistics
+	as computed by stats.compute_block_stats()) and of their transactions.
+	Every row carries the height of its block, so a block is disconnected by
+	deleting its height's rows.
+
+	A txid can appear twice on the chain (see BIP30, e.g. the coinbases of
+	heights 91842 and 91880 on mainnet). The later location wins, and the one
+	it replaces is moved to replaced_transactions, from which it is restored
+	when the later block is disconnected.
+	"""
+
+	def __init__(self, index_path: str):
+		self.connection = sqlite3.connect(index_path)
+		self.connection.execute(
+			'CREATE TABLE IF NOT EXISTS blocks (height INTEGER PRIMARY KEY, hash BLOB NOT NULL, '
+			'file_number INTEGER, data_pos INTEGER, stats TEXT NOT NULL)'
+		)
+		self.connection.execute(
+			'CREATE TABLE IF NOT EXISTS transactions (txid BLOB PRIMARY KEY, height INTEGER NOT NULL, '
+			'position INTEGER NOT NULL)'
+		)
+		self.connection.execute('CREATE INDEX IF NOT EXISTS transactions_height ON transactions (height)')
+		# replaced_height is the height of the block whose transaction replaced the row
+		self.connection.execute(
+			'CREATE TABLE IF NOT EXISTS replaced_transactions (txid BLOB NOT NULL, height INTEGER NOT NULL, '
+			'position INTEGER NOT NULL, replaced_height INTEGER NOT NULL)'
+		)
+		self.connection.execute(
+			'CREATE INDEX IF NOT EXISTS replaced_transactions_height ON replaced_transactions (replaced_height)'
+		)
+		row = self.connection.execute('SELECT MAX(height) FROM blocks').fetchone()
+		self.tip_height = -1 if row[0] is None else row[0]
+
+	def get_tip_height(self) -> int:
+		return self.tip_height
+
+	def get_block_hash(self, height: int) -> bytes:
+		row = self.connection.execute('SELECT hash FROM blocks WHERE height = ?', (height,)).fetchone()
+		return None if row is None else row[0]
+
+	def connect_block(self, block: Block, entry: BlockIndexEntry):
+		assert entry.height == self.tip_height + 1
+		self.connection.execute(
+			'INSERT INTO blocks (height, hash, file_number, data_pos, stats) VALUES (?, ?, ?, ?, ?)',
+			(entry.height, block.curr_block_hash, entry.file_number, entry.data_pos,
+				json.dumps(stats.compute_block_stats(block, height=entry.height)))
+		)
+		txids = [utils.convert_endianness(bytes.fromhex(transaction.tx_hash)) for transaction in block.transactions]
+		self.connection.executemany(
+			'INSERT INTO replaced_transactions (txid, height, position, replaced_height) '
+			'SELECT txid, height, position, ? FROM transactions WHERE txid = ?',
+			[(entry.height, txid) for txid in txids]
+		)
+		self.connection.executemany(
+			'INSERT OR REPLACE INTO transactions (txid, height, position) VALUES (?, ?, ?)',
+			[(txid, entry.height, i) for i, txid in enumerate(txids)]
+		)
+		self.tip_height = entry.height
+
+	def disconnect_block(self, block: Block, entry: BlockIndexEntry):
+		self.connection.execute('DELETE FROM transactions WHERE height = ?', (self.tip_height,))
+		self.connection.execute(
+			'INSERT INTO transactions (txid, height, position) '
+			'SELECT txid, height, position FROM replaced_transactions WHERE replaced_height = ?',
+			(self.tip_height,)
+		)
+		self.connection.execute('DELETE FROM replaced_transactions WHERE replaced_height = ?', (self.tip_height,))
+		self.connection.execute('DELETE FROM blocks WHERE height = ?', (self.tip_height,))
+		self.tip_height -= 1
+
+	def commit(self):
+		self.connection.commit()
+
+	def close(self):
+		self.connection.close()
+
+	def get_block(self, height: int):
+		"""
+		Return (hash, file number, data_pos, stats) of the block at height, or None.
+		"""
+		row = self.connection.execute(
+			'SELECT hash, file_number, data_pos, stats FROM blocks WHERE height = ?', (height,)
+		).fetchone()
+		if row is None:
+			return None
+		return row[0], row[1], row[2], json.loads(row[3])
+
+	def get_transaction(self, txid: bytes):
+		"""
+		Return (height, position in block) of a raw (i.e. little-endian) txid, or
+		None.
+		"""
+		return self.connection.execute(
+			'SELECT height, position FROM transactions WHERE txid = ?', (txid,)
+		).fetchone()
+
+
+def read_block_with_undo(block_index: BlockIndex, entry: BlockIndexEntry) -> Block:
+	"""
+	Read a block and attach its undo data if there is any, so that fee
+	statistics are available.
+	"""
+	from undo import UndoFileReader, attach_undo
+
+	block = block_index.read_block(entry)
+	if entry.undo_pos is not None:
+		with UndoFileReader(block_index.get_undo_file_path(entry)) as undo_reader:
+			attach_undo(block, undo_reader.read_at(entry.undo_pos))
+	return block
+
+
+def find_fork(index: ChainIndex, block_index: BlockIndex):
+	"""
+	Return (fork height, entries of the new branch from the bottom up). The
+	fork height is the height of the last block the index shares with the
+	active chain, or -1 if they do not even share the genesis block.
+	"""
+	tip_height = index.get_tip_height()
+	new_branch = []
+	entry = None
+	if block_index.get_height() >= 0:
+		entry = block_index.get_by_height(block_index.get_height())
+	while entry is not None and (entry.height > tip_height or index.get_block_hash(entry.height) != entry.hash):
+		new_branch.append(entry)
+		entry = block_index.entries.get(entry.hash_prev_blk)
+	new_branch.reverse()
+	if entry is None:
+		return -1, new_branch
+	return entry.height, new_branch
+
+
+def update_index(index: ChainIndex, block_index: BlockIndex, commit_interval: int = DEFAULT_COMMIT_INTERVAL,
+	read_block=read_block_with_undo, on_commit=None):
+	"""
+	Bring index to the active chain of block_index. Return (number of
+	disconnected blocks, number of connected blocks). Commits happen between
+	blocks, so an interrupted update leaves the index at a consistent (possibly
+	stale) tip that the next update continues from. on_commit, if given, is
+	called with the tip height after every commit while connecting blocks,
+	e.g. to report progress.
+	"""
+	fork_height, new_branch = find_fork(index, block_index)
+	disconnected = 0
+	while index.get_tip_height() > fork_height:
+		stale_entry = block_index.entries.get(index.get_block_hash(index.get_tip_height()))
+		stale_block = None
+		if stale_entry is not None and stale_entry.has_data():
+			stale_block = block_index.read_block(stale_entry)
+		index.disconnect_block(stale_block, stale_entry)
+		disconnected += 1
+		if disconnected % commit_interval == 0:
+			index.commit()
+	index.commit()
+	for connected, entry in enumerate(new_branch, start=1):
+		index.connect_block(read_block(block_index, entry), entry)
+		if connected % commit_interval == 0:
+			index.commit()
+			if on_commit is not None:
+				on_commit(entry.height)
+	index.commit()
+	return disconnected, len(new_branch)
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument(
+		'--blocks-dir', dest='blocks-dir', required=True,
+		help="The blocks/ directory as managed by Bitcoin Core."
+	)
+	ap.add_argument('--index-path', dest='index-path', required=True, help="Path of the SQLite index.")
+	ap.add_argument(
+		'--follow', dest='follow', default=None,
+		help="Keep updating the index every given number of seconds."
+	)
+	ap.add_argument('--height', dest='height', default=None, help="Print the indexed block at this height.")
+	ap.add_argument('--txid', dest='txid', default=None, help="Print the height and position of this transaction.")
+	args = vars(ap.parse_args())
+	blocks_dir = str(args['blocks-dir'])
+
+	if os.path.isdir(blocks_dir) is False:
+		raise FileNotFoundError(f"[{blocks_dir}] does not exist")
+	def print_progress(height: int):
+		print(f"Connected height {height}", file=sys.stderr)
+
+	index = BlockTxIndex(str(args['index-path']))
+	try:
+		while True:
+			block_index = BlockIndex(blocks_dir)
+			disconnected, connected = update_index(index, block_index, on_commit=print_progress)
+			if disconnected > 0 or connected > 0:
+				print(f"Tip {utils.convert_endianness(index.get_block_hash(index.get_tip_height())).hex()} "
+					f"at height {index.get_tip_height()}: {disconnected} blocks disconnected, "
+					f"{connected} blocks connected", file=sys.stderr)
+			if args['follow'] is None:
+				break
+			time.sleep(float(args['follow']))
+		if args['height'] is not None:
+			block = index.get_block(int(args['height']))
+			if block is not None:
+				block_hash, file_number, data_pos, block_stats = block
+				print(json.dumps({
+					'hash': utils.convert_endianness(block_hash).hex(), 'file_number': file_number,
+					'data_pos': data_pos, 'stats': block_stats
+				}))
+		if args['txid'] is not None:
+			print(json.dumps(index.get_transaction(bytes.fromhex(str(args['txid']))[::-1])))
+	finally:
+		index.close()
+
+
+if __name__ == '__main__':
+	main()
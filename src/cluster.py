@@ -0,0 +1,374 @@
+#!/usr/bin/python3
+
+from addrindex import get_address_key, get_script_key
+from block import Block, Transaction
+
+import argparse
+import array
+import base58
+import json
+import os
+import sqlite3
+import sys
+import utils
+
+# Cluster addresses with the common-input-ownership heuristic: all inputs of a
+# transaction are assumed to be controlled by the same entity, so the
+# addresses they spend from are linked. Addresses are keyed as in
+# addrindex.py and the spent scriptPubKeys come from the rev*.dat files, so
+# P2SH, P2PK and other inputs are clustered too, not only P2PKH inputs whose
+# public key is in the scriptSig.
+#
+# Every address key is mapped to a dense integer id by AddressIdMap, which
+# keeps recently used keys in memory and the full map in SQLite, so the number
+# of addresses is not limited by memory. Clusters are a union-find over the
+# ids, backed by two flat arrays of 4 bytes per address (parent and cluster
+# size), with union by size and path halving.
+#
+# As the chain is processed, every new address and every merge of two clusters
+# is emitted as an event, so that cluster assignments can be followed
+# incrementally instead of waiting for a full dump at the end.
+
+DEFAULT_CACHE_SIZE = 4_000_000
+"""
+Number of address keys kept in memory by AddressIdMap.
+"""
+DEFAULT_CHECKPOINT_INTERVAL = 10000
+META_FILE_NAME = 'meta.json'
+ID_MAP_FILE_NAME = 'ids.sqlite'
+PARENTS_FILE_NAME = 'parents.bin'
+SIZES_FILE_NAME = 'sizes.bin'
+
+
+def get_address_from_key(key: bytes) -> str:
+	"""
+	The reverse of addrindex.get_address_key(), or 'script:' + hex of the
+	key for scripts that have no Base58Check address.
+	"""
+	if key[0] in (0x00, 0x05):
+		return base58.b58encode_check(key).decode()
+	return 'script:' + key.hex()
+
+
+def get_input_keys(transaction: Transaction) -> list:
+	"""
+	Return the distinct address keys of the inputs of transaction. The spent
+	scriptPubKey is known if undo.attach_undo() has been called, otherwise
+	only P2PKH inputs are recognized from the public key in their scriptSig.
+	"""
+	keys = []
+	for tx_input in transaction.inputs:
+		if tx_input.prev_output is not None:
+			key = get_script_key(tx_input.prev_output.script_pubkey)
+		elif tx_input.pubkey is not None:
+			key = b'\x00' + utils.get_pubkey_hash(tx_input.pubkey)
+		else:
+			continue
+		if key not in keys:
+			keys.append(key)
+	return keys
+
+
+class AddressIdMap:
+	"""
+	Map address keys to ids 0, 1, 2... in order of first appearance. New ids
+	are buffered and written to SQLite once the in-memory cache is full, then
+	the cache is cleared.
+	"""
+
+	def __init__(self, path: str, cache_size: int = DEFAULT_CACHE_SIZE):
+		self.connection = sqlite3.connect(path)
+		self.connection.execute('PRAGMA synchronous = OFF')
+		self.connection.execute(
+			'CREATE TABLE IF NOT EXISTS addresses (id INTEGER PRIMARY KEY, key BLOB NOT NULL UNIQUE)'
+		)
+		self.cache_size = cache_size
+		self.cache = {}
+		"""
+		Address key -> id of recently used keys, including the pending ones
+		"""
+		self.pending = []
+		"""
+		(id, key) assigned since the last spill
+		"""
+		self.count = self.connection.execute('SELECT COUNT(*) FROM addresses').fetchone()[0]
+
+	def get_id(self, key: bytes, create: bool = True):
+		"""
+		Return (id, is_new) of key. If create is False, return (None, False) for
+		an unknown key.
+		"""
+		address_id = self.cache.get(key)
+		if address_id is not None:
+			return address_id, False
+		row = self.connection.execute('SELECT id FROM addresses WHERE key = ?', (key,)).fetchone()
+		if row is not None:
+			address_id = row[0]
+			is_new = False
+		elif create is False:
+			return None, False
+		else:
+			address_id = self.count
+			self.count += 1
+			self.pending.append((address_id, key))
+			is_new = True
+		if len(self.cache) >= self.cache_size:
+			self.spill()
+		self.cache[key] = address_id
+		return address_id, is_new
+
+	def spill(self):
+		self.flush()
+		self.cache.clear()
+
+	def flush(self):
+		if len(self.pending) > 0:
+			self.connection.executemany('INSERT INTO addresses (id, key) VALUES (?, ?)', self.pending)
+			self.pending.clear()
+		self.connection.commit()
+
+	def iterate_keys(self):
+		"""
+		Yield (id, key) of every address in id order.
+		"""
+		self.flush()
+		yield from self.connection.execute('SELECT id, key FROM addresses ORDER BY id')
+
+	def close(self):
+		self.flush()
+		self.connection.close()
+
+
+class UnionFind:
+	"""
+	Disjoint sets over the ids 0...n-1, backed by arrays of unsigned 32-bit
+	integers.
+	"""
+
+	def __init__(self):
+		self.parents = array.array('I')
+		self.sizes = array.array('I')
+
+	def __len__(self):
+		return len(self.parents)
+
+	def add(self) -> int:
+		i = len(self.parents)
+		self.parents.append(i)
+		self.sizes.append(1)
+		return i
+
+	def find(self, i: int) -> int:
+		parents = self.parents
+		while parents[i] != i:
+			# Path halving: point every other node of the path to its grandparent
+			parents[i] = parents[parents[i]]
+			i = parents[i]
+		return i
+
+	def union(self, i: int, j: int):
+		"""
+		Merge the sets of i and j. Return (absorbed root, surviving root), or None
+		if they are in the same set already.
+		"""
+		i = self.find(i)
+		j = self.find(j)
+		if i == j:
+			return None
+		if self.sizes[i] < self.sizes[j]:
+			i, j = j, i
+		self.parents[j] = i
+		self.sizes[i] += self.sizes[j]
+		return j, i
+
+	def save(self, parents_path: str, sizes_path: str):
+		for values, path in ((self.parents, parents_path), (self.sizes, sizes_path)):
+			with open(path + '.tmp', 'wb') as f:
+				values.tofile(f)
+			os.replace(path + '.tmp', path)
+
+	def load(self, parents_path: str, sizes_path: str, count: int):
+		for values, path in ((self.parents, parents_path), (self.sizes, sizes_path)):
+			del values[:]
+			with open(path, 'rb') as f:
+				values.fromfile(f, count)
+
+
+class AddressClusters:
+	"""
+	The clustering state kept in state_dir, i.e., the id map, the union-find
+	arrays and the last height that has been processed.
+	"""
+
+	def __init__(self, state_dir: str, cache_size: int = DEFAULT_CACHE_SIZE, events=None):
+		os.makedirs(state_dir, exist_ok=True)
+		self.state_dir = state_dir
+		self.events = events
+		"""
+		A text file that receives events as JSON lines, or None
+		"""
+		self.meta = {'height': -1, 'count': 0}
+		"""
+		height is the last height whose transactions are in the saved state and
+		count the number of addresses at that point.
+		"""
+		meta_path = os.path.join(state_dir, META_FILE_NAME)
+		if os.path.isfile(meta_path):
+			with open(meta_path, 'r') as f:
+				self.meta = json.load(f)
+		self.id_map = AddressIdMap(os.path.join(state_dir, ID_MAP_FILE_NAME), cache_size)
+		self.union_find = UnionFind()
+		if self.meta['count'] > 0:
+			self.union_find.load(
+				os.path.join(state_dir, PARENTS_FILE_NAME), os.path.join(state_dir, SIZES_FILE_NAME),
+				self.meta['count']
+			)
+		if self.id_map.count != self.meta['count']:
+			# Ids assigned after the last save, e.g. before a crash, are dropped:
+			# the blocks that assigned them are processed again.
+			self.id_map.connection.execute('DELETE FROM addresses WHERE id >= ?', (self.meta['count'],))
+			self.id_map.connection.commit()
+			self.id_map.count = self.meta['count']
+		self.pending_height = self.meta['height']
+
+	def emit(self, event: dict):
+		if self.events is not None:
+			self.events.write(json.dumps(event) + '\n')
+
+	def add_transaction(self, transaction: Transaction, height: int):
+		ids = []
+		for key in get_input_keys(transaction):
+			address_id, is_new = self.id_map.get_id(key)
+			if is_new:
+				self.union_find.add()
+				self.emit({'height': height, 'address': get_address_from_key(key), 'id': address_id})
+			ids.append(address_id)
+		for address_id in ids[1:]:
+			merge = self.union_find.union(ids[0], address_id)
+			if merge is not None:
+				absorbed, surviving = merge
+				self.emit({
+					'height': height, 'txid': transaction.tx_hash, 'merge': absorbed, 'into': surviving,
+					'size': self.union_find.sizes[surviving]
+				})
+
+	def add_block(self, block: Block, height: int):
+		for transaction in block.transactions[1:]:
+			self.add_transaction(transaction, height)
+		self.pending_height = height
+
+	def save(self):
+		self.id_map.flush()
+		self.union_find.save(
+			os.path.join(self.state_dir, PARENTS_FILE_NAME), os.path.join(self.state_dir, SIZES_FILE_NAME)
+		)
+		if self.events is not None:
+			self.events.flush()
+		self.meta = {'height': self.pending_height, 'count': len(self.union_find)}
+		meta_path = os.path.join(self.state_dir, META_FILE_NAME)
+		with open(meta_path + '.tmp', 'w') as f:
+			json.dump(self.meta, f)
+		os.replace(meta_path + '.tmp', meta_path)
+
+	def get_cluster(self, key: bytes):
+		"""
+		Return the cluster id (i.e., the id of the cluster's root address) of an
+		address key, or None if it has never been spent from.
+		"""
+		address_id, _ = self.id_map.get_id(key, create=False)
+		if address_id is None or address_id >= len(self.union_find):
+			return None
+		return self.union_find.find(address_id)
+
+	def iterate_assignments(self):
+		"""
+		Yield (address, cluster id) of every address in id order.
+		"""
+		for address_id, key in self.id_map.iterate_keys():
+			if address_id >= len(self.union_find):
+				break
+			yield get_address_from_key(key), self.union_find.find(address_id)
+
+	def close(self):
+		self.id_map.close()
+
+
+def build(blocks_dir: str, clusters: AddressClusters, checkpoint_interval: int = DEFAULT_CHECKPOINT_INTERVAL):
+	"""
+	Cluster the active chain in height order, continuing after the last height
+	already processed. Events of blocks after the last checkpoint are emitted
+	again after a crash.
+	"""
+	from blockindex import BlockIndex
+	from undo import UndoFileReader, attach_undo
+
+	block_index = BlockIndex(blocks_dir)
+	undo_path = None
+	undo_reader = None
+	try:
+		for height in range(clusters.meta['height'] + 1, block_index.get_height() + 1):
+			entry = block_index.get_by_height(height)
+			block = block_index.read_block(entry)
+			if entry.undo_pos is not None:
+				if block_index.get_undo_file_path(entry) != undo_path:
+					if undo_reader is not None:
+						undo_reader.close()
+					undo_path = block_index.get_undo_file_path(entry)
+					undo_reader = UndoFileReader(undo_path)
+				attach_undo(block, undo_reader.read_at(entry.undo_pos))
+			clusters.add_block(block, height)
+			if height % checkpoint_interval == 0:
+				clusters.save()
+				print(f"Clustered height {height}, {len(clusters.union_find)} addresses", file=sys.stderr)
+		clusters.save()
+	finally:
+		if undo_reader is not None:
+			undo_reader.close()
+	print(f"Clustered up to height {block_index.get_height()}, {len(clusters.union_find)} addresses", file=sys.stderr)
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument('--state-dir', dest='state-dir', required=True, help="Directory of the clustering state.")
+	ap.add_argument(
+		'--blocks-dir', dest='blocks-dir', default=None,
+		help="The blocks/ directory as managed by Bitcoin Core. Cluster the blocks not processed yet."
+	)
+	ap.add_argument(
+		'--events-output', dest='events-output', default=None,
+		help="Append new addresses and cluster merges to this file as JSON lines."
+	)
+	ap.add_argument(
+		'--assignments-output', dest='assignments-output', default=None,
+		help="Write the cluster id of every address to this CSV file."
+	)
+	ap.add_argument('--address', dest='address', default=None, help="Print the cluster id of this address.")
+	ap.add_argument(
+		'--cache-size', dest='cache-size', default=DEFAULT_CACHE_SIZE,
+		help="Number of address ids kept in memory, the others are looked up in SQLite."
+	)
+	args = vars(ap.parse_args())
+
+	events = None
+	if args['events-output'] is not None:
+		events = open(str(args['events-output']), 'a')
+	clusters = AddressClusters(str(args['state-dir']), int(args['cache-size']), events)
+	try:
+		if args['blocks-dir'] is not None:
+			build(str(args['blocks-dir']), clusters)
+		if args['assignments-output'] is not None:
+			with open(str(args['assignments-output']), 'w') as f:
+				f.write('address,cluster\n')
+				for address, cluster_id in clusters.iterate_assignments():
+					f.write(f'{address},{cluster_id}\n')
+		if args['address'] is not None:
+			print(json.dumps({'address': args['address'], 'cluster': clusters.get_cluster(get_address_key(str(args['address'])))}))
+	finally:
+		clusters.close()
+		if events is not None:
+			events.close()
+
+
+if __name__ == '__main__':
+	main()
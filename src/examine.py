@@ -4,10 +4,22 @@ from utils import *
 from block import Block, BlockHeader
 
 import argparse
+import collections
 import io
 import os
 import sys
 
+DEFAULT_MAX_OPEN_FILES = 64
+DEFAULT_MAX_CACHED_BLOCKS = 256
+DEFAULT_MAX_CACHED_TXIDS = 250000
+"""
+About 40 MB: every txid costs about 160 bytes with its entry in the cache.
+"""
+END_OF_RESPONSE = '.'
+"""
+The line that ends every response of --daemon and --socket, as in SMTP.
+"""
+
 
 def parse(block_reader: io.BufferedReader, start: int, offset: int):
 	assert isinstance(block_reader, io.BufferedReader)
@@ -41,13 +53,386 @@ def parse(block_reader: io.BufferedReader, start: int, offset: int):
 	print(f"Parsed {counter} blocks")
 
 
-def main():
+def parse_with_cache(file_path: str, cache_dir: str, start: int, offset: int):
+	# Imported here so that plain --file-path runs do not pay for it
+	from cache import BlockCache
+
+	block_cache = BlockCache(cache_dir)
+	counter = 0
+	for record in block_cache.iterate_blocks(file_path):
+		counter += 1
+		if counter <= start:
+			continue
+		print(f"#################### Blocks[{counter-1}] BEGIN ####################")
+		print(f"  Blocksize (bytes): {record.block_size}")
+		print(f"  Curr. Block Hash:  {convert_endianness(record.block_hash).hex()}")
+		for i, transaction in enumerate(record.transactions):
+			print(f"    ##### Transactions[{i}] #####")
+			print(f"      Curr. Tx Hash:           {convert_endianness(transaction.tx_hash).hex()}")
+			for j, tx_input in enumerate(transaction.inputs):
+				print(f"      ## Inputs[{j}] ##  {convert_endianness(tx_input.prev_tx_hash).hex()}:"
+					f"{tx_input.tx_out_id} (Addr: {tx_input.address})")
+			for j, tx_output in enumerate(transaction.outputs):
+				print(f"      ## Outputs[{j}] ## {tx_output.value:,} Satoshi {tx_output.script_type} "
+					f"(Addr: {tx_output.address})")
+		print(f"#################### Blocks[{counter-1}] END ####################\n")
+		if counter >= start + offset:
+			break
+	print('')
+	print(f"Parsed {counter} blocks")
+
+
+def parse_by_height(blocks_dir: str, height: int):
+	# Imported here so that plain --file-path runs do not pay for it
+	from blockindex import BlockIndex
+
+	if os.path.isdir(blocks_dir) is False:
+		raise FileNotFoundError(f"[{blocks_dir}] does not exist")
+	block_index = BlockIndex(blocks_dir)
+	entry = block_index.get_by_height(height)
+	print(f"Parsing {os.path.basename(block_index.get_block_file_path(entry))}"
+		f"[offset: {entry.data_pos - 8}] (height: {height})")
+	block = block_index.read_block(entry)
+	print(f"#################### Blocks[height: {height}] BEGIN ####################")
+	block.stdout()
+	print(f"#################### Blocks[height: {height}] END ####################\n")
+
+
+def get_index_state(blocks_dir: str) -> list:
+	"""
+	Name, size and modification time of the files of the block index (i.e.,
+	blocks/index/) that change whenever Bitcoin Core writes to it: CURRENT,
+	the MANIFEST and the write-ahead logs. Tables are only created together
+	with a new MANIFEST.
+	"""
+	index_dir = os.path.join(blocks_dir, 'index')
+	state = []
+	for file_name in sorted(os.listdir(index_dir)):
+		if file_name == 'CURRENT' or file_name.startswith('MANIFEST-') or file_name.endswith('.log'):
+			try:
+				file_stat = os.stat(os.path.join(index_dir, file_name))
+			except FileNotFoundError:
+				# An obsolete log or MANIFEST deleted by a compaction
+				continue
+			state.append((file_name, file_stat.st_size, file_stat.st_mtime_ns))
+	return state
+
+
+class BlockFile:
+	"""
+	An open blk*.dat file and the table of the blocks found in it so far.
+	"""
+
+	def __init__(self, file_path: str):
+		self.block_reader = open(file_path, 'rb')
+		self.inode = os.fstat(self.block_reader.fileno()).st_ino
+		self.offsets = []
+		"""
+		Position of the magic number of every complete block, in file order.
+		"""
+		self.numbers = {}
+		"""
+		Block number in the file by position of the magic number.
+		"""
+		self.sizes = []
+		self.end = 0
+
+	def refresh(self):
+		"""
+		Extend the table with the blocks written since the last call. Only the
+		8-byte prefixes are read, block bodies are skipped. Bitcoin Core
+		preallocates blk*.dat files, so new blocks do not necessarily change the
+		file size and the prefix at self.end is checked every time.
+		"""
+		file_size = os.fstat(self.block_reader.fileno()).st_size
+		while self.end + 8 <= file_size:
+			self.block_reader.seek(self.end)
+			magic_number, block_size = magic_and_size_struct.unpack(self.block_reader.read(8))
+			if magic_number == 0 or self.end + 8 + block_size > file_size:
+				# The zero-filled tail or a block that is still being written
+				break
+			self.numbers[self.end] = len(self.offsets)
+			self.offsets.append(self.end)
+			self.sizes.append(block_size)
+			self.end += 8 + block_size
+
+	def read_block(self, number: int) -> Block:
+		self.block_reader.seek(self.offsets[number])
+		return Block.from_bytes(self.block_reader.read(8 + self.sizes[number]), has_prefix=True)
+
+	def close(self):
+		self.block_reader.close()
+
+
+class Examiner:
+	"""
+	Answers examine.py queries in a long-running process. Open files, their
+	block tables, the most recently decoded blocks and the txids of decoded
+	blocks are kept between queries, so asking for a block again costs a
+	dictionary lookup and printing it. All caches are bounded and evict in
+	least-recently-used order. Not thread-safe, serve_socket() serializes
+	queries.
+	"""
+
+	def __init__(self, max_open_files: int = DEFAULT_MAX_OPEN_FILES,
+		max_cached_blocks: int = DEFAULT_MAX_CACHED_BLOCKS, max_cached_txids: int = DEFAULT_MAX_CACHED_TXIDS):
+		self.max_open_files = max_open_files
+		self.max_cached_blocks = max_cached_blocks
+		self.max_cached_txids = max_cached_txids
+		self.block_files = collections.OrderedDict()
+		self.blocks = collections.OrderedDict()
+		"""
+		Decoded blocks by (absolute file path, block number in the file).
+		"""
+		self.txids = collections.OrderedDict()
+		"""
+		(absolute file path, block number) by txid, for every decoded block.
+		txids are kept as 32 bytes rather than hex strings, which take twice the
+		memory.
+		"""
+		self.block_indexes = {}
+		"""
+		(get_index_state(), BlockIndex) by absolute blocks directory.
+		"""
+		self.argument_parser = None
+
+	def get_block_file(self, file_path: str) -> BlockFile:
+		file_path = os.path.abspath(file_path)
+		block_file = self.block_files.get(file_path)
+		if block_file is not None and (os.path.isfile(file_path) is False or
+			block_file.inode != os.stat(file_path).st_ino):
+			# The file was replaced or removed, e.g., by a reindex
+			self.close_block_file(file_path)
+			block_file = None
+		if block_file is None:
+			if os.path.isfile(file_path) is False:
+				raise FileNotFoundError(f"[{file_path}] does not exist")
+			block_file = BlockFile(file_path)
+			self.block_files[file_path] = block_file
+			if len(self.block_files) > self.max_open_files:
+				self.close_block_file(next(iter(self.block_files)))
+		else:
+			self.block_files.move_to_end(file_path)
+		block_file.refresh()
+		return block_file
+
+	def close_block_file(self, file_path: str):
+		"""
+		Close the file and forget its blocks and txids.
+		"""
+		self.block_files.pop(file_path).close()
+		for key in [key for key in self.blocks if key[0] == file_path]:
+			del self.blocks[key]
+		for txid in [txid for txid, location in self.txids.items() if location[0] == file_path]:
+			del self.txids[txid]
+
+	def get_block(self, file_path: str, number: int) -> Block:
+		file_path = os.path.abspath(file_path)
+		# Even for a cached block, so that the blocks of a replaced file are not
+		# served
+		block_file = self.get_block_file(file_path)
+		block = self.blocks.get((file_path, number))
+		if block is not None:
+			self.blocks.move_to_end((file_path, number))
+			return block
+		block = block_file.read_block(number)
+		self.blocks[(file_path, number)] = block
+		if len(self.blocks) > self.max_cached_blocks:
+			self.blocks.popitem(last=False)
+		location = (file_path, number)
+		for transaction in block.transactions:
+			self.txids[bytes.fromhex(transaction.tx_hash)] = location
+		while len(self.txids) > self.max_cached_txids:
+			self.txids.popitem(last=False)
+		return block
+
+	def print_blocks(self, file_path: str, start: int, offset: int):
+		"""
+		Print the same blocks as parse(), i.e., offset blocks (at least one)
+		from start.
+		"""
+		block_count = len(self.get_block_file(file_path).offsets)
+		print(f"Parsing {os.path.basename(file_path)}[{start}: {start + offset}]")
+		if start >= block_count:
+			print(f"Start {start} is past the last block, {os.path.basename(file_path)} "
+				f"has {block_count} blocks", file=sys.stderr)
+			return
+		end = min(start + max(offset, 1), block_count)
+		for number in range(start, end):
+			print(f"#################### Blocks[{number}] BEGIN ####################")
+			self.get_block(file_path, number).stdout()
+			print(f"#################### Blocks[{number}] END ####################\n")
+		if end == block_count:
+			print('')
+			print('Reached End of Field')
+			print(f"Parsed {block_count} blocks")
+
+	def find_transaction(self, txid: str, file_path: str = None):
+		"""
+		Return (file path, block number, transaction) of txid (in big-endian
+		hex, as bitcoin-cli shows it). Transactions of blocks that were not
+		decoded yet are only found if file_path is given. Raise ValueError if
+		txid is not found.
+		"""
+		location = self.txids.get(bytes.fromhex(txid))
+		if location is not None:
+			try:
+				# Forgets the txids of the file if it was replaced or removed
+				self.get_block_file(location[0])
+			except FileNotFoundError:
+				pass
+			location = self.txids.get(bytes.fromhex(txid))
+		if location is not None:
+			for transaction in self.get_block(*location).transactions:
+				if transaction.tx_hash == txid:
+					return location[0], location[1], transaction
+		if file_path is not None:
+			for number in range(len(self.get_block_file(file_path).offsets)):
+				for transaction in self.get_block(file_path, number).transactions:
+					if transaction.tx_hash == txid:
+						return os.path.abspath(file_path), number, transaction
+		raise ValueError(f'Transaction [{txid}] not found')
+
+	def print_transaction(self, txid: str, file_path: str = None):
+		file_path, number, transaction = self.find_transaction(txid.lower(), file_path)
+		print(f"Parsing {os.path.basename(file_path)}[{number}] (txid: {transaction.tx_hash})")
+		transaction.stdout()
+
+	def print_by_height(self, blocks_dir: str, height: int):
+		# Imported here so that plain --file-path runs do not pay for it
+		from blockindex import BlockIndex
+
+		if os.path.isdir(blocks_dir) is False:
+			raise FileNotFoundError(f"[{blocks_dir}] does not exist")
+		blocks_dir = os.path.abspath(blocks_dir)
+		index_state = get_index_state(blocks_dir)
+		cached = self.block_indexes.get(blocks_dir)
+		if cached is None or cached[0] != index_state:
+			# Reloaded whenever bitcoind has written to the index since, e.g., a
+			# new tip or a reorg that changed the block at a known height
+			cached = (index_state, BlockIndex(blocks_dir))
+			self.block_indexes[blocks_dir] = cached
+		block_index = cached[1]
+		entry = block_index.get_by_height(height)
+		block_file = self.get_block_file(block_index.get_block_file_path(entry))
+		number = block_file.numbers.get(entry.data_pos - 8)
+		print(f"Parsing {os.path.basename(block_index.get_block_file_path(entry))}"
+			f"[offset: {entry.data_pos - 8}] (height: {height})")
+		if number is not None:
+			block = self.get_block(block_file.block_reader.name, number)
+		else:
+			# Behind a zero-filled gap, where the block table of the file stops
+			block = block_index.read_block(entry)
+		print(f"#################### Blocks[height: {height}] BEGIN ####################")
+		block.stdout()
+		print(f"#################### Blocks[height: {height}] END ####################\n")
 
+	def query(self, args: dict):
+		if args['height'] is not None:
+			if args['blocks-dir'] is None:
+				self.argument_parser.error('--height requires --blocks-dir')
+			self.print_by_height(str(args['blocks-dir']), int(args['height']))
+		elif args['txid'] is not None:
+			self.print_transaction(str(args['txid']), args['file-path'])
+		elif args['file-path'] is None:
+			self.argument_parser.error('either --file-path, --height or --txid is required')
+		elif args['cache-dir'] is not None:
+			start = int(args['start'])
+			offset = int(args['offset'])
+			print(f"Parsing {os.path.basename(str(args['file-path']))}[{start}: {start + offset}]")
+			parse_with_cache(str(args['file-path']), str(args['cache-dir']), start=start, offset=offset)
+		else:
+			self.print_blocks(str(args['file-path']), int(args['start']), int(args['offset']))
+
+	def answer(self, line: str) -> str:
+		"""
+		Answer one query line, which takes the same options as the command line
+		(e.g. --file-path blk00000.dat --start 5 --offset 2). Return what the
+		query printed, including errors, followed by END_OF_RESPONSE.
+		"""
+		# Imported here so that plain --file-path runs do not pay for it
+		import contextlib
+		import shlex
+
+		output = io.StringIO()
+		with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+			try:
+				self.query(vars(self.argument_parser.parse_args(shlex.split(line))))
+			except SystemExit:
+				# argparse has printed the usage and the error
+				pass
+			except Exception as e:
+				print(f"Error: {e}")
+		return output.getvalue() + END_OF_RESPONSE + '\n'
+
+	def close(self):
+		# Cleared first, so that closing the files does not scan them
+		self.blocks.clear()
+		self.txids.clear()
+		for file_path in list(self.block_files):
+			self.close_block_file(file_path)
+
+
+def serve_lines(examiner: Examiner):
+	"""
+	Answer queries from stdin, one per line, until EOF.
+	"""
+	for line in sys.stdin:
+		if line.strip() == '':
+			continue
+		sys.stdout.write(examiner.answer(line))
+		sys.stdout.flush()
+
+
+def serve_socket(examiner: Examiner, socket_path: str):
+	"""
+	Answer queries on a Unix socket with the protocol of serve_lines(). Every
+	connection gets its own thread and can send any number of queries.
+	"""
+	# Imported here so that plain --file-path runs do not pay for it
+	import socketserver
+	import stat
+	import threading
+
+	lock = threading.Lock()
+
+	class QueryHandler(socketserver.StreamRequestHandler):
+		def handle(self):
+			for line in self.rfile:
+				if line.strip() == b'':
+					continue
+				with lock:
+					response = examiner.answer(line.decode())
+				self.wfile.write(response.encode())
+
+	if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+		# Left behind by a previous run
+		os.remove(socket_path)
+	server = socketserver.ThreadingUnixStreamServer(socket_path, QueryHandler)
+	server.daemon_threads = True
+	print(f"Serving queries on {socket_path}", file=sys.stderr)
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		os.remove(socket_path)
+
+
+def build_argument_parser() -> argparse.ArgumentParser:
 	ap = argparse.ArgumentParser()
 	ap.add_argument(
-		'--file-path', dest='file-path', required=True, 
+		'--file-path', dest='file-path', default=None,
 		help="The path of blk*.dat file as managed by Bitcoin Core."
 	)
+	ap.add_argument(
+		'--blocks-dir', dest='blocks-dir', default=None,
+		help="The blocks/ directory as managed by Bitcoin Core. Used with --height."
+	)
+	ap.add_argument(
+		'--height', dest='height', default=None,
+		help="Height of a block on the active chain. The block is located with " \
+			"Bitcoin Core's block index (i.e., blocks/index/) instead of --file-path."
+	)
 	ap.add_argument(
 		'--start', dest='start', default=0, 
 		help="Start index of a block withIN the given data file." \
@@ -55,14 +440,78 @@ def main():
 				 "an empty result set."
 	)
 	ap.add_argument('--offset', dest='offset', default=-1, help="Offset from start.")
+	ap.add_argument(
+		'--cache-dir', dest='cache-dir', default=None,
+		help="Print a summary (hashes, script types and addresses) of blocks and " \
+			"keep it in this directory, so that the next run does not decode them again."
+	)
+	ap.add_argument(
+		'--txid', dest='txid', default=None,
+		help="Print this transaction. It is looked up in the blocks of --file-path " \
+			"or, with --daemon and --socket, in all blocks decoded so far."
+	)
+	return ap
+
+
+def main():
+
+	ap = build_argument_parser()
+	ap.add_argument(
+		'--daemon', dest='daemon', action='store_true',
+		help="Keep running and answer queries from stdin, one per line, with the " \
+			"options above (e.g. --file-path blk00000.dat --start 5). Every response " \
+			f"ends with a line '{END_OF_RESPONSE}'."
+	)
+	ap.add_argument('--socket', dest='socket', default=None, help="Like --daemon, but on this Unix socket.")
+	ap.add_argument(
+		'--max-cached-blocks', dest='max-cached-blocks', default=DEFAULT_MAX_CACHED_BLOCKS,
+		help="Number of decoded blocks that --daemon and --socket keep in memory."
+	)
+	ap.add_argument(
+		'--max-cached-txids', dest='max-cached-txids', default=DEFAULT_MAX_CACHED_TXIDS,
+		help="Number of txids of decoded blocks that --daemon and --socket keep for --txid."
+	)
 	args = vars(ap.parse_args())
+	if args['daemon'] or args['socket'] is not None:
+		examiner = Examiner(
+			max_cached_blocks=int(args['max-cached-blocks']), max_cached_txids=int(args['max-cached-txids'])
+		)
+		# Queries must not start daemons of their own
+		examiner.argument_parser = build_argument_parser()
+		try:
+			if args['socket'] is not None:
+				serve_socket(examiner, str(args['socket']))
+			else:
+				serve_lines(examiner)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			examiner.close()
+		return
+	if args['height'] is not None:
+		if args['blocks-dir'] is None:
+			ap.error('--height requires --blocks-dir')
+		parse_by_height(str(args['blocks-dir']), int(args['height']))
+		return
+	if args['file-path'] is None:
+		ap.error('either --file-path or --height is required')
 	file_path = str(args['file-path'])
 	start = int(args['start'])
 	offset = int(args['offset'])
 
 	if os.path.isfile(file_path) is False:
 		raise FileNotFoundError(f"[{file_path}] does not exist")
+	if args['txid'] is not None:
+		examiner = Examiner()
+		try:
+			examiner.print_transaction(str(args['txid']), file_path)
+		finally:
+			examiner.close()
+		return
 	print(f"Parsing {os.path.basename(file_path)}[{start}: {start + offset}]")
+	if args['cache-dir'] is not None:
+		parse_with_cache(file_path, str(args['cache-dir']), start=start, offset=offset)
+		return
 	with open(file_path, 'rb') as block_reader:
 		# rb: Opens the file as read-only in binary format and starts reading from
 		# the beginning of the file.
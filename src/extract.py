@@ -0,0 +1,362 @@
+#!/usr/bin/python3
+
+from opcodes import *
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import utils
+
+# Extract the data carried by the transactions of a blk*.dat file:
+#   - OP_RETURN outputs: the data pushed after OP_RETURN,
+#   - inscription envelopes in witnesses:
+#       OP_FALSE OP_IF "ord" <tag> <value>... OP_0 <body pushes>... OP_ENDIF
+#     where tag 1 is the content type.
+# Blocks are walked at byte level in the mmap-ed file instead of being decoded
+# by block.py, so payloads are never copied: their pushes are hashed and
+# written to disk as memoryview slices of the map.
+# Output files are named after the SHA256 of their content, so a payload is
+# stored once however often it occurs, and every occurrence is recorded in an
+# index of JSON lines (block, txid, output or input, MIME type, size, SHA256).
+
+ENVELOPE_MARKER = bytes([OP_FALSE, OP_IF, 3]) + b'ord'
+CONTENT_TYPE_TAG = b'\x01'
+INDEX_FILE_NAME = 'index.jsonl'
+DEFAULT_MIN_SIZE = 1
+SNIFF_SIZE = 512
+"""
+Number of bytes at the beginning of a payload that are used to guess its MIME
+type if it does not state one.
+"""
+
+MIME_SIGNATURES = (
+	(b'\x89PNG\r\n\x1a\n', 'image/png'),
+	(b'\xff\xd8\xff', 'image/jpeg'),
+	(b'GIF87a', 'image/gif'),
+	(b'GIF89a', 'image/gif'),
+	(b'%PDF-', 'application/pdf'),
+	(b'\x1f\x8b', 'application/gzip'),
+	(b'PK\x03\x04', 'application/zip'),
+	(b'<svg', 'image/svg+xml'),
+	(b'<!DOCTYPE html', 'text/html'),
+	(b'<html', 'text/html'),
+)
+
+
+class TransactionSpans:
+	"""
+	Where the parts of a transaction are in the buffer it was walked in, as
+	(start, end) offsets.
+	"""
+
+	def __init__(self, start: int):
+		self.start = start
+		self.end = None
+		self.txid = None
+		"""
+		The txid in big-endian hex, as shown by bitcoin-cli
+		"""
+		self.output_scripts = []
+		self.witnesses = []
+		"""
+		One list of witness items per input, empty for legacy transactions
+		"""
+
+
+def walk_transaction(buffer, pos: int) -> TransactionSpans:
+	"""
+	Walk the (legacy or segwit) transaction at pos without copying any of it.
+	The txid hashes the serialization without marker, flag and witnesses.
+	"""
+	spans = TransactionSpans(pos)
+	is_segwit = buffer[pos + 4] == 0 and buffer[pos + 5] == 1
+	inputs_start = pos + (6 if is_segwit else 4)
+	input_count, pos = utils.unpack_variable_int_from(buffer, inputs_start)
+	for _ in range(input_count):
+		script_length, pos = utils.unpack_variable_int_from(buffer, pos + 36)
+		pos += script_length + 4
+	output_count, pos = utils.unpack_variable_int_from(buffer, pos)
+	for _ in range(output_count):
+		script_length, pos = utils.unpack_variable_int_from(buffer, pos + 8)
+		spans.output_scripts.append((pos, pos + script_length))
+		pos += script_length
+	outputs_end = pos
+	if is_segwit:
+		for _ in range(input_count):
+			item_count, pos = utils.unpack_variable_int_from(buffer, pos)
+			items = []
+			for _ in range(item_count):
+				item_length, pos = utils.unpack_variable_int_from(buffer, pos)
+				items.append((pos, pos + item_length))
+				pos += item_length
+			spans.witnesses.append(items)
+	spans.end = pos + 4
+	if spans.end > len(buffer):
+		raise ValueError(f'Transaction at offset {spans.start} ends beyond the buffer')
+
+	digest = hashlib.sha256()
+	if is_segwit:
+		digest.update(buffer[spans.start:spans.start + 4])
+		digest.update(buffer[inputs_start:outputs_end])
+		digest.update(buffer[pos:spans.end])
+	else:
+		digest.update(buffer[spans.start:spans.end])
+	spans.txid = hashlib.sha256(digest.digest()).digest()[::-1].hex()
+	return spans
+
+
+def read_push(buffer, pos: int, end: int):
+	"""
+	Read one script operation at pos. Return (opcode, data start, data end, next
+	position); data start and end are None for opcodes that push no data
+	(OP_1NEGATE and OP_1...OP_16 push numbers, not data).
+	"""
+	opcode = buffer[pos]
+	pos += 1
+	if opcode < OP_PUSHDATA1:
+		size = opcode
+	elif opcode == OP_PUSHDATA1:
+		size = buffer[pos]
+		pos += 1
+	elif opcode == OP_PUSHDATA2:
+		size = utils.uint16_struct.unpack_from(buffer, pos)[0]
+		pos += 2
+	elif opcode == OP_PUSHDATA4:
+		size = utils.uint32_struct.unpack_from(buffer, pos)[0]
+		pos += 4
+	else:
+		return opcode, None, None, pos
+	if pos + size > end:
+		raise ValueError(f'Push of {size} bytes beyond the end of the script')
+	return opcode, pos, pos + size, pos + size
+
+
+def get_op_return_spans(buffer, start: int, end: int) -> list:
+	"""
+	Return the (start, end) of every push after OP_RETURN, or None if the
+	script is not an OP_RETURN script made of pushes only.
+	"""
+	if start == end or buffer[start] != OP_RETURN:
+		return None
+	spans = []
+	pos = start + 1
+	while pos < end:
+		opcode, data_start, data_end, pos = read_push(buffer, pos, end)
+		if data_start is None:
+			return None
+		spans.append((data_start, data_end))
+	return spans
+
+
+def iterate_envelopes(file_map: mmap.mmap, start: int, end: int):
+	"""
+	Yield (content type, spans of the body pushes) of every inscription envelope
+	in file_map[start:end], e.g. a tapscript witness item. The spans are empty
+	for an envelope that ends before its body, which is an inscription too.
+	"""
+	pos = file_map.find(ENVELOPE_MARKER, start, end)
+	while pos >= 0:
+		pos += len(ENVELOPE_MARKER)
+		content_type = None
+		body = None
+		try:
+			while pos < end:
+				opcode, data_start, data_end, pos = read_push(file_map, pos, end)
+				if opcode == OP_ENDIF:
+					body = []
+					break
+				if data_start is not None and data_start == data_end:
+					# OP_0 separates the fields from the body
+					body = []
+					while pos < end:
+						opcode, data_start, data_end, pos = read_push(file_map, pos, end)
+						if data_start is None:
+							break
+						body.append((data_start, data_end))
+					break
+				tag = bytes([opcode - OP_1 + 1]) if data_start is None else file_map[data_start:data_end]
+				_, value_start, value_end, pos = read_push(file_map, pos, end)
+				if tag == CONTENT_TYPE_TAG and value_start is not None:
+					content_type = file_map[value_start:value_end].decode('utf-8', errors='replace')
+		except (ValueError, IndexError, struct.error):
+			body = None
+		if body is not None:
+			yield content_type, body
+		pos = file_map.find(ENVELOPE_MARKER, pos, end)
+
+
+def guess_mime_type(head: bytes) -> str:
+	for signature, mime_type in MIME_SIGNATURES:
+		if head.startswith(signature):
+			return mime_type
+	if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+		return 'image/webp'
+	try:
+		text = head.decode('utf-8')
+	except UnicodeDecodeError as ex:
+		# The head may end in the middle of a multi-byte character
+		if len(head) < SNIFF_SIZE or ex.start < len(head) - 3:
+			return 'application/octet-stream'
+		text = head[:ex.start].decode('utf-8')
+	if len(text) > 0 and all(c.isprintable() or c in '\t\r\n' for c in text):
+		stripped = text.lstrip()
+		if stripped.startswith('{') or stripped.startswith('['):
+			return 'application/json'
+		return 'text/plain;charset=utf-8'
+	return 'application/octet-stream'
+
+
+class PayloadWriter:
+	"""
+	Write payloads to content-addressed files under output_dir/<2 hex digits>/
+	and record them in output_dir/index.jsonl. The index is rewritten by every
+	run, payload files are kept and reused.
+	"""
+
+	def __init__(self, output_dir: str, min_size: int = DEFAULT_MIN_SIZE):
+		os.makedirs(output_dir, exist_ok=True)
+		self.output_dir = output_dir
+		self.min_size = min_size
+		self.index = open(os.path.join(output_dir, INDEX_FILE_NAME), 'w')
+		self.payload_count = 0
+		self.file_count = 0
+		self.total_size = 0
+
+	def write(self, buffer, spans: list, record: dict, mime_type: str = None, always_record: bool = False):
+		"""
+		spans are (start, end) slices of buffer that make up the payload in order.
+		A payload smaller than min_size is skipped, unless always_record is set:
+		then it is recorded in the index without a file and with sha256 None.
+		"""
+		size = sum(end - start for start, end in spans)
+		if size < self.min_size:
+			if always_record:
+				record.update({'mime': mime_type, 'size': size, 'sha256': None})
+				self.index.write(json.dumps(record) + '\n')
+				self.payload_count += 1
+			return
+		digest = hashlib.sha256()
+		for start, end in spans:
+			digest.update(buffer[start:end])
+		name = digest.hexdigest()
+		path = os.path.join(self.output_dir, name[:2], name)
+		if os.path.exists(path) is False:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			with open(path + '.tmp', 'wb') as f:
+				for start, end in spans:
+					f.write(buffer[start:end])
+			os.replace(path + '.tmp', path)
+			self.file_count += 1
+		if mime_type is None:
+			head = b''
+			for start, end in spans:
+				head += bytes(buffer[start:min(end, start + SNIFF_SIZE - len(head))])
+				if len(head) >= SNIFF_SIZE:
+					break
+			mime_type = guess_mime_type(head)
+		record.update({'mime': mime_type, 'size': size, 'sha256': name})
+		self.index.write(json.dumps(record) + '\n')
+		self.payload_count += 1
+		self.total_size += size
+
+	def close(self):
+		self.index.close()
+
+
+def iterate_transactions(file_map: mmap.mmap, magic_numbers=utils.NETWORK_MAGICS):
+	"""
+	Yield (block hash in big-endian hex, TransactionSpans) of every transaction
+	of an mmap-ed blk*.dat file. Like scan.iterate_blocks(), we search for the
+	next magic number after zero-filled gaps and damaged blocks.
+	"""
+	buffer = memoryview(file_map)
+	next_positions = {}
+	offset = 0
+	try:
+		while offset is not None and offset + 8 <= len(file_map):
+			magic_number, block_size = utils.magic_and_size_struct.unpack_from(file_map, offset)
+			block_end = offset + 8 + block_size
+			if magic_number in magic_numbers and 80 < block_size <= utils.MAX_BLOCK_SERIALIZED_SIZE and block_end <= len(file_map):
+				block_buffer = buffer[:block_end]
+				try:
+					block_hash = utils.double_sha256(file_map[offset + 8:offset + 88])[::-1].hex()
+					transaction_count, pos = utils.unpack_variable_int_from(block_buffer, offset + 88)
+					transactions = []
+					for _ in range(transaction_count):
+						spans = walk_transaction(block_buffer, pos)
+						transactions.append(spans)
+						pos = spans.end
+					if pos != block_end:
+						raise ValueError(f'Block size is {block_size} but {pos - offset - 8} bytes are parsed')
+				except (ValueError, IndexError, struct.error) as ex:
+					print(f"Skipping corrupt block at offset {offset}: {repr(ex)}", file=sys.stderr)
+					transactions = None
+				finally:
+					block_buffer.release()
+				if transactions is not None:
+					for spans in transactions:
+						yield block_hash, spans
+					offset = block_end
+					continue
+			offset = utils.find_next_magic(file_map, offset + 1, magic_numbers, next_positions)
+	finally:
+		buffer.release()
+
+
+def extract_file(file_path: str, writer: PayloadWriter, magic_numbers=utils.NETWORK_MAGICS):
+	with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+		# Slices of an mmap are copies, slices of a memoryview are not
+		buffer = memoryview(file_map)
+		try:
+			for block_hash, spans in iterate_transactions(file_map, magic_numbers):
+				for vout, (start, end) in enumerate(spans.output_scripts):
+					push_spans = get_op_return_spans(file_map, start, end)
+					if push_spans is not None:
+						writer.write(buffer, push_spans, {
+							'block': block_hash, 'txid': spans.txid, 'output': vout, 'kind': 'op_return'
+						})
+				for input_index, items in enumerate(spans.witnesses):
+					for start, end in items:
+						for content_type, body in iterate_envelopes(file_map, start, end):
+							writer.write(buffer, body, {
+								'block': block_hash, 'txid': spans.txid, 'input': input_index, 'kind': 'inscription'
+							}, content_type, always_record=True)
+		finally:
+			buffer.release()
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument(
+		'--file-path', dest='file-path', required=True, nargs='+',
+		help="The path of blk*.dat files as managed by Bitcoin Core."
+	)
+	ap.add_argument(
+		'--output-dir', dest='output-dir', required=True,
+		help="Directory of the extracted payloads and their index."
+	)
+	ap.add_argument(
+		'--min-size', dest='min-size', default=DEFAULT_MIN_SIZE,
+		help="Payloads smaller than this many bytes are skipped."
+	)
+	args = vars(ap.parse_args())
+
+	writer = PayloadWriter(str(args['output-dir']), int(args['min-size']))
+	try:
+		for file_path in args['file-path']:
+			if os.path.isfile(file_path) is False:
+				raise FileNotFoundError(f"[{file_path}] does not exist")
+			extract_file(file_path, writer)
+			print(f"Extracted {file_path}: {writer.payload_count} payloads so far", file=sys.stderr)
+	finally:
+		writer.close()
+	print(f"{writer.payload_count} payloads ({writer.total_size:,} bytes) in {writer.file_count} new files", file=sys.stderr)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,296 @@
+#!/usr/bin/python3
+
+from block import Block
+
+import argparse
+import json
+import mmap
+import numpy
+import os
+import utils
+
+# BIP158 basic compact block filters. A filter is a Golomb-coded set of every
+# output scriptPubKey of a block (except empty and OP_RETURN ones) and every
+# scriptPubKey spent by its inputs, as served by Bitcoin Core's getblockfilter:
+#   N (CompactSize) | Golomb-Rice coded, sorted deltas of the hashed items
+# An item is hashed with SipHash-2-4 keyed by the block hash and mapped into
+# [0, N * M). Spent scriptPubKeys come from rev*.dat, see undo.py.
+# Hashing, sorting and encoding work on numpy arrays of a whole block at once,
+# since doing it one item at a time in Python is far slower than parsing.
+
+BASIC_FILTER_P = 19
+BASIC_FILTER_M = 784931
+OP_RETURN_BYTE = 0x6a
+GENESIS_PREV_FILTER_HEADER = b'\x00' * 32
+
+SIPHASH_CONSTANTS = (0x736f6d6570736575, 0x646f72616e646f6d, 0x6c7967656e657261, 0x7465646279746573)
+LOW_32_BITS = numpy.uint64(0xffffffff)
+
+
+def rotate_left(x, b: int):
+	return (x << numpy.uint64(b)) | (x >> numpy.uint64(64 - b))
+
+
+def sip_round(v0, v1, v2, v3):
+	v0 += v1
+	v1 = rotate_left(v1, 13)
+	v1 ^= v0
+	v0 = rotate_left(v0, 32)
+	v2 += v3
+	v3 = rotate_left(v3, 16)
+	v3 ^= v2
+	v0 += v3
+	v3 = rotate_left(v3, 21)
+	v3 ^= v0
+	v2 += v1
+	v1 = rotate_left(v1, 17)
+	v1 ^= v2
+	v2 = rotate_left(v2, 32)
+	return v0, v1, v2, v3
+
+
+def siphash_batch(k0: int, k1: int, items: list):
+	"""
+	Return SipHash-2-4(k0, k1, item) of every item as a numpy uint64 array.
+	Items are grouped by their number of 8-byte message words, and every group
+	is hashed as one set of array operations.
+	"""
+	result = numpy.zeros(len(items), dtype=numpy.uint64)
+	groups = {}
+	for i, item in enumerate(items):
+		groups.setdefault(len(item) // 8 + 1, []).append(i)
+	for word_count, indexes in groups.items():
+		# The last word holds the remaining bytes and the length in its top byte
+		padded = b''.join(
+			items[i] + b'\x00' * (word_count * 8 - 1 - len(items[i])) + bytes([len(items[i]) & 0xff])
+			for i in indexes
+		)
+		words = numpy.frombuffer(padded, dtype='<u8').reshape(len(indexes), word_count).astype(numpy.uint64)
+		v0 = numpy.full(len(indexes), k0 ^ SIPHASH_CONSTANTS[0], dtype=numpy.uint64)
+		v1 = numpy.full(len(indexes), k1 ^ SIPHASH_CONSTANTS[1], dtype=numpy.uint64)
+		v2 = numpy.full(len(indexes), k0 ^ SIPHASH_CONSTANTS[2], dtype=numpy.uint64)
+		v3 = numpy.full(len(indexes), k1 ^ SIPHASH_CONSTANTS[3], dtype=numpy.uint64)
+		for w in range(word_count):
+			m = words[:, w]
+			v3 ^= m
+			v0, v1, v2, v3 = sip_round(v0, v1, v2, v3)
+			v0, v1, v2, v3 = sip_round(v0, v1, v2, v3)
+			v0 ^= m
+		v2 ^= numpy.uint64(0xff)
+		for _ in range(4):
+			v0, v1, v2, v3 = sip_round(v0, v1, v2, v3)
+		result[indexes] = v0 ^ v1 ^ v2 ^ v3
+	return result
+
+
+def multiply_high(a, f: int):
+	"""
+	(a * f) >> 64 for a uint64 array and f < 2 ** 64, i.e., BIP158's
+	hash_to_range(), computed with 32-bit limbs since numpy has no 128-bit type.
+	"""
+	a0, a1 = a & LOW_32_BITS, a >> numpy.uint64(32)
+	f0, f1 = numpy.uint64(f & 0xffffffff), numpy.uint64(f >> 32)
+	p00, p01, p10, p11 = a0 * f0, a0 * f1, a1 * f0, a1 * f1
+	middle = (p00 >> numpy.uint64(32)) + (p01 & LOW_32_BITS) + (p10 & LOW_32_BITS)
+	return p11 + (p01 >> numpy.uint64(32)) + (p10 >> numpy.uint64(32)) + (middle >> numpy.uint64(32))
+
+
+def get_siphash_key(block_hash: bytes):
+	"""
+	k0 and k1 are the first 16 bytes of the raw (i.e. little-endian) block hash
+	"""
+	return (utils.uint64_struct.unpack_from(block_hash, 0)[0],
+		utils.uint64_struct.unpack_from(block_hash, 8)[0])
+
+
+def hash_items(block_hash: bytes, items: list):
+	"""
+	Return the sorted hashed values of items as a numpy uint64 array
+	"""
+	k0, k1 = get_siphash_key(block_hash)
+	values = multiply_high(siphash_batch(k0, k1, items), len(items) * BASIC_FILTER_M)
+	values.sort()
+	return values
+
+
+def golomb_rice_encode(values, p: int = BASIC_FILTER_P) -> bytes:
+	"""
+	Encode the deltas of sorted values: every delta is its quotient (delta >> p)
+	in unary (ones terminated by a zero) followed by its remainder in p bits,
+	most significant bit first. The bit stream is padded with zeros to a byte.
+	"""
+	deltas = numpy.diff(values, prepend=numpy.uint64(0))
+	quotients = (deltas >> numpy.uint64(p)).astype(numpy.int64)
+	remainders = deltas & numpy.uint64((1 << p) - 1)
+	# Every delta takes quotient + 1 + p bits, starting right after the previous one
+	lengths = quotients + 1 + p
+	starts = numpy.cumsum(lengths) - lengths
+	bits = numpy.zeros(int(lengths.sum()), dtype=numpy.uint8)
+	quotient_total = int(quotients.sum())
+	if quotient_total > 0:
+		first_ones = numpy.repeat(starts, quotients)
+		offsets = numpy.arange(quotient_total) - numpy.repeat(numpy.cumsum(quotients) - quotients, quotients)
+		bits[first_ones + offsets] = 1
+	shifts = numpy.arange(p - 1, -1, -1, dtype=numpy.uint64)
+	remainder_bits = (remainders[:, None] >> shifts[None, :]) & numpy.uint64(1)
+	bits[(starts + quotients + 1)[:, None] + numpy.arange(p)[None, :]] = remainder_bits
+	return numpy.packbits(bits).tobytes()
+
+
+def golomb_rice_decode(data: bytes, count: int, p: int = BASIC_FILTER_P) -> list:
+	"""
+	The reverse of golomb_rice_encode(), returns the sorted values
+	"""
+	bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))
+	values = []
+	value = 0
+	pos = 0
+	for _ in range(count):
+		quotient = 0
+		while bits[pos] == 1:
+			quotient += 1
+			pos += 1
+		pos += 1
+		remainder = 0
+		for bit in bits[pos:pos + p]:
+			remainder = (remainder << 1) | int(bit)
+		pos += p
+		value += (quotient << p) | remainder
+		values.append(value)
+	return values
+
+
+def get_filter_items(block: Block) -> list:
+	"""
+	Return the distinct scripts of a basic filter. Every non-coinbase input
+	must have its txInput.prev_output set, e.g. by undo.attach_undo().
+	"""
+	items = set()
+	for transaction in block.transactions:
+		for tx_output in transaction.outputs:
+			script = bytes(tx_output.pubkey)
+			if len(script) > 0 and script[0] != OP_RETURN_BYTE:
+				items.add(script)
+		for tx_input in transaction.inputs:
+			if tx_input.txOutId == 0xffffffff:  # Coinbase
+				continue
+			if tx_input.prev_output is None:
+				raise ValueError(f'Input of transaction {transaction.tx_hash} has no spent output, '
+					'attach the undo data first')
+			if len(tx_input.prev_output.script_pubkey) > 0:
+				items.add(bytes(tx_input.prev_output.script_pubkey))
+	return sorted(items)
+
+
+def build_basic_filter(block: Block) -> bytes:
+	items = get_filter_items(block)
+	encoded = b''
+	if len(items) > 0:
+		encoded = golomb_rice_encode(hash_items(block.curr_block_hash, items))
+	return utils.get_bytes_from_variable_int(len(items)) + encoded
+
+
+def match_any(filter_bytes: bytes, block_hash: bytes, items: list) -> bool:
+	"""
+	Check whether any of items (scriptPubKeys) may be in a basic filter, as a
+	light client does. False positives happen at a rate of 1 / M.
+	"""
+	count, pos = utils.unpack_variable_int_from(filter_bytes, 0)
+	if count == 0 or len(items) == 0:
+		return False
+	k0, k1 = get_siphash_key(block_hash)
+	targets = set(int(v) for v in multiply_high(siphash_batch(k0, k1, items), count * BASIC_FILTER_M))
+	return any(value in targets for value in golomb_rice_decode(filter_bytes[pos:], count))
+
+
+def get_filter_header(filter_bytes: bytes, prev_header: bytes) -> bytes:
+	"""
+	Return the raw filter header: double_sha256(filter hash + previous header)
+	"""
+	return utils.double_sha256(utils.double_sha256(filter_bytes) + prev_header)
+
+
+def build_file_filters(blocks_dir: str, file_number: int, prev_header: bytes = None):
+	"""
+	Yield (height, block hash, filter, filter header) for every block of the
+	active chain stored in blk{file_number}.dat, in height order. Headers chain
+	from prev_header, the raw header of the block before the first one (not
+	needed if the file starts at the genesis block). Headers are None if it is
+	not known, or after a gap in heights, e.g. blocks stored in another file.
+	"""
+	from blockindex import BlockIndex
+	from undo import UndoFileReader, attach_undo
+
+	block_index = BlockIndex(blocks_dir)
+	entries = [
+		block_index.entries[block_hash] for block_hash in block_index.active_chain
+		if block_index.entries[block_hash].file_number == file_number and
+		block_index.entries[block_hash].has_data()
+	]
+	if len(entries) == 0:
+		return
+	if entries[0].height == 0:
+		prev_header = GENESIS_PREV_FILTER_HEADER
+	block_path = os.path.join(blocks_dir, f'blk{file_number:05d}.dat')
+	undo_path = os.path.join(blocks_dir, f'rev{file_number:05d}.dat')
+	undo_reader = None
+	if os.path.isfile(undo_path):
+		undo_reader = UndoFileReader(undo_path)
+	try:
+		with open(block_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+			prev_height = entries[0].height - 1
+			for entry in entries:
+				block = Block.from_bytes(buffer, entry.data_pos)
+				if entry.undo_pos is not None:
+					if undo_reader is None:
+						raise FileNotFoundError(f"[{undo_path}] does not exist")
+					block_undo = undo_reader.read_at(entry.undo_pos)
+					try:
+						attach_undo(block, block_undo)
+					finally:
+						# A traceback would keep the view alive and undo_reader open
+						block_undo.release()
+				elif entry.height > 0:
+					raise ValueError(f'Block {entry.hash[::-1].hex()} has no undo data')
+				filter_bytes = build_basic_filter(block)
+				header = None
+				if prev_header is not None and entry.height == prev_height + 1:
+					header = get_filter_header(filter_bytes, prev_header)
+				prev_header, prev_height = header, entry.height
+				yield entry.height, entry.hash, filter_bytes, header
+	finally:
+		# Also when a block fails or the caller stops iterating early
+		if undo_reader is not None:
+			undo_reader.close()
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument(
+		'--blocks-dir', dest='blocks-dir', required=True,
+		help="The blocks/ directory as managed by Bitcoin Core."
+	)
+	ap.add_argument('--file-number', dest='file-number', required=True, help="Build filters for blk<N>.dat")
+	ap.add_argument(
+		'--prev-header', dest='prev-header', default=None,
+		help="Filter header (as getblockfilter shows it) of the block before the first block of the file."
+	)
+	args = vars(ap.parse_args())
+	prev_header = None
+	if args['prev-header'] is not None:
+		prev_header = utils.convert_endianness(bytes.fromhex(str(args['prev-header'])))
+
+	for height, block_hash, filter_bytes, header in build_file_filters(
+		str(args['blocks-dir']), int(args['file-number']), prev_header
+	):
+		# Hashes and headers are shown in big-endian order, as bitcoin-cli does
+		print(json.dumps({
+			'height': height, 'hash': utils.convert_endianness(block_hash).hex(),
+			'filter': filter_bytes.hex(),
+			'header': utils.convert_endianness(header).hex() if header is not None else None
+		}))
+
+
+if __name__ == '__main__':
+	main()
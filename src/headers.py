@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+
+import argparse
+import numpy
+import os
+import utils
+
+# Whole-chain header analytics on a structured numpy array of 80-byte block
+# headers, one row per height of the active chain. 256-bit values (targets and
+# chainwork) are arrays of 8 little-endian 32-bit limbs per header, kept in
+# uint64 so that sums of limbs cannot overflow before their carries are
+# propagated. Consensus rules follow Bitcoin Core's src/pow.cpp and
+# src/validation.cpp.
+
+HEADER_DTYPE = numpy.dtype([
+	('version', '<i4'), ('hash_prev_blk', 'u1', 32), ('hash_merkle_root', 'u1', 32),
+	('timestamp', '<u4'), ('bits', '<u4'), ('nonce', '<u4')
+])
+assert HEADER_DTYPE.itemsize == 80
+
+LIMB_COUNT = 8
+LIMB_BITS = 32
+LIMB_MASK = numpy.uint64(0xffffffff)
+
+RETARGET_INTERVAL = 2016
+TARGET_TIMESPAN = 14 * 24 * 60 * 60
+TARGET_SPACING = 10 * 60
+MEDIAN_TIME_SPAN = 11
+
+NETWORK_PARAMS = {
+	'mainnet': {'pow_limit_bits': 0x1d00ffff, 'allow_min_difficulty': False, 'no_retargeting': False, 'enforce_bip94': False},
+	'testnet3': {'pow_limit_bits': 0x1d00ffff, 'allow_min_difficulty': True, 'no_retargeting': False, 'enforce_bip94': False},
+	'testnet4': {'pow_limit_bits': 0x1d00ffff, 'allow_min_difficulty': True, 'no_retargeting': False, 'enforce_bip94': True},
+	'signet': {'pow_limit_bits': 0x1e0377ae, 'allow_min_difficulty': False, 'no_retargeting': False, 'enforce_bip94': False},
+	'regtest': {'pow_limit_bits': 0x207fffff, 'allow_min_difficulty': True, 'no_retargeting': True, 'enforce_bip94': False}
+}
+"""
+Proof-of-work parameters of CChainParams in Bitcoin Core's src/kernel/chainparams.cpp,
+keyed by the network names of utils.NETWORK_MAGICS.
+"""
+
+
+def load_headers_from_index(blocks_dir: str):
+	"""
+	Return the headers of the active chain, in height order, from the block index.
+	"""
+	from blockindex import BlockIndex
+
+	block_index = BlockIndex(blocks_dir)
+	raw = b''.join(
+		utils.block_header_struct.pack(e.version, e.hash_prev_blk, e.hash_merkle_root, e.timestamp, e.bits, e.nonce)
+		for e in (block_index.entries[block_hash] for block_hash in block_index.active_chain)
+	)
+	return numpy.frombuffer(raw, dtype=HEADER_DTYPE)
+
+
+def load_headers_from_file(path: str):
+	"""
+	Read a file of concatenated 80-byte headers, as written by save_headers().
+	"""
+	return numpy.fromfile(path, dtype=HEADER_DTYPE)
+
+
+def save_headers(headers, path: str):
+	headers.tofile(path + '.tmp')
+	os.replace(path + '.tmp', path)
+
+
+def get_block_hashes(headers):
+	"""
+	Return the raw (i.e. little-endian) hash of every header
+	"""
+	raw = headers.tobytes()
+	return [utils.double_sha256(raw[i:i + 80]) for i in range(0, len(raw), 80)]
+
+
+def limbs_to_int(limbs) -> int:
+	value = 0
+	for limb in reversed(limbs.tolist()):
+		value = (value << LIMB_BITS) | limb
+	return value
+
+
+def int_to_limbs(value: int):
+	return [(value >> (LIMB_BITS * i)) & 0xffffffff for i in range(LIMB_COUNT)]
+
+
+def get_targets(bits):
+	"""
+	Expand compact targets (nBits) into 256-bit limbs, as arith_uint256::SetCompact().
+	Negative and overflowing targets are treated as mantissa & 0x7fffff without
+	the overflow, they are invalid anyway.
+	"""
+	bits = bits.astype(numpy.uint64)
+	exponents = (bits >> numpy.uint64(24)).astype(numpy.int64)
+	mantissas = bits & numpy.uint64(0x007fffff)
+	targets = numpy.zeros((len(bits), LIMB_COUNT), dtype=numpy.uint64)
+	small = exponents <= 3
+	# An exponent of 3 or less shifts the mantissa right, into the lowest limb
+	targets[small, 0] = mantissas[small] >> (numpy.uint64(8) * (3 - exponents[small]).astype(numpy.uint64))
+	rows = numpy.nonzero(~small)[0]
+	shifts = 8 * (exponents[rows] - 3)
+	limbs = shifts // LIMB_BITS
+	shifted = mantissas[rows] << (shifts % LIMB_BITS).astype(numpy.uint64)
+	in_range = limbs < LIMB_COUNT
+	targets[rows[in_range], limbs[in_range]] = shifted[in_range] & LIMB_MASK
+	in_range = limbs + 1 < LIMB_COUNT
+	targets[rows[in_range], limbs[in_range] + 1] = shifted[in_range] >> numpy.uint64(LIMB_BITS)
+	return targets
+
+
+def get_target(bits: int) -> int:
+	return limbs_to_int(get_targets(numpy.array([bits], dtype=numpy.uint32))[0])
+
+
+def get_difficulties(bits):
+	"""
+	The same floating-point difficulty as GetDifficulty() in Bitcoin Core, for
+	every nBits at once.
+	"""
+	exponents = (bits >> 24).astype(numpy.int64)
+	mantissas = (bits & 0x00ffffff).astype(numpy.float64)
+	return 0xffff / mantissas * numpy.power(256.0, 0x1d - exponents)
+
+
+def get_chainwork(bits):
+	"""
+	Return the cumulative chainwork after every header as 256-bit limbs. The work
+	of a block is 2 ** 256 // (target + 1), as GetBlockProof() in src/chain.cpp.
+	Targets only change at retargets, so the division is done once per distinct
+	nBits with Python integers, and the running sum is done on limbs.
+	"""
+	unique_bits, inverse = numpy.unique(bits, return_inverse=True)
+	work_table = numpy.array([
+		int_to_limbs(2 ** 256 // (limbs_to_int(target) + 1)) for target in get_targets(unique_bits)
+	], dtype=numpy.uint64).reshape(len(unique_bits), LIMB_COUNT)
+	sums = numpy.cumsum(work_table[inverse], axis=0, dtype=numpy.uint64)
+	carry = numpy.zeros(len(bits), dtype=numpy.uint64)
+	for i in range(LIMB_COUNT):
+		total = sums[:, i] + carry
+		carry = total >> numpy.uint64(LIMB_BITS)
+		sums[:, i] = total & LIMB_MASK
+	return sums
+
+
+def get_chainwork_hex(chainwork, height: int) -> str:
+	"""
+	Format chainwork the same way as getblockheader does
+	"""
+	return ''.join(f'{limb:08x}' for limb in reversed(chainwork[height].tolist()))
+
+
+def get_compact(target: int) -> int:
+	"""
+	The reverse of get_targets() for one target, as arith_uint256::GetCompact()
+	"""
+	size = (target.bit_length() + 7) // 8
+	if size <= 3:
+		compact = target << (8 * (3 - size))
+	else:
+		compact = target >> (8 * (size - 3))
+	if compact & 0x00800000:
+		compact >>= 8
+		size += 1
+	return compact | (size << 24)
+
+
+def get_median_time_past(timestamps):
+	"""
+	Median of the timestamps of every header and up to 10 headers before it,
+	as CBlockIndex::GetMedianTimePast().
+	"""
+	timestamps = timestamps.astype(numpy.int64)
+	result = numpy.empty(len(timestamps), dtype=numpy.int64)
+	head = min(MEDIAN_TIME_SPAN - 1, len(timestamps))
+	for i in range(head):
+		result[i] = numpy.sort(timestamps[:i + 1])[(i + 1) // 2]
+	if len(timestamps) >= MEDIAN_TIME_SPAN:
+		windows = numpy.lib.stride_tricks.sliding_window_view(timestamps, MEDIAN_TIME_SPAN)
+		result[MEDIAN_TIME_SPAN - 1:] = numpy.partition(windows, MEDIAN_TIME_SPAN // 2, axis=1)[:, MEDIAN_TIME_SPAN // 2]
+	return result
+
+
+def get_inter_block_times(timestamps):
+	"""
+	Seconds between every header and the one before it (0 for the genesis
+	block). They can be negative, timestamps only have to exceed the
+	median-time-past.
+	"""
+	timestamps = timestamps.astype(numpy.int64)
+	return numpy.diff(timestamps, prepend=timestamps[:1])
+
+
+def check_timestamps(timestamps, median_time_past):
+	"""
+	Whether every header's timestamp is greater than the median-time-past of its
+	parent, as ContextualCheckBlockHeader(). The genesis block is always valid.
+	"""
+	valid = numpy.ones(len(timestamps), dtype=bool)
+	valid[1:] = timestamps[1:].astype(numpy.int64) > median_time_past[:-1]
+	return valid
+
+
+def get_next_retarget_bits(first_bits: int, last_bits: int, first_time: int, last_time: int,
+	pow_limit_bits: int, enforce_bip94: bool) -> int:
+	"""
+	CalculateNextWorkRequired(): scale the target by the actual timespan of the
+	last 2016 blocks, limited to a factor of 4 either way.
+	"""
+	timespan = min(max(last_time - first_time, TARGET_TIMESPAN // 4), TARGET_TIMESPAN * 4)
+	# BIP94 (testnet4) uses the first block of the period, which cannot be a
+	# min-difficulty block
+	old_bits = first_bits if enforce_bip94 else last_bits
+	target = get_target(old_bits) * timespan // TARGET_TIMESPAN
+	return get_compact(min(target, get_target(pow_limit_bits)))
+
+
+def check_retargets(headers, network: str = 'mainnet'):
+	"""
+	Whether the nBits of every header is what GetNextWorkRequired() expects.
+	Between retargets, this is a vectorized comparison with the previous
+	header. Retargets (one per 2016 headers) are computed with Python integers.
+	"""
+	params = NETWORK_PARAMS[network]
+	bits = headers['bits'].astype(numpy.int64)
+	timestamps = headers['timestamp'].astype(numpy.int64)
+	heights = numpy.arange(len(headers))
+	valid = numpy.ones(len(headers), dtype=bool)
+	if len(headers) < 2:
+		return valid
+	if params['no_retargeting']:
+		valid[1:] = bits[1:] == bits[:-1]
+		return valid
+
+	is_boundary = heights % RETARGET_INTERVAL == 0
+	expected = numpy.empty(len(headers), dtype=numpy.int64)
+	expected[1:] = bits[:-1]
+	if params['allow_min_difficulty']:
+		# Off a retarget, the last block that is a boundary or not a
+		# min-difficulty block sets the difficulty, except that a block more than
+		# 20 minutes after its parent may use the minimum difficulty.
+		is_normal = is_boundary | (bits != params['pow_limit_bits'])
+		last_normal = numpy.maximum.accumulate(numpy.where(is_normal, heights, 0))
+		expected[1:] = bits[last_normal[:-1]]
+		is_late = numpy.zeros(len(headers), dtype=bool)
+		is_late[1:] = timestamps[1:] > timestamps[:-1] + 2 * TARGET_SPACING
+		expected[is_late] = params['pow_limit_bits']
+	valid[1:] = bits[1:] == expected[1:]
+
+	for height in range(RETARGET_INTERVAL, len(headers), RETARGET_INTERVAL):
+		first = height - RETARGET_INTERVAL
+		valid[height] = bits[height] == get_next_retarget_bits(
+			int(bits[first]), int(bits[height - 1]), int(timestamps[first]), int(timestamps[height - 1]),
+			params['pow_limit_bits'], params['enforce_bip94']
+		)
+	return valid
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument(
+		'--blocks-dir', dest='blocks-dir', default=None,
+		help="The blocks/ directory as managed by Bitcoin Core."
+	)
+	ap.add_argument(
+		'--headers-file', dest='headers-file', default=None,
+		help="File of concatenated 80-byte headers. Loaded if it exists, otherwise written from --blocks-dir."
+	)
+	ap.add_argument(
+		'--network', dest='network', default='mainnet', choices=sorted(NETWORK_PARAMS),
+		help="Network whose difficulty rules are checked."
+	)
+	ap.add_argument(
+		'--csv', dest='csv', default=None,
+		help="Write height, time, mediantime, interval, bits, difficulty and chainwork of every block to this file."
+	)
+	args = vars(ap.parse_args())
+	headers_file = args['headers-file']
+
+	if headers_file is not None and os.path.isfile(str(headers_file)):
+		headers = load_headers_from_file(str(headers_file))
+	elif args['blocks-dir'] is not None:
+		headers = load_headers_from_index(str(args['blocks-dir']))
+		if headers_file is not None:
+			save_headers(headers, str(headers_file))
+	else:
+		ap.error('either --blocks-dir or an existing --headers-file is required')
+	if len(headers) == 0:
+		print("No headers")
+		return
+
+	chainwork = get_chainwork(headers['bits'])
+	difficulties = get_difficulties(headers['bits'])
+	median_time_past = get_median_time_past(headers['timestamp'])
+	intervals = get_inter_block_times(headers['timestamp'])
+	retarget_valid = check_retargets(headers, str(args['network']))
+	timestamp_valid = check_timestamps(headers['timestamp'], median_time_past)
+
+	tip = len(headers) - 1
+	print(f"Height:                 {tip}")
+	print(f"Chainwork:              {get_chainwork_hex(chainwork, tip)}")
+	print(f"Difficulty:             {difficulties[tip]}")
+	print(f"Median time past:       {median_time_past[tip]}")
+	if tip > 0:
+		print(f"Inter-block time:       mean {intervals[1:].mean():.1f}s, median {numpy.median(intervals[1:]):.0f}s, "
+			f"{(intervals[1:] < 0).sum()} negative")
+	print(f"Invalid nBits:          {numpy.nonzero(~retarget_valid)[0].tolist()[:20]} ({(~retarget_valid).sum()} in total)")
+	print(f"Invalid timestamps:     {numpy.nonzero(~timestamp_valid)[0].tolist()[:20]} ({(~timestamp_valid).sum()} in total)")
+
+	if args['csv'] is not None:
+		with open(str(args['csv']), 'w') as f:
+			f.write('height,time,mediantime,interval,bits,difficulty,chainwork\n')
+			for height in range(len(headers)):
+				f.write(f"{height},{headers['timestamp'][height]},{median_time_past[height]},{intervals[height]},"
+					f"{headers['bits'][height]:08x},{difficulties[height]},{get_chainwork_hex(chainwork, height)}\n")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+
+from opcodes import *
+
+import collections
+import os
+import utils
+
+# Scripts and public keys repeat a lot across blocks: reused addresses pay to
+# the same scriptPubKey over and over, and the same public keys show up in the
+# inputs that spend them. Standard scriptPubKeys only differ in a hash or a
+# public key. While a ScriptInterner is active, block.py keeps
+#   - outputs of a standard template as (template id, payload), e.g. the
+#     PubkeyHash of a P2PKH script, and rebuilds the script on access,
+#   - one shared object per distinct payload, non-standard scriptPubKey and
+#     input pubkey (from the scriptSig or a P2WPKH witness) among the most
+#     recently seen ones.
+# scriptSigs themselves are not interned: their signatures make almost every
+# one of them unique, so they would only fill the cache and evict the values
+# that do repeat. Both caches are bounded and evict in least-recently-used
+# order, so long-running jobs that hold many decoded blocks stay within a
+# fixed overhead.
+
+TEMPLATES = (
+	TX_PUBKEYHASH, TX_SCRIPTHASH, TX_PUBKEY, TX_WITNESS_V0_KEYHASH,
+	TX_WITNESS_V0_SCRIPTHASH, TX_WITNESS_V1_TAPROOT
+)
+"""
+The script types that are rebuilt from their payload. The index of a type in
+this tuple is its template id.
+"""
+TEMPLATE_IDS = {script_type: i for i, script_type in enumerate(TEMPLATES)}
+
+# (bytes before, bytes after) the payload, by template id. The prefix of a
+# P2PK script is the length of its public key.
+TEMPLATE_AFFIXES = (
+	(bytes([OP_DUP, OP_HASH160, 20]), bytes([OP_EQUALVERIFY, OP_CHECKSIG])),
+	(bytes([OP_HASH160, 20]), bytes([OP_EQUAL])),
+	(None, bytes([OP_CHECKSIG])),
+	(bytes([OP_0, 20]), b''),
+	(bytes([OP_0, 32]), b''),
+	(bytes([OP_1, 32]), b''),
+)
+
+DEFAULT_MAX_SIZE = 1_000_000
+
+active_interner = None
+"""
+The ScriptInterner used by block.py while parsing, set by
+ScriptInterner.__enter__(). It is shared by every thread of the process.
+"""
+
+
+def expand_script_pubkey(template_id: int, payload: bytes) -> bytes:
+	"""
+	The reverse of ScriptInterner.compact_script_pubkey()
+	"""
+	prefix, suffix = TEMPLATE_AFFIXES[template_id]
+	if prefix is None:
+		prefix = bytes([len(payload)])
+	return prefix + payload + suffix
+
+
+class Interner:
+	"""
+	Map values (bytes or str) to one shared object per distinct value, for at
+	most max_size distinct values.
+	"""
+
+	def __init__(self, max_size: int):
+		self.max_size = max_size
+		self.values = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def intern(self, value):
+		canonical = self.values.get(value)
+		if canonical is not None:
+			self.values.move_to_end(value)
+			self.hits += 1
+			return canonical
+		self.misses += 1
+		self.values[value] = value
+		if len(self.values) > self.max_size:
+			self.values.popitem(last=False)
+			self.evictions += 1
+		return value
+
+
+class ScriptInterner:
+	"""
+	Deduplicate the scripts of the blocks parsed inside a with statement:
+
+		with interning.ScriptInterner():
+			block = Block(block_reader)
+
+	Blocks parsed this way stay valid after the with statement. An interner is
+	not thread-safe, so blocks must not be parsed by several threads at once
+	while it is active.
+	"""
+
+	def __init__(self, max_size: int = DEFAULT_MAX_SIZE, intern_inputs: bool = True):
+		self.payloads = Interner(max_size)
+		"""
+		Payloads of standard scriptPubKeys and pubkeys of inputs
+		"""
+		self.scripts = Interner(max_size)
+		"""
+		Non-standard scriptPubKeys
+		"""
+		self.intern_inputs = intern_inputs
+		"""
+		Whether the pubkeys of inputs are interned, or only outputs
+		"""
+		self.previous_interner = None
+
+	def __enter__(self):
+		global active_interner
+		self.previous_interner = active_interner
+		active_interner = self
+		return self
+
+	def __exit__(self, *args):
+		global active_interner
+		active_interner = self.previous_interner
+		self.previous_interner = None
+
+	def compact_script_pubkey(self, script: bytes):
+		"""
+		Return (template id, interned payload) of a standard scriptPubKey, or
+		(None, interned script) for any other script.
+		"""
+		script_type, payload = utils.classify_script_pubkey(script)
+		template_id = TEMPLATE_IDS.get(script_type)
+		if template_id is None:
+			return None, self.scripts.intern(script)
+		return template_id, self.payloads.intern(payload)
+
+	def intern_output(self, tx_output):
+		tx_output.template_id, tx_output.payload = self.compact_script_pubkey(tx_output.payload)
+
+	def intern_input(self, tx_input):
+		if self.intern_inputs and tx_input.pubkey is not None:
+			tx_input.pubkey = self.payloads.intern(tx_input.pubkey)
+
+	def intern_witness(self, tx_input):
+		# <signature> <pubkey> of a P2WPKH input
+		witness = tx_input.witness
+		if self.intern_inputs and len(witness) == 2 and len(witness[1]) == 33:
+			witness[1] = self.payloads.intern(witness[1])
+
+	def get_stats(self) -> dict:
+		stats = {}
+		for name, interner in (('payloads', self.payloads), ('scripts', self.scripts)):
+			stats[name] = {
+				'size': len(interner.values), 'hits': interner.hits,
+				'misses': interner.misses, 'evictions': interner.evictions
+			}
+		return stats
+
+
+def load_blocks(blocks_dir: str, file_count: int) -> list:
+	# Not imported at the top: block.py imports this module
+	import scan
+
+	blocks = []
+	for file_name in scan.list_block_files(blocks_dir)[:file_count]:
+		with open(os.path.join(blocks_dir, file_name), 'rb') as block_reader:
+			blocks.extend(block for _, block in scan.iterate_blocks(block_reader))
+	return blocks
+
+
+def measure(blocks_dir: str, file_count: int, interner: ScriptInterner):
+	"""
+	Return (block count, bytes allocated, seconds) to parse and hold the
+	blocks of the first file_count files, with or without interner.
+	"""
+	# Imported here, like argparse in main(), so that importing block.py (and
+	# so this module) stays cheap
+	import time
+	import tracemalloc
+
+	tracemalloc.start()
+	start = time.perf_counter()
+	if interner is None:
+		blocks = load_blocks(blocks_dir, file_count)
+	else:
+		with interner:
+			blocks = load_blocks(blocks_dir, file_count)
+	elapsed = time.perf_counter() - start
+	size, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return len(blocks), size, elapsed
+
+
+def main():
+	import argparse
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument(
+		'--blocks-dir', dest='blocks-dir', required=True,
+		help="The blocks/ directory as managed by Bitcoin Core."
+	)
+	ap.add_argument(
+		'--file-count', dest='file-count', default=1,
+		help="Number of blk*.dat files whose blocks are held in memory."
+	)
+	ap.add_argument(
+		'--max-size', dest='max-size', default=DEFAULT_MAX_SIZE,
+		help="Maximum number of distinct payloads and scripts that are interned."
+	)
+	args = vars(ap.parse_args())
+	blocks_dir = str(args['blocks-dir'])
+	file_count = int(args['file-count'])
+
+	if os.path.isdir(blocks_dir) is False:
+		raise FileNotFoundError(f"[{blocks_dir}] does not exist")
+	max_size = int(args['max-size'])
+	interner = ScriptInterner(max_size)
+	configurations = (
+		('Plain', None), ('Outputs', ScriptInterner(max_size, intern_inputs=False)),
+		('Outputs + input pubkeys', interner)
+	)
+	for name, current_interner in configurations:
+		block_count, size, elapsed = measure(blocks_dir, file_count, current_interner)
+		print(f"{name + ':':<25}{block_count} blocks hold {size / 1e6:.1f} MB (parsed in {elapsed:.2f} seconds)")
+	for name, stats in interner.get_stats().items():
+		print(f"{name + ':':<25}{stats['size']} interned, {stats['hits']} hits, "
+			f"{stats['misses']} misses, {stats['evictions']} evictions")
+
+
+if __name__ == '__main__':
+	# block.py reads active_interner from the module named interning, which is
+	# not this one while the file runs as __main__
+	import interning
+	interning.main()
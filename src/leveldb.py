@@ -0,0 +1,412 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+
+# A minimal, read-only and pure-Python reader of LevelDB databases, such as
+# blocks/index/ and indexes/txindex/ as managed by Bitcoin Core. We do not use
+# the LevelDB library itself because it refuses to open a database locked by
+# a running bitcoind.
+# The on-disk format is documented in
+# https://github.com/google/leveldb/blob/main/doc/table_format.md and
+# https://github.com/google/leveldb/blob/main/doc/log_format.md
+
+TABLE_MAGIC_NUMBER = 0xdb4775248b80fb57
+TABLE_FOOTER_SIZE = 48
+LOG_BLOCK_SIZE = 32768
+LOG_HEADER_SIZE = 7
+
+LOG_FULL_TYPE = 1
+LOG_FIRST_TYPE = 2
+LOG_MIDDLE_TYPE = 3
+LOG_LAST_TYPE = 4
+
+TYPE_DELETION = 0
+TYPE_VALUE = 1
+
+NO_COMPRESSION = 0
+SNAPPY_COMPRESSION = 1
+
+# Tags of the fields of a VersionEdit record in a MANIFEST file
+MANIFEST_COMPARATOR = 1
+MANIFEST_LOG_NUMBER = 2
+MANIFEST_NEXT_FILE_NUMBER = 3
+MANIFEST_LAST_SEQUENCE = 4
+MANIFEST_COMPACT_POINTER = 5
+MANIFEST_DELETED_FILE = 6
+MANIFEST_NEW_FILE = 7
+MANIFEST_PREV_LOG_NUMBER = 9
+
+uint32_struct = struct.Struct('<I')
+uint64_struct = struct.Struct('<Q')
+
+
+def read_varint(data: bytes, pos: int):
+	"""
+	Read a LevelDB varint (i.e., little-endian base-128, the least significant
+	group first). Note that this is NOT the same as Bitcoin's CompactSize nor
+	Bitcoin Core's own VARINT. Return the value and the position after it.
+	"""
+	result = 0
+	shift = 0
+	while True:
+		byte = data[pos]
+		pos += 1
+		result |= (byte & 0x7f) << shift
+		if byte < 0x80:
+			return result, pos
+		shift += 7
+
+
+def read_length_prefixed(data: bytes, pos: int):
+	length, pos = read_varint(data, pos)
+	return bytes(data[pos:pos + length]), pos + length
+
+
+def iterate_block_entries(block: bytes, pos: int = 0):
+	"""
+	Yield (key, value) pairs of a table block, starting from pos which must be
+	0 or a restart point. Keys are prefix-compressed: every entry only stores
+	the bytes that differ from the previous key, except at restart points.
+	"""
+	restart_count = uint32_struct.unpack_from(block, len(block) - 4)[0]
+	limit = len(block) - 4 - 4 * restart_count
+	key = b''
+	while pos < limit:
+		shared, pos = read_varint(block, pos)
+		non_shared, pos = read_varint(block, pos)
+		value_length, pos = read_varint(block, pos)
+		key = key[:shared] + bytes(block[pos:pos + non_shared])
+		pos += non_shared
+		yield key, bytes(block[pos:pos + value_length])
+		pos += value_length
+
+
+def find_restart_point(block: bytes, user_key: bytes) -> int:
+	"""
+	Binary search the restart points of a table block (whose keys are internal
+	keys) and return the last one whose user key is smaller than user_key, so
+	that scanning from there finds every entry of user_key.
+	"""
+	restart_count = uint32_struct.unpack_from(block, len(block) - 4)[0]
+	restarts = len(block) - 4 - 4 * restart_count
+	low, high = 0, restart_count - 1
+	while low < high:
+		middle = (low + high + 1) // 2
+		pos = uint32_struct.unpack_from(block, restarts + 4 * middle)[0]
+		_, pos = read_varint(block, pos)  # shared, always 0 at a restart point
+		non_shared, pos = read_varint(block, pos)
+		_, pos = read_varint(block, pos)
+		if bytes(block[pos:pos + non_shared - 8]) < user_key:
+			low = middle
+		else:
+			high = middle - 1
+	return uint32_struct.unpack_from(block, restarts + 4 * low)[0]
+
+
+def read_table_block(data: bytes, handle: bytes):
+	offset, pos = read_varint(handle, 0)
+	size, pos = read_varint(handle, pos)
+	# Every block is followed by a 1-byte compression type and a 4-byte CRC
+	compression = data[offset + size]
+	block = data[offset:offset + size]
+	if compression == NO_COMPRESSION:
+		return block
+	if compression == SNAPPY_COMPRESSION:
+		# Bitcoin Core disables compression, so python-snappy is only needed
+		# for databases written by other programs.
+		import snappy
+		return snappy.decompress(bytes(block))
+	raise ValueError(f'Unknown compression type {compression}')
+
+
+def split_internal_key(internal_key: bytes):
+	"""
+	An internal key is the user key followed by 8 bytes of
+	(sequence number << 8 | value type). Return (user_key, sequence, type).
+	"""
+	tag = uint64_struct.unpack_from(internal_key, len(internal_key) - 8)[0]
+	return internal_key[:-8], tag >> 8, tag & 0xff
+
+
+def read_index_block(data, path: str):
+	"""
+	Return the index block of a table file, i.e., one entry per data block whose
+	key is >= every key of that block and whose value is the block's handle.
+	"""
+	if len(data) < TABLE_FOOTER_SIZE:
+		raise ValueError(f'[{path}] is too short to be a table file')
+	footer = data[-TABLE_FOOTER_SIZE:]
+	if uint64_struct.unpack_from(footer, 40)[0] != TABLE_MAGIC_NUMBER:
+		raise ValueError(f'[{path}] does not look like a table file')
+	# The footer starts with the handle of the metaindex block, which we do not
+	# need, and then the handle of the index block.
+	_, pos = read_varint(footer, 0)
+	_, pos = read_varint(footer, pos)
+	index_handle = footer[pos:]
+	return read_table_block(data, index_handle)
+
+
+def iterate_table(path: str):
+	"""
+	Yield (user_key, sequence, type, value) of every entry of a .ldb/.sst file.
+	"""
+	with open(path, 'rb') as f:
+		data = f.read()
+	for _, data_handle in iterate_block_entries(read_index_block(data, path)):
+		for internal_key, value in iterate_block_entries(read_table_block(data, data_handle)):
+			user_key, sequence, value_type = split_internal_key(internal_key)
+			yield user_key, sequence, value_type, value
+
+
+class Table:
+	"""
+	A .ldb/.sst file opened for point lookups. The file is mmap-ed and only its
+	index block is decoded up front, so a lookup reads a single data block.
+	"""
+
+	def __init__(self, path: str):
+		with open(path, 'rb') as f:
+			self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self.index_keys = []
+		self.handles = []
+		for separator, handle in iterate_block_entries(read_index_block(self.data, path)):
+			self.index_keys.append(split_internal_key(separator)[0])
+			self.handles.append(handle)
+
+	def close(self):
+		self.data.close()
+
+	def get(self, key: bytes):
+		"""
+		Return (sequence, type, value) of the newest entry of key, or None.
+		"""
+		found = None
+		i = bisect.bisect_left(self.index_keys, key)
+		while i < len(self.handles):
+			block = read_table_block(self.data, self.handles[i])
+			for internal_key, value in iterate_block_entries(block, find_restart_point(block, key)):
+				user_key, sequence, value_type = split_internal_key(internal_key)
+				if user_key > key:
+					return found
+				if user_key == key and (found is None or found[0] < sequence):
+					found = (sequence, value_type, value)
+			# Entries of the same key (with different sequence numbers) can
+			# continue in the next block.
+			i += 1
+		return found
+
+
+def iterate_log_records(path: str):
+	"""
+	Yield the payload of every record of a log file (i.e., a .log write-ahead
+	log or a MANIFEST file). A record can be fragmented across 32KB blocks.
+	"""
+	with open(path, 'rb') as f:
+		data = f.read()
+	pos = 0
+	fragments = []
+	while pos + LOG_HEADER_SIZE <= len(data):
+		remaining_in_block = LOG_BLOCK_SIZE - pos % LOG_BLOCK_SIZE
+		if remaining_in_block < LOG_HEADER_SIZE:
+			# The trailer of a block is zero-padded if it cannot hold a header
+			pos += remaining_in_block
+			continue
+		length = data[pos + 4] | (data[pos + 5] << 8)
+		record_type = data[pos + 6]
+		if record_type == 0 and length == 0:
+			# Zero-filled preallocated space, skip the rest of the block
+			pos += remaining_in_block
+			continue
+		payload = data[pos + LOG_HEADER_SIZE:pos + LOG_HEADER_SIZE + length]
+		pos += LOG_HEADER_SIZE + length
+		if len(payload) < length:
+			# The last record is incomplete if the writer crashed
+			break
+		if record_type == LOG_FULL_TYPE:
+			fragments = []
+			yield payload
+		elif record_type == LOG_FIRST_TYPE:
+			fragments = [payload]
+		elif record_type == LOG_MIDDLE_TYPE:
+			fragments.append(payload)
+		elif record_type == LOG_LAST_TYPE:
+			fragments.append(payload)
+			yield b''.join(fragments)
+			fragments = []
+		else:
+			raise ValueError(f'Unknown log record type {record_type} in [{path}]')
+
+
+def iterate_write_batches(path: str):
+	"""
+	Yield (user_key, sequence, type, value) of every operation of a .log file.
+	A WriteBatch is a 8-byte sequence number, a 4-byte count and then the
+	operations, each of them takes the next sequence number.
+	"""
+	for batch in iterate_log_records(path):
+		sequence = uint64_struct.unpack_from(batch, 0)[0]
+		count = uint32_struct.unpack_from(batch, 8)[0]
+		pos = 12
+		for i in range(count):
+			value_type = batch[pos]
+			key, pos = read_length_prefixed(batch, pos + 1)
+			value = None
+			if value_type == TYPE_VALUE:
+				value, pos = read_length_prefixed(batch, pos)
+			yield key, sequence + i, value_type, value
+
+
+def read_manifest(path: str):
+	"""
+	Replay the VersionEdit records of a MANIFEST file and return a dict of live
+	table file number -> (smallest user key, largest user key), and the number
+	of the oldest live log file.
+	"""
+	table_ranges = {}
+	log_number = 0
+	for record in iterate_log_records(path):
+		pos = 0
+		while pos < len(record):
+			tag, pos = read_varint(record, pos)
+			if tag == MANIFEST_COMPARATOR:
+				_, pos = read_length_prefixed(record, pos)
+			elif tag == MANIFEST_LOG_NUMBER:
+				log_number, pos = read_varint(record, pos)
+			elif tag in (MANIFEST_NEXT_FILE_NUMBER, MANIFEST_LAST_SEQUENCE,
+				MANIFEST_PREV_LOG_NUMBER):
+				_, pos = read_varint(record, pos)
+			elif tag == MANIFEST_COMPACT_POINTER:
+				_, pos = read_varint(record, pos)
+				_, pos = read_length_prefixed(record, pos)
+			elif tag == MANIFEST_DELETED_FILE:
+				_, pos = read_varint(record, pos)
+				number, pos = read_varint(record, pos)
+				table_ranges.pop(number, None)
+			elif tag == MANIFEST_NEW_FILE:
+				_, pos = read_varint(record, pos)
+				number, pos = read_varint(record, pos)
+				_, pos = read_varint(record, pos)
+				smallest, pos = read_length_prefixed(record, pos)
+				largest, pos = read_length_prefixed(record, pos)
+				table_ranges[number] = (smallest[:-8], largest[:-8])
+			else:
+				raise ValueError(f'Unknown MANIFEST tag {tag} in [{path}]')
+	return table_ranges, log_number
+
+
+class LevelDBReader:
+	"""
+	Read the live content of a LevelDB directory, i.e., the tables listed in
+	the current MANIFEST plus the write-ahead logs not yet compacted into
+	tables. If the same key appears more than once, the entry with the highest
+	sequence number wins, exactly as LevelDB itself resolves it.
+	"""
+
+	def __init__(self, db_dir: str):
+		if os.path.isdir(db_dir) is False:
+			raise FileNotFoundError(f"[{db_dir}] does not exist")
+		self.db_dir = db_dir
+		self.lock = threading.Lock()
+		self.snapshot = None
+		"""
+		(live tables, open Table objects, entries of the logs) for get()
+		"""
+
+	def list_live_files(self):
+		with open(os.path.join(self.db_dir, 'CURRENT'), 'r') as f:
+			manifest_name = f.read().strip()
+		table_ranges, log_number = read_manifest(os.path.join(self.db_dir, manifest_name))
+		tables = {}
+		"""
+		File name -> (smallest user key, largest user key)
+		"""
+		logs = []
+		for file_name in os.listdir(self.db_dir):
+			stem, ext = os.path.splitext(file_name)
+			if stem.isdigit() is False:
+				continue
+			if ext in ('.ldb', '.sst') and int(stem) in table_ranges:
+				tables[file_name] = table_ranges[int(stem)]
+			elif ext == '.log' and int(stem) >= log_number:
+				logs.append(file_name)
+		return tables, sorted(logs)
+
+	def items(self, prefix: bytes = b''):
+		"""
+		Return a dict of user_key -> value of every live key starting with prefix.
+		"""
+		latest = {}
+		tables, logs = self.list_live_files()
+		sources = [iterate_table(os.path.join(self.db_dir, f)) for f in sorted(tables)]
+		sources += [iterate_write_batches(os.path.join(self.db_dir, f)) for f in logs]
+		for source in sources:
+			for key, sequence, value_type, value in source:
+				if key.startswith(prefix) is False:
+					continue
+				if key not in latest or latest[key][0] < sequence:
+					latest[key] = (sequence, value_type, value)
+		return {
+			key: value for key, (_, value_type, value) in latest.items()
+			if value_type == TYPE_VALUE
+		}
+
+	def reload(self):
+		"""
+		Forget the live files seen by get(), e.g. after a running bitcoind has
+		compacted the database. The tables of the old snapshot are not closed:
+		other threads may still be reading them through the snapshot they got
+		before. Their maps are unmapped once the last reference is released.
+		"""
+		with self.lock:
+			self.snapshot = None
+
+	def get_snapshot(self):
+		with self.lock:
+			if self.snapshot is None:
+				tables, logs = self.list_live_files()
+				log_entries = {}
+				for f in logs:
+					for key, sequence, value_type, value in iterate_write_batches(os.path.join(self.db_dir, f)):
+						if key not in log_entries or log_entries[key][0] < sequence:
+							log_entries[key] = (sequence, value_type, value)
+				self.snapshot = (tables, {}, log_entries)
+			return self.snapshot
+
+	def get_table(self, snapshot, file_name: str) -> Table:
+		_, open_tables, _ = snapshot
+		with self.lock:
+			if file_name not in open_tables:
+				open_tables[file_name] = Table(os.path.join(self.db_dir, file_name))
+			return open_tables[file_name]
+
+	def get(self, key: bytes):
+		"""
+		Return the value of key, or None if it does not exist. Unlike items(),
+		only the tables whose key range covers key are searched, so a lookup
+		does not depend on the size of the database. The live files are listed
+		once; if one of them has been deleted since, they are listed again.
+		"""
+		for attempt in range(2):
+			try:
+				return self.get_from_snapshot(key)
+			except FileNotFoundError:
+				if attempt == 1:
+					raise
+				self.reload()
+
+	def get_from_snapshot(self, key: bytes):
+		# Tables are opened in this snapshot even if reload() replaces it meanwhile
+		snapshot = self.get_snapshot()
+		tables, _, log_entries = snapshot
+		found = log_entries.get(key)
+		for file_name, (smallest, largest) in tables.items():
+			if key < smallest or key > largest:
+				continue
+			entry = self.get_table(snapshot, file_name).get(key)
+			if entry is not None and (found is None or found[0] < entry[0]):
+				found = entry
+		if found is None or found[1] != TYPE_VALUE:
+			return None
+		return found[2]
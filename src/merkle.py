@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+import argparse
+import utils
+
+# Merkle trees of blocks and SPV proofs in the format of Bitcoin Core's
+# gettxoutproof/verifytxoutproof RPCs, i.e., a serialized CMerkleBlock:
+#   block header (80 bytes) | transaction count (4 bytes) |
+#   hashes (CompactSize count + 32 bytes each) | flag bits (CompactSize count + bytes)
+# as implemented in Bitcoin Core's src/merkleblock.cpp.
+# All hashes are in raw (i.e. little-endian) order unless stated otherwise.
+
+HASH_SIZE = 32
+
+
+class MerkleTree:
+	"""
+	Every level of a block's merkle tree, from the txids (level 0) up to the
+	root, kept in one contiguous bytearray. Once a tree is built, a merkle
+	branch or partial merkle tree for any transaction costs O(log n) lookups
+	instead of rebuilding the tree.
+	"""
+
+	def __init__(self, txids: list):
+		self.leaf_count = len(txids)
+		self.level_offsets = []
+		"""
+		(offset in self.buffer, number of hashes) of each level
+		"""
+		self.buffer = bytearray(b''.join(txids))
+		self.level_offsets.append((0, self.leaf_count))
+		offset, count = 0, self.leaf_count
+		while count > 1:
+			next_offset = len(self.buffer)
+			for pos in range(0, count, 2):
+				left = self.buffer[offset + pos * HASH_SIZE:offset + (pos + 1) * HASH_SIZE]
+				if pos + 1 < count:
+					right = self.buffer[offset + (pos + 1) * HASH_SIZE:offset + (pos + 2) * HASH_SIZE]
+				else:
+					# An odd number of hashes: the last one is paired with itself
+					right = left
+				self.buffer += utils.double_sha256(bytes(left + right))
+			offset, count = next_offset, (count + 1) // 2
+			self.level_offsets.append((offset, count))
+
+	def get_height(self) -> int:
+		"""
+		Level of the root, 0 if the block has only the coinbase transaction.
+		"""
+		return len(self.level_offsets) - 1
+
+	def get_width(self, level: int) -> int:
+		return self.level_offsets[level][1]
+
+	def get_hash(self, level: int, pos: int) -> bytes:
+		offset = self.level_offsets[level][0] + pos * HASH_SIZE
+		return bytes(self.buffer[offset:offset + HASH_SIZE])
+
+	def get_root(self) -> bytes:
+		if self.leaf_count == 0:
+			return None
+		return self.get_hash(self.get_height(), 0)
+
+	def get_branch(self, index: int) -> list:
+		"""
+		Return the sibling hashes from the leaf at index up to the root, i.e.,
+		the hashes needed to recompute the root from the txid alone.
+		"""
+		branch = []
+		for level in range(self.get_height()):
+			sibling = index ^ 1
+			if sibling >= self.get_width(level):
+				sibling = index
+			branch.append(self.get_hash(level, sibling))
+			index //= 2
+		return branch
+
+	def get_partial_tree(self, matches: list):
+		"""
+		Build a CPartialMerkleTree: return (hashes, bits) for the transactions
+		whose matches[i] is True, following TraverseAndBuild() in Bitcoin Core.
+		"""
+		# prefix[i] is the number of matches before leaf i, so that whether a
+		# subtree contains any match is an O(1) check.
+		prefix = [0]
+		for match in matches:
+			prefix.append(prefix[-1] + (1 if match else 0))
+		hashes = []
+		bits = []
+
+		def traverse(level: int, pos: int):
+			first = pos << level
+			last = min((pos + 1) << level, self.leaf_count)
+			is_parent_of_match = prefix[last] - prefix[first] > 0
+			bits.append(is_parent_of_match)
+			if level == 0 or is_parent_of_match is False:
+				hashes.append(self.get_hash(level, pos))
+				return
+			traverse(level - 1, pos * 2)
+			if pos * 2 + 1 < self.get_width(level - 1):
+				traverse(level - 1, pos * 2 + 1)
+
+		traverse(self.get_height(), 0)
+		return hashes, bits
+
+
+def get_root(txids: list) -> bytes:
+	"""
+	The merkle root of txids, without keeping the inner levels as MerkleTree
+	does. None if txids is empty.
+	"""
+	if len(txids) == 0:
+		return None
+	level = txids
+	while len(level) > 1:
+		if len(level) % 2 == 1:
+			level = level + [level[-1]]
+		level = [utils.double_sha256(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+	return level[0]
+
+
+def get_root_from_branch(txid: bytes, index: int, branch: list) -> bytes:
+	"""
+	The reverse of MerkleTree.get_branch(): recompute the root from a txid, its
+	position in the block and its branch.
+	"""
+	current = txid
+	for sibling in branch:
+		if index & 1:
+			current = utils.double_sha256(sibling + current)
+		else:
+			current = utils.double_sha256(current + sibling)
+		index //= 2
+	return current
+
+
+def serialize_tx_out_proof(header: bytes, transaction_count: int, hashes: list, bits: list) -> bytes:
+	flag_bytes = bytearray((len(bits) + 7) // 8)
+	for i, bit in enumerate(bits):
+		if bit:
+			flag_bytes[i // 8] |= 1 << (i % 8)
+	return (header + utils.uint32_struct.pack(transaction_count) +
+		utils.get_bytes_from_variable_int(len(hashes)) + b''.join(hashes) +
+		utils.get_bytes_from_variable_int(len(flag_bytes)) + bytes(flag_bytes))
+
+
+def verify_tx_out_proof(proof: bytes) -> list:
+	"""
+	Return the raw txids proven by a gettxoutproof proof. Raise ValueError if
+	the proof is malformed or does not commit to its header's merkle root, like
+	TraverseAndExtract() in Bitcoin Core. The header's proof of work is NOT
+	checked here.
+	"""
+	header = proof[:80]
+	hash_merkle_root = utils.block_header_struct.unpack_from(header)[2]
+	transaction_count = utils.uint32_struct.unpack_from(proof, 80)[0]
+	hash_count, pos = utils.unpack_variable_int_from(proof, 84)
+	hashes = [proof[pos + i * HASH_SIZE:pos + (i + 1) * HASH_SIZE] for i in range(hash_count)]
+	pos += hash_count * HASH_SIZE
+	flag_byte_count, pos = utils.unpack_variable_int_from(proof, pos)
+	flag_bytes = proof[pos:pos + flag_byte_count]
+	bits = [(flag_bytes[i // 8] >> (i % 8)) & 1 == 1 for i in range(flag_byte_count * 8)]
+	if transaction_count == 0 or hash_count > transaction_count or len(bits) < hash_count:
+		raise ValueError('Malformed proof')
+
+	height = 0
+	while (transaction_count + (1 << height) - 1) >> height > 1:
+		height += 1
+	matched = []
+	cursor = {'bit': 0, 'hash': 0}
+
+	def get_width(level: int) -> int:
+		return (transaction_count + (1 << level) - 1) >> level
+
+	def traverse(level: int, pos: int) -> bytes:
+		if cursor['bit'] >= len(bits):
+			raise ValueError('Proof runs out of flag bits')
+		is_parent_of_match = bits[cursor['bit']]
+		cursor['bit'] += 1
+		if level == 0 or is_parent_of_match is False:
+			if cursor['hash'] >= len(hashes):
+				raise ValueError('Proof runs out of hashes')
+			result = hashes[cursor['hash']]
+			cursor['hash'] += 1
+			if level == 0 and is_parent_of_match:
+				matched.append(result)
+			return result
+		left = traverse(level - 1, pos * 2)
+		right = left
+		if pos * 2 + 1 < get_width(level - 1):
+			right = traverse(level - 1, pos * 2 + 1)
+			if right == left:
+				# CVE-2012-2459: a duplicated hash would make two trees share a root
+				raise ValueError('Proof contains identical left and right hashes')
+		return utils.double_sha256(left + right)
+
+	root = traverse(height, 0)
+	if cursor['hash'] != len(hashes) or (cursor['bit'] + 7) // 8 != flag_byte_count:
+		raise ValueError('Proof has unused hashes or flag bits')
+	if root != hash_merkle_root:
+		raise ValueError('Proof does not match the merkle root of its header')
+	return matched
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument(
+		'--blocks-dir', dest='blocks-dir', default=None,
+		help="The blocks/ directory as managed by Bitcoin Core."
+	)
+	ap.add_argument('--height', dest='height', default=None, help="Height of the block containing --txid.")
+	ap.add_argument(
+		'--txid', dest='txid', action='append', default=[],
+		help="Print the proof (as gettxoutproof does) for this txid, can be repeated."
+	)
+	ap.add_argument(
+		'--verify', dest='verify', default=None,
+		help="Verify a proof in hex and print the txids it proves, as verifytxoutproof does."
+	)
+	args = vars(ap.parse_args())
+
+	if args['verify'] is not None:
+		for txid in verify_tx_out_proof(bytes.fromhex(str(args['verify']))):
+			print(utils.convert_endianness(txid).hex())
+		return
+	if args['blocks-dir'] is None or args['height'] is None or len(args['txid']) == 0:
+		ap.error('--blocks-dir, --height and --txid are required unless --verify is given')
+
+	from blockindex import BlockIndex
+
+	block_index = BlockIndex(str(args['blocks-dir']))
+	block = block_index.read_block(block_index.get_by_height(int(args['height'])))
+	print(block.get_tx_out_proof(args['txid']).hex())
+
+
+if __name__ == '__main__':
+	main()
@@ -10,6 +10,11 @@ TX_PUBKEY      = 'pubkey'
 TX_PUBKEYHASH  = 'pubkey-hash'
 TX_SCRIPTHASH  = 'script-hash'
 TX_MULTISIG    = 'multi-sig'
+TX_NULLDATA    = 'null-data'
+TX_WITNESS_V0_KEYHASH    = 'witness-v0-keyhash'
+TX_WITNESS_V0_SCRIPTHASH = 'witness-v0-scripthash'
+TX_WITNESS_V1_TAPROOT    = 'witness-v1-taproot'
+TX_WITNESS_UNKNOWN       = 'witness-unknown'
 
 # ===----------------------------------------------------------------------===
 
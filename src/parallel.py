@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+
+from cache import BlockRecord, record_prefix_struct
+from multiprocessing import resource_tracker, shared_memory
+
+import argparse
+import multiprocessing
+import os
+import scan
+import time
+import utils
+
+# Parse blk*.dat files in worker processes without pickling decoded blocks.
+# Each worker encodes the blocks of one file as BlockRecords (see cache.py)
+# into shared memory "arenas", in the same layout as a cache file:
+#   record length (4 bytes) | block offset (8 bytes) | BlockRecord
+# Only the arenas' names and sizes travel back through the Pool. The parent
+# maps the arenas and decodes records straight from the shared buffers, then
+# releases them. Decoded BlockRecords are ordinary objects, no view of shared
+# memory outlives its arena.
+
+DEFAULT_ARENA_SIZE = 32 * 1024 * 1024
+DEFAULT_MAX_ARENAS_IN_FLIGHT = 2
+"""
+Per worker process. A worker waits before it parses another file once this
+many files of results have not been consumed yet, which bounds memory usage.
+"""
+
+arena_slots = None
+"""
+The worker processes' handle of the semaphore shared with the parent, set by
+init_worker().
+"""
+
+
+def init_worker(slots):
+	global arena_slots
+	arena_slots = slots
+
+
+class ArenaWriter:
+	"""
+	Append records to a list of shared memory segments of arena_size bytes, or
+	larger for a record that does not fit in one.
+	"""
+
+	def __init__(self, arena_size: int):
+		self.arena_size = arena_size
+		self.arenas = []
+		"""
+		(name, used bytes, record count) of every segment written so far
+		"""
+		self.current = None
+		self.used = 0
+		self.count = 0
+
+	def append(self, offset: int, record_bytes: bytes):
+		size = record_prefix_struct.size + len(record_bytes)
+		if self.current is None or self.used + size > self.current.size:
+			self.seal()
+			self.current = shared_memory.SharedMemory(create=True, size=max(self.arena_size, size))
+		record_prefix_struct.pack_into(self.current.buf, self.used, len(record_bytes), offset)
+		self.current.buf[self.used + record_prefix_struct.size:self.used + size] = record_bytes
+		self.used += size
+		self.count += 1
+
+	def seal(self):
+		"""
+		Stop writing the current segment. The segment stays alive after close(),
+		it is the reader that unlinks it.
+		"""
+		if self.current is not None:
+			self.arenas.append((self.current.name, self.used, self.count))
+			self.current.close()
+		self.current = None
+		self.used = 0
+		self.count = 0
+
+
+def parse_file_into_arenas(task: tuple):
+	"""
+	Worker: parse one blk*.dat file and return (file name, arenas), where arenas
+	is a list of (shared memory name, used bytes, record count).
+	"""
+	blocks_dir, file_name, arena_size, magic_numbers = task
+	arena_slots.acquire()
+	writer = ArenaWriter(arena_size)
+	try:
+		with open(os.path.join(blocks_dir, file_name), 'rb') as block_reader:
+			for offset, block in scan.iterate_blocks(block_reader, 0, magic_numbers):
+				writer.append(offset, BlockRecord.from_block(block, offset).to_bytes())
+		writer.seal()
+	except BaseException:
+		writer.seal()
+		release_arenas(writer.arenas)
+		arena_slots.release()
+		raise
+	return file_name, writer.arenas
+
+
+def release_arenas(arenas: list):
+	for name, _, _ in arenas:
+		segment = shared_memory.SharedMemory(name=name)
+		segment.close()
+		segment.unlink()
+
+
+def iterate_arena(buffer, used: int):
+	"""
+	Yield (block offset, memoryview of a BlockRecord) of every record of an
+	arena. The views point into shared memory and are only valid until the
+	arena is released.
+	"""
+	pos = 0
+	while pos < used:
+		length, offset = record_prefix_struct.unpack_from(buffer, pos)
+		pos += record_prefix_struct.size
+		yield offset, buffer[pos:pos + length]
+		pos += length
+
+
+def iterate_records_in_parallel(blocks_dir: str, processes: int = None, arena_size: int = DEFAULT_ARENA_SIZE,
+	magic_numbers=utils.NETWORK_MAGICS, max_arenas_in_flight: int = DEFAULT_MAX_ARENAS_IN_FLIGHT):
+	"""
+	Yield (file name, BlockRecord) of every block in blocks_dir, parsed by a
+	pool of processes. Blocks of a file are yielded in file order, but files
+	are yielded in the order in which workers finish them. If the caller stops
+	early, segments of files still being parsed are left to the
+	multiprocessing resource tracker, which removes them at exit.
+	"""
+	processes = processes or os.cpu_count()
+	slots = multiprocessing.BoundedSemaphore(processes * max_arenas_in_flight)
+	# Workers must share the parent's resource tracker: segments are registered
+	# by the worker that creates them and unregistered by the parent that
+	# unlinks them. Otherwise every worker would start its own tracker, which
+	# would report and try to remove the segments already unlinked by the parent.
+	resource_tracker.ensure_running()
+	tasks = [(blocks_dir, file_name, arena_size, magic_numbers) for file_name in scan.list_block_files(blocks_dir)]
+	with multiprocessing.Pool(processes, initializer=init_worker, initargs=(slots,)) as pool:
+		# Unordered, so that a finished file never waits behind a slow one while
+		# holding a slot, which could otherwise leave every worker blocked.
+		for file_name, arenas in pool.imap_unordered(parse_file_into_arenas, tasks):
+			try:
+				while len(arenas) > 0:
+					name, used, _ = arenas[0]
+					segment = shared_memory.SharedMemory(name=name)
+					try:
+						for offset, view in iterate_arena(segment.buf, used):
+							record = BlockRecord.from_bytes(view, offset)
+							# Released before yielding, so that the segment can always be closed
+							view.release()
+							yield file_name, record
+					finally:
+						segment.close()
+						segment.unlink()
+						arenas.pop(0)
+			finally:
+				release_arenas(arenas)
+				slots.release()
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument(
+		'--blocks-dir', dest='blocks-dir', required=True,
+		help="The blocks/ directory as managed by Bitcoin Core."
+	)
+	ap.add_argument(
+		'--processes', dest='processes', default=os.cpu_count(),
+		help="Number of worker processes."
+	)
+	ap.add_argument(
+		'--arena-size', dest='arena-size', default=DEFAULT_ARENA_SIZE,
+		help="Size in bytes of the shared memory segments that carry results to the parent."
+	)
+	args = vars(ap.parse_args())
+	blocks_dir = str(args['blocks-dir'])
+
+	if os.path.isdir(blocks_dir) is False:
+		raise FileNotFoundError(f"[{blocks_dir}] does not exist")
+	start = time.perf_counter()
+	block_count = 0
+	transaction_count = 0
+	for _, record in iterate_records_in_parallel(blocks_dir, int(args['processes']), int(args['arena-size'])):
+		block_count += 1
+		transaction_count += len(record.transactions)
+	print(f"Parsed {block_count} blocks ({transaction_count} transactions) "
+		f"in {time.perf_counter() - start:.2f} seconds")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,625 @@
+#!/usr/bin/python3
+
+from block import Block, Transaction, WITNESS_SCALE_FACTOR
+from blockindex import BlockIndex, BlockIndexEntry
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from leveldb import LevelDBReader
+from opcodes import *
+
+import argparse
+import collections
+import http.client
+import inspect
+import io
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import utils
+
+# A read-only JSON-RPC server that answers a subset of Bitcoin Core's RPCs
+# straight from blk*.dat files: getblockcount, getbestblockhash,
+# getblockhash, getblockheader, getblock, getrawtransaction and
+# gettxoutproof. Blocks are located through the block index (blocks/index/)
+# and transactions through Bitcoin Core's txindex (indexes/txindex/, only
+# exists with -txindex=1), whose values are CDiskTxPos:
+#   file number (VARINT) | block position (VARINT) | offset after the header (VARINT)
+# Requests and responses follow bitcoind's JSON-RPC 1.0/2.0 conventions, so
+# existing clients (e.g., bitcoin-cli -rpcconnect -rpcport) can be pointed at it.
+# Scripts are returned in hex only, there is no "asm" field.
+
+TXINDEX_PREFIX = b't'
+DEFAULT_PORT = 8339
+DEFAULT_CACHE_SIZE = 64
+REFRESH_INTERVAL = 10
+"""
+Minimum number of seconds between two reloads of the block index, which are
+triggered by requests for blocks that are not (yet) known.
+"""
+REFRESH_WAIT = 1
+"""
+Maximum number of seconds a request waits for a reload of the block index.
+A slower reload goes on in a background thread, so that requests for unknown
+(e.g. bogus) hashes cannot stall the server.
+"""
+MEDIAN_TIME_SPAN = 11
+
+# Error codes as defined in Bitcoin Core's src/rpc/protocol.h
+RPC_INVALID_REQUEST = -32600
+RPC_METHOD_NOT_FOUND = -32601
+RPC_PARSE_ERROR = -32700
+RPC_MISC_ERROR = -1
+RPC_TYPE_ERROR = -3
+RPC_INVALID_ADDRESS_OR_KEY = -5
+RPC_INVALID_PARAMETER = -8
+
+SCRIPT_TYPE_NAMES = {
+	TX_NONSTANDARD: 'nonstandard', TX_PUBKEY: 'pubkey', TX_PUBKEYHASH: 'pubkeyhash',
+	TX_SCRIPTHASH: 'scripthash', TX_MULTISIG: 'multisig', TX_NULLDATA: 'nulldata',
+	TX_WITNESS_V0_KEYHASH: 'witness_v0_keyhash', TX_WITNESS_V0_SCRIPTHASH: 'witness_v0_scripthash',
+	TX_WITNESS_V1_TAPROOT: 'witness_v1_taproot', TX_WITNESS_UNKNOWN: 'witness_unknown'
+}
+"""
+TX_* constants -> the "type" names of scriptPubKeys used by Bitcoin Core
+"""
+
+
+class RPCError(Exception):
+	def __init__(self, code: int, message: str):
+		super().__init__(message)
+		self.code = code
+		self.message = message
+
+
+class LRUCache:
+	"""
+	A thread-safe mapping that keeps the max_size most recently used items.
+	"""
+
+	def __init__(self, max_size: int):
+		self.max_size = max_size
+		self.items = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			if key not in self.items:
+				return None
+			self.items.move_to_end(key)
+			return self.items[key]
+
+	def put(self, key, value):
+		with self.lock:
+			self.items[key] = value
+			self.items.move_to_end(key)
+			while len(self.items) > self.max_size:
+				self.items.popitem(last=False)
+
+
+def parse_hash(value, name: str) -> bytes:
+	"""
+	Return the raw (i.e. little-endian) bytes of a hash given in hex as
+	bitcoin-cli shows it, raising the same errors as ParseHashV() in Bitcoin Core.
+	"""
+	if isinstance(value, str) is False:
+		raise RPCError(RPC_TYPE_ERROR, f'{name} must be a string')
+	if len(value) != 64:
+		raise RPCError(RPC_INVALID_PARAMETER, f'{name} must be of length 64 (not {len(value)}, for \'{value}\')')
+	try:
+		return utils.convert_endianness(bytes.fromhex(value))
+	except ValueError:
+		raise RPCError(RPC_INVALID_PARAMETER, f'{name} must be hexadecimal string (not \'{value}\')')
+
+
+def get_hash_hex(raw_hash: bytes) -> str:
+	return utils.convert_endianness(raw_hash).hex()
+
+
+def get_block_work(bits: int) -> int:
+	"""
+	The expected number of hashes to find a block, as GetBlockProof() in
+	Bitcoin Core's src/chain.cpp
+	"""
+	target = utils.get_target_hash_by_difficulty(bits.to_bytes(4, byteorder='little'))
+	return 2 ** 256 // (target + 1)
+
+
+def get_script_pubkey_json(script_pubkey: bytes) -> dict:
+	script_type, payload = utils.classify_script_pubkey(script_pubkey)
+	result = {'hex': bytes(script_pubkey).hex(), 'type': SCRIPT_TYPE_NAMES[script_type]}
+	if script_type in (TX_PUBKEYHASH, TX_SCRIPTHASH):
+		result['address'] = utils.get_address_from_script_type(script_type, payload)
+	return result
+
+
+def get_transaction_json(transaction: Transaction) -> dict:
+	"""
+	The same fields as TxToUniv() in Bitcoin Core's src/core_write.cpp
+	"""
+	inputs = []
+	for tx_input in transaction.inputs:
+		if tx_input.txOutId == 0xffffffff:
+			result = {'coinbase': tx_input.script_sig.hex()}
+		else:
+			result = {
+				'txid': get_hash_hex(tx_input.prev_tx_hash), 'vout': tx_input.txOutId,
+				'scriptSig': {'hex': tx_input.script_sig.hex()}
+			}
+		if len(tx_input.witness) > 0:
+			result['txinwitness'] = [item.hex() for item in tx_input.witness]
+		result['sequence'] = tx_input.seqNo
+		inputs.append(result)
+	outputs = []
+	for n, tx_output in enumerate(transaction.outputs):
+		outputs.append({
+			'value': tx_output.value / 100000000, 'n': n,
+			'scriptPubKey': get_script_pubkey_json(tx_output.pubkey)
+		})
+	return {
+		'txid': transaction.tx_hash, 'hash': transaction.get_wtxid(), 'version': transaction.version,
+		'size': transaction.size, 'vsize': transaction.get_vsize(), 'weight': transaction.get_weight(),
+		'locktime': transaction.lockTime, 'vin': inputs, 'vout': outputs,
+		'hex': transaction.get_bytes().hex()
+	}
+
+
+class ReadOnlyNode:
+	"""
+	The RPC methods, answered from blk*.dat files. Every public method whose
+	name is in METHODS takes the positional params of the JSON-RPC request.
+	"""
+
+	METHODS = ('getblockcount', 'getbestblockhash', 'getblockhash', 'getblockheader', 'getblock',
+		'getrawtransaction', 'gettxoutproof')
+
+	def __init__(self, blocks_dir: str, txindex_dir: str = None, cache_size: int = DEFAULT_CACHE_SIZE):
+		self.blocks_dir = blocks_dir
+		self.txindex = None
+		if txindex_dir is not None and os.path.isdir(txindex_dir):
+			self.txindex = LevelDBReader(txindex_dir)
+		self.block_cache = LRUCache(cache_size)
+		"""
+		Raw block hash -> (raw block bytes, Block) of the most recently requested blocks
+		"""
+		self.refresh_lock = threading.Lock()
+		self.refresh_thread = None
+		self.last_refresh = 0
+		self.load_block_index()
+
+	def load_block_index(self):
+		block_index = BlockIndex(self.blocks_dir)
+		chainwork = []
+		total = 0
+		for block_hash in block_index.active_chain:
+			total += get_block_work(block_index.entries[block_hash].bits)
+			chainwork.append(total)
+		# Replaced together so that concurrent requests see a consistent state
+		self.state = (block_index, chainwork)
+		self.last_refresh = time.monotonic()
+
+	def reload(self):
+		try:
+			self.load_block_index()
+			if self.txindex is not None:
+				self.txindex.reload()
+		except Exception:
+			# The old state is kept
+			traceback.print_exc(file=sys.stderr)
+
+	def refresh(self) -> bool:
+		"""
+		Reload the block index in a background thread if it has not been
+		reloaded recently, e.g. when a request refers to a block that bitcoind
+		has connected since. Wait for the reload up to REFRESH_WAIT seconds and
+		return whether a reload has finished in the meantime.
+		"""
+		with self.refresh_lock:
+			if self.refresh_thread is None or self.refresh_thread.is_alive() is False:
+				if time.monotonic() - self.last_refresh < REFRESH_INTERVAL:
+					return False
+				# Counts from the start, so that a failing reload is not retried by every request
+				self.last_refresh = time.monotonic()
+				self.refresh_thread = threading.Thread(target=self.reload, daemon=True)
+				self.refresh_thread.start()
+			refresh_thread = self.refresh_thread
+		refresh_thread.join(REFRESH_WAIT)
+		return refresh_thread.is_alive() is False
+
+	def get_entry(self, block_hash: bytes) -> BlockIndexEntry:
+		for attempt in range(2):
+			block_index, _ = self.state
+			if block_hash in block_index.entries:
+				return block_index.entries[block_hash]
+			if attempt == 0 and self.refresh() is False:
+				break
+		raise RPCError(RPC_INVALID_ADDRESS_OR_KEY, 'Block not found')
+
+	def is_on_active_chain(self, entry: BlockIndexEntry) -> bool:
+		block_index, _ = self.state
+		return (entry.height < len(block_index.active_chain) and
+			block_index.active_chain[entry.height] == entry.hash)
+
+	def get_chainwork(self, entry: BlockIndexEntry) -> int:
+		block_index, chainwork = self.state
+		work = 0
+		# Blocks on stale branches: add up the work back to the active chain
+		while entry is not None and self.is_on_active_chain(entry) is False:
+			work += get_block_work(entry.bits)
+			entry = block_index.entries.get(entry.hash_prev_blk)
+		if entry is not None:
+			work += chainwork[entry.height]
+		return work
+
+	def get_median_time_past(self, entry: BlockIndexEntry) -> int:
+		block_index, _ = self.state
+		timestamps = []
+		while entry is not None and len(timestamps) < MEDIAN_TIME_SPAN:
+			timestamps.append(entry.timestamp)
+			entry = block_index.entries.get(entry.hash_prev_blk)
+		timestamps.sort()
+		return timestamps[len(timestamps) // 2]
+
+	def read_block(self, entry: BlockIndexEntry):
+		"""
+		Return (raw block bytes, Block), from the cache if it is a hot block.
+		"""
+		cached = self.block_cache.get(entry.hash)
+		if cached is not None:
+			return cached
+		if entry.has_data() is False:
+			raise RPCError(RPC_MISC_ERROR, 'Block not available (pruned data)')
+		block_index, _ = self.state
+		with open(block_index.get_block_file_path(entry), 'rb') as f:
+			f.seek(entry.data_pos - 4, io.SEEK_SET)
+			block_size = utils.read_4bytes_as_uint(f)
+			raw_block = f.read(block_size)
+		cached = (raw_block, Block.from_bytes(raw_block))
+		self.block_cache.put(entry.hash, cached)
+		return cached
+
+	def get_header_json(self, entry: BlockIndexEntry) -> dict:
+		"""
+		The same fields as blockheaderToJSON() in Bitcoin Core's src/rpc/blockchain.cpp
+		"""
+		block_index, _ = self.state
+		confirmations = -1
+		if self.is_on_active_chain(entry):
+			confirmations = block_index.get_height() - entry.height + 1
+		result = {
+			'hash': get_hash_hex(entry.hash), 'confirmations': confirmations, 'height': entry.height,
+			'version': entry.version, 'versionHex': f'{entry.version:08x}',
+			'merkleroot': get_hash_hex(entry.hash_merkle_root), 'time': entry.timestamp,
+			'mediantime': self.get_median_time_past(entry), 'nonce': entry.nonce,
+			'bits': f'{entry.bits:08x}', 'difficulty': utils.difficulty(entry.bits),
+			'chainwork': f'{self.get_chainwork(entry):064x}', 'nTx': entry.transaction_count
+		}
+		if entry.height > 0:
+			result['previousblockhash'] = get_hash_hex(entry.hash_prev_blk)
+		if confirmations > 1:
+			result['nextblockhash'] = get_hash_hex(block_index.active_chain[entry.height + 1])
+		return result
+
+	def getblockcount(self) -> int:
+		block_index, _ = self.state
+		return block_index.get_height()
+
+	def getbestblockhash(self) -> str:
+		block_index, _ = self.state
+		return get_hash_hex(block_index.active_chain[-1])
+
+	def getblockhash(self, height) -> str:
+		if isinstance(height, int) is False:
+			raise RPCError(RPC_TYPE_ERROR, 'height must be an integer')
+		block_index, _ = self.state
+		if height > block_index.get_height():
+			self.refresh()
+			block_index, _ = self.state
+		if height < 0 or height > block_index.get_height():
+			raise RPCError(RPC_INVALID_PARAMETER, 'Block height out of range')
+		return get_hash_hex(block_index.active_chain[height])
+
+	def getblockheader(self, blockhash, verbose=True):
+		entry = self.get_entry(parse_hash(blockhash, 'hash'))
+		if verbose is False:
+			return utils.block_header_struct.pack(entry.version, entry.hash_prev_blk,
+				entry.hash_merkle_root, entry.timestamp, entry.bits, entry.nonce).hex()
+		return self.get_header_json(entry)
+
+	def getblock(self, blockhash, verbosity=1):
+		# bitcoin-cli sends verbose=true/false for older clients
+		if verbosity is True or verbosity is False:
+			verbosity = int(verbosity)
+		entry = self.get_entry(parse_hash(blockhash, 'blockhash'))
+		raw_block, block = self.read_block(entry)
+		if verbosity == 0:
+			return raw_block.hex()
+		result = self.get_header_json(entry)
+		stripped_size = len(raw_block) - sum(t.size - t.base_size for t in block.transactions)
+		result['strippedsize'] = stripped_size
+		result['size'] = len(raw_block)
+		result['weight'] = stripped_size * (WITNESS_SCALE_FACTOR - 1) + len(raw_block)
+		if verbosity == 1:
+			result['tx'] = [transaction.tx_hash for transaction in block.transactions]
+		else:
+			result['tx'] = [get_transaction_json(transaction) for transaction in block.transactions]
+		return result
+
+	def find_transaction(self, txid: bytes):
+		"""
+		Return (Transaction, block hash) of txid through the txindex, or None.
+		"""
+		if self.txindex is None:
+			return None
+		value = self.txindex.get(TXINDEX_PREFIX + txid)
+		if value is None and self.refresh():
+			# The transaction may be in a block connected since the last refresh
+			value = self.txindex.get(TXINDEX_PREFIX + txid)
+		if value is None:
+			return None
+		file_number, pos = utils.read_core_varint(value, 0)
+		data_pos, pos = utils.read_core_varint(value, pos)
+		tx_offset, pos = utils.read_core_varint(value, pos)
+		with open(os.path.join(self.blocks_dir, f'blk{file_number:05d}.dat'), 'rb') as f:
+			f.seek(data_pos, io.SEEK_SET)
+			block_hash = utils.double_sha256(f.read(80))
+			# nTxOffset counts from the end of the header
+			f.seek(tx_offset, io.SEEK_CUR)
+			transaction = Transaction(f)
+		return transaction, block_hash
+
+	def getrawtransaction(self, txid, verbose=False, blockhash=None):
+		raw_txid = parse_hash(txid, 'parameter 1')
+		if blockhash is not None:
+			entry = self.get_entry(parse_hash(blockhash, 'parameter 3'))
+			_, block = self.read_block(entry)
+			# The same form as tx_hash, whatever the case of the given txid
+			txid = get_hash_hex(raw_txid)
+			found = None
+			for transaction in block.transactions:
+				if transaction.tx_hash == txid:
+					found = (transaction, entry.hash)
+					break
+			if found is None:
+				raise RPCError(RPC_INVALID_ADDRESS_OR_KEY, 'No such transaction found in the provided block. '
+					'Use gettransaction for wallet transactions.')
+		else:
+			found = self.find_transaction(raw_txid)
+			if found is None:
+				if self.txindex is None:
+					raise RPCError(RPC_INVALID_ADDRESS_OR_KEY, 'No such mempool transaction. Use -txindex or '
+						'provide a block hash to enable blockchain transaction queries. '
+						'Use gettransaction for wallet transactions.')
+				raise RPCError(RPC_INVALID_ADDRESS_OR_KEY, 'No such mempool or blockchain transaction. '
+					'Use gettransaction for wallet transactions.')
+		transaction, block_hash = found
+		if not verbose:
+			return transaction.get_bytes().hex()
+		result = get_transaction_json(transaction)
+		result['blockhash'] = get_hash_hex(block_hash)
+		entry = self.get_entry(block_hash)
+		if self.is_on_active_chain(entry):
+			block_index, _ = self.state
+			result['confirmations'] = block_index.get_height() - entry.height + 1
+			result['time'] = entry.timestamp
+			result['blocktime'] = entry.timestamp
+		else:
+			result['confirmations'] = 0
+		return result
+
+	def gettxoutproof(self, txids, blockhash=None):
+		"""
+		The same as gettxoutproof in Bitcoin Core's src/rpc/txoutproof.cpp. Without
+		blockhash, the block is found through the txindex.
+		"""
+		if isinstance(txids, list) is False:
+			raise RPCError(RPC_TYPE_ERROR, 'txids must be an array')
+		raw_txids = []
+		for txid in txids:
+			raw_txid = parse_hash(txid, 'txid')
+			if raw_txid in raw_txids:
+				raise RPCError(RPC_INVALID_PARAMETER, f'Invalid parameter, duplicated txid: {txid}')
+			raw_txids.append(raw_txid)
+		if blockhash is not None:
+			entry = self.get_entry(parse_hash(blockhash, 'blockhash'))
+		else:
+			found = None
+			for raw_txid in raw_txids:
+				found = self.find_transaction(raw_txid)
+				if found is not None:
+					break
+			if found is None:
+				raise RPCError(RPC_INVALID_ADDRESS_OR_KEY, 'Transaction not yet in block')
+			entry = self.get_entry(found[1])
+		_, block = self.read_block(entry)
+		txids = [get_hash_hex(raw_txid) for raw_txid in raw_txids]
+		block_txids = set(transaction.tx_hash for transaction in block.transactions)
+		if any(txid not in block_txids for txid in txids):
+			raise RPCError(RPC_INVALID_ADDRESS_OR_KEY, 'Not all transactions found in specified or retrieved block')
+		return block.get_tx_out_proof(txids).hex()
+
+	def call(self, method: str, params):
+		if method not in self.METHODS:
+			raise RPCError(RPC_METHOD_NOT_FOUND, 'Method not found')
+		if params is None:
+			params = []
+		function = getattr(self, method)
+		try:
+			if isinstance(params, dict):
+				inspect.signature(function).bind(**params)
+				return function(**params)
+			if isinstance(params, list):
+				inspect.signature(function).bind(*params)
+				return function(*params)
+		except TypeError as e:
+			# Wrong number or names of params
+			raise RPCError(RPC_MISC_ERROR, f'{method}: {e}')
+		raise RPCError(RPC_INVALID_REQUEST, 'Params must be an array or object')
+
+
+class RPCRequestHandler(BaseHTTPRequestHandler):
+	"""
+	HTTP/1.1, so connections are kept alive across requests. Every connection
+	is served by its own thread of the ThreadingHTTPServer.
+	"""
+
+	protocol_version = 'HTTP/1.1'
+	# Headers and body are written separately, without TCP_NODELAY every
+	# response on a kept-alive connection would wait for a delayed ACK.
+	disable_nagle_algorithm = True
+	node: ReadOnlyNode = None
+	verbose = False
+
+	def log_message(self, format, *args):
+		if self.verbose:
+			super().log_message(format, *args)
+
+	def handle_request(self, request):
+		"""
+		Return (HTTP status, response object) for a single JSON-RPC request,
+		following JSONRPCExecOne() and the status codes of bitcoind.
+		"""
+		if isinstance(request, dict) is False:
+			return 400, {'result': None, 'error': {'code': RPC_INVALID_REQUEST, 'message': 'Invalid Request object'}, 'id': None}
+		request_id = request.get('id')
+		is_v2 = request.get('jsonrpc') == '2.0'
+		try:
+			result = self.node.call(request.get('method'), request.get('params'))
+		except Exception as e:
+			if isinstance(e, RPCError):
+				error = {'code': e.code, 'message': e.message}
+			else:
+				# Like CRPCTable::execute(), any other failure of a method is an
+				# RPC_MISC_ERROR carrying the exception's message
+				traceback.print_exc(file=sys.stderr)
+				error = {'code': RPC_MISC_ERROR, 'message': str(e)}
+			if is_v2:
+				return 200, {'jsonrpc': '2.0', 'error': error, 'id': request_id}
+			status = 404 if error['code'] == RPC_METHOD_NOT_FOUND else 500
+			return status, {'result': None, 'error': error, 'id': request_id}
+		if is_v2:
+			return 200, {'jsonrpc': '2.0', 'result': result, 'id': request_id}
+		return 200, {'result': result, 'error': None, 'id': request_id}
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		try:
+			request = json.loads(body)
+		except ValueError:
+			status, response = 500, {'result': None, 'error': {'code': RPC_PARSE_ERROR, 'message': 'Parse error'}, 'id': None}
+		else:
+			if isinstance(request, list):
+				# A batch is always answered with 200, errors are in the items
+				status, response = 200, [self.handle_request(r)[1] for r in request]
+			else:
+				status, response = self.handle_request(request)
+		payload = json.dumps(response).encode() + b'\n'
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(payload)))
+		self.end_headers()
+		self.wfile.write(payload)
+
+
+def make_server(node: ReadOnlyNode, host: str, port: int, verbose: bool = False) -> ThreadingHTTPServer:
+	handler = type('BoundRPCRequestHandler', (RPCRequestHandler,), {'node': node, 'verbose': verbose})
+	server = ThreadingHTTPServer((host, port), handler)
+	server.daemon_threads = True
+	return server
+
+
+def serve(node: ReadOnlyNode, host: str, port: int, verbose: bool = False):
+	server = make_server(node, host, port, verbose)
+	print(f"Serving {node.blocks_dir} on http://{host}:{port}/ (height {node.getblockcount()}, "
+		f"txindex {'enabled' if node.txindex is not None else 'disabled'})")
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+
+
+class RPCClient:
+	"""
+	A minimal stand-in for bitcoin-cli, reusing one keep-alive connection.
+	"""
+
+	def __init__(self, host: str, port: int):
+		self.connection = http.client.HTTPConnection(host, port)
+		self.next_id = 0
+
+	def call(self, method: str, *params):
+		self.next_id += 1
+		body = json.dumps({'jsonrpc': '1.0', 'id': self.next_id, 'method': method, 'params': list(params)})
+		self.connection.request('POST', '/', body, {'Content-Type': 'application/json'})
+		response = json.loads(self.connection.getresponse().read())
+		if response['error'] is not None:
+			raise RPCError(response['error']['code'], response['error']['message'])
+		return response['result']
+
+	def close(self):
+		self.connection.close()
+
+
+def parse_cli_param(value: str):
+	"""
+	Like bitcoin-cli, a param is JSON if it parses as such (e.g., 0, true),
+	otherwise a string (e.g., a hash).
+	"""
+	try:
+		return json.loads(value)
+	except ValueError:
+		return value
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument(
+		'--blocks-dir', dest='blocks-dir', default=None,
+		help="The blocks/ directory as managed by Bitcoin Core."
+	)
+	ap.add_argument(
+		'--txindex-dir', dest='txindex-dir', default=None,
+		help="Bitcoin Core's indexes/txindex/ directory, defaults to the one next to --blocks-dir."
+	)
+	ap.add_argument('--host', dest='host', default='127.0.0.1', help="Address to listen on or connect to.")
+	ap.add_argument('--port', dest='port', default=DEFAULT_PORT, help="Port to listen on or connect to.")
+	ap.add_argument(
+		'--cache-size', dest='cache-size', default=DEFAULT_CACHE_SIZE,
+		help="Number of recently requested blocks kept decoded in memory."
+	)
+	ap.add_argument('--verbose', dest='verbose', action='store_true', help="Log every HTTP request.")
+	ap.add_argument(
+		'--call', dest='call', nargs='+', default=None, metavar='ARG',
+		help="Act as a client: send <method> [params...] to a running server and print the result."
+	)
+	args = vars(ap.parse_args())
+
+	if args['call'] is not None:
+		client = RPCClient(str(args['host']), int(args['port']))
+		try:
+			result = client.call(args['call'][0], *[parse_cli_param(p) for p in args['call'][1:]])
+		except RPCError as e:
+			print(f"error code: {e.code}\nerror message:\n{e.message}", file=sys.stderr)
+			sys.exit(1)
+		finally:
+			client.close()
+		print(result if isinstance(result, str) else json.dumps(result, indent=2))
+		return
+
+	if args['blocks-dir'] is None:
+		ap.error('--blocks-dir is required unless --call is given')
+	blocks_dir = str(args['blocks-dir'])
+	if os.path.isdir(blocks_dir) is False:
+		raise FileNotFoundError(f"[{blocks_dir}] does not exist")
+	txindex_dir = args['txindex-dir']
+	if txindex_dir is None:
+		txindex_dir = os.path.join(os.path.dirname(os.path.abspath(blocks_dir)), 'indexes', 'txindex')
+	node = ReadOnlyNode(blocks_dir, str(txindex_dir), int(args['cache-size']))
+	serve(node, str(args['host']), int(args['port']), args['verbose'])
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+from block import Block
+from sink import BlockSink, BlockCounterSink
+
+import argparse
+import glob
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+import utils
+
+
+def list_block_files(blocks_dir: str):
+	"""
+	Return the names of blk*.dat files in blocks_dir. Bitcoin Core zero-pads
+	the file number, so lexicographical order is also the order of the files.
+	"""
+	return sorted(
+		os.path.basename(path) for path in glob.glob(os.path.join(blocks_dir, 'blk*.dat'))
+	)
+
+
+def iterate_blocks(block_reader: io.BufferedReader, offset: int = 0,
+	magic_numbers=utils.NETWORK_MAGICS):
+	"""
+	Yield (offset, block) for every block of a blk*.dat file from offset on.
+	Bitcoin Core preallocates blk*.dat files, so they can contain zero-filled
+	gaps and tails, and a crash can leave partially written or damaged blocks.
+	Whenever the data at offset is not a block of one of magic_numbers, we jump
+	to the next occurrence of a magic number instead of stopping.
+	"""
+	assert isinstance(block_reader, io.BufferedReader)
+	file_size = os.fstat(block_reader.fileno()).st_size
+	file_map = None
+	next_positions = {}
+	try:
+		while offset + 8 <= file_size:
+			block_reader.seek(offset, io.SEEK_SET)
+			magic_number, block_size = utils.magic_and_size_struct.unpack(block_reader.read(8))
+			block = None
+			if (magic_number in magic_numbers and 80 < block_size <= utils.MAX_BLOCK_SERIALIZED_SIZE and
+				offset + 8 + block_size <= file_size):
+				block_reader.seek(offset, io.SEEK_SET)
+				try:
+					# Block() checks that the transactions end exactly at block_size
+					block = Block(block_reader)
+				except (ValueError, AssertionError, IndexError, MemoryError, struct.error) as ex:
+					# A corrupt length field can make the parser read far beyond the
+					# block, e.g., a MemoryError for a script length of several GB.
+					print(f"Skipping corrupt block at offset {offset}: {repr(ex)}", file=sys.stderr)
+					block = None
+			if block is not None and block.continue_parsing:
+				yield offset, block
+				offset = block_reader.tell()
+				continue
+
+			if file_map is None:
+				file_map = mmap.mmap(block_reader.fileno(), 0, access=mmap.ACCESS_READ)
+			offset = utils.find_next_magic(file_map, offset + 1, magic_numbers, next_positions)
+			if offset is None:
+				return
+	finally:
+		if file_map is not None:
+			file_map.close()
+
+
+def load_checkpoint(checkpoint_path: str):
+	if checkpoint_path is None or os.path.isfile(checkpoint_path) is False:
+		return None
+	with open(checkpoint_path, 'r') as f:
+		return json.load(f)
+
+
+def save_checkpoint(checkpoint_path: str, checkpoint: dict):
+	"""
+	Write the checkpoint atomically: we write to a temporary file next to the
+	checkpoint and then rename it over the old one, so a crash leaves either
+	the old checkpoint or the new one on disk but never a half-written file.
+	"""
+	if checkpoint_path is None:
+		return
+	temp_path = checkpoint_path + '.tmp'
+	with open(temp_path, 'w') as f:
+		json.dump(checkpoint, f)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(temp_path, checkpoint_path)
+
+
+def scan_directory(blocks_dir: str, sink: BlockSink, checkpoint_path: str = None,
+	checkpoint_interval: int = 1000, magic_numbers=utils.NETWORK_MAGICS):
+	"""
+	Parse every block of every blk*.dat file in blocks_dir and pass them to
+	sink. Every checkpoint_interval blocks, the position right after the last
+	complete block is saved to checkpoint_path together with the sink's state.
+	If checkpoint_path already exists, the scan resumes from that position.
+	"""
+	assert isinstance(sink, BlockSink)
+	assert checkpoint_interval > 0
+
+	checkpoint = load_checkpoint(checkpoint_path)
+	block_count = 0
+	if checkpoint is not None and checkpoint.get('sink') != type(sink).__name__:
+		# The state of another sink cannot be restored
+		print(f"Checkpoint was saved by {checkpoint.get('sink')}, not {type(sink).__name__}, "
+			f"starting from scratch", file=sys.stderr)
+		checkpoint = None
+	if checkpoint is not None:
+		block_count = checkpoint['block_count']
+		sink.set_state(checkpoint['sink_state'])
+		print(f"Resuming from {checkpoint['file']}[offset: {checkpoint['offset']}] "
+			f"after {block_count} blocks")
+	else:
+		sink.reset()
+
+	for file_name in list_block_files(blocks_dir):
+		offset = 0
+		if checkpoint is not None:
+			if file_name < checkpoint['file']:
+				continue
+			if file_name == checkpoint['file']:
+				offset = checkpoint['offset']
+
+		with open(os.path.join(blocks_dir, file_name), 'rb') as block_reader:
+			for block_offset, block in iterate_blocks(block_reader, offset, magic_numbers):
+				sink.consume(block, file_name, block_offset)
+				offset = block_reader.tell()
+				block_count += 1
+				if block_count % checkpoint_interval == 0:
+					save_checkpoint(checkpoint_path, {
+						'file': file_name, 'offset': offset, 'block_count': block_count,
+						'sink': type(sink).__name__, 'sink_state': sink.get_state()
+					})
+		# We also checkpoint at the end of each file, so that a restart does not
+		# have to re-parse the tail of the last file.
+		save_checkpoint(checkpoint_path, {
+			'file': file_name, 'offset': offset, 'block_count': block_count,
+			'sink': type(sink).__name__, 'sink_state': sink.get_state()
+		})
+		print(f"Scanned {file_name}, {block_count} blocks so far")
+
+	sink.close()
+	return block_count
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument(
+		'--blocks-dir', dest='blocks-dir', required=True,
+		help="The blocks/ directory as managed by Bitcoin Core."
+	)
+	ap.add_argument(
+		'--checkpoint', dest='checkpoint', default=None,
+		help="Path of the checkpoint file. If it exists, the scan resumes from it."
+	)
+	ap.add_argument(
+		'--checkpoint-interval', dest='checkpoint-interval', default=1000,
+		help="Number of blocks between two checkpoints."
+	)
+	ap.add_argument(
+		'--stats-output', dest='stats-output', default=None,
+		help="Write per-block and per-file statistics (as JSON lines) to this path."
+	)
+	ap.add_argument(
+		'--stats-fields', dest='stats-fields', default=None,
+		help="Comma-separated statistics fields, e.g. txs,total_out,script_types. " \
+			"Defaults to every field."
+	)
+	ap.add_argument(
+		'--network', dest='network', default=None,
+		choices=sorted(utils.NETWORK_MAGICS.values()),
+		help="Only accept blocks of this network. Defaults to every network."
+	)
+	args = vars(ap.parse_args())
+	blocks_dir = str(args['blocks-dir'])
+	checkpoint_path = args['checkpoint']
+	checkpoint_interval = int(args['checkpoint-interval'])
+	magic_numbers = utils.NETWORK_MAGICS
+	if args['network'] is not None:
+		magic_numbers = [m for m, n in utils.NETWORK_MAGICS.items() if n == args['network']]
+
+	if os.path.isdir(blocks_dir) is False:
+		raise FileNotFoundError(f"[{blocks_dir}] does not exist")
+	if args['stats-output'] is not None:
+		from stats import StatsSink, BLOCK_STATS_FIELDS
+
+		fields = BLOCK_STATS_FIELDS
+		if args['stats-fields'] is not None:
+			fields = args['stats-fields'].split(',')
+		sink = StatsSink(args['stats-output'], fields)
+	else:
+		sink = BlockCounterSink()
+	block_count = scan_directory(blocks_dir, sink, checkpoint_path, checkpoint_interval, magic_numbers)
+	print('')
+	print(f"Scanned {block_count} blocks")
+	if args['stats-output'] is not None:
+		print(f"Statistics are written to [{args['stats-output']}]")
+	else:
+		print(json.dumps(sink.get_state()))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,56 @@
+from block import Block
+
+
+class BlockSink:
+	"""
+	A sink receives every block parsed by scan_directory(). Its state is saved
+	in the checkpoint file together with the scan position, so a sink must be
+	able to dump its state to a JSON-serializable dict and restore it from one.
+	"""
+
+	def consume(self, block: Block, file_name: str, offset: int):
+		raise NotImplementedError()
+
+	def get_state(self) -> dict:
+		return {}
+
+	def set_state(self, state: dict):
+		pass
+
+	def reset(self):
+		"""
+		Called instead of set_state() when a scan starts from scratch, to drop
+		the output of earlier runs.
+		"""
+		pass
+
+	def close(self):
+		pass
+
+
+class BlockCounterSink(BlockSink):
+	"""
+	The default sink, it only counts blocks, transactions and bytes.
+	"""
+
+	def __init__(self):
+		self.block_count = 0
+		self.transaction_count = 0
+		self.total_size = 0
+
+	def consume(self, block: Block, file_name: str, offset: int):
+		self.block_count += 1
+		self.transaction_count += block.transaction_count
+		self.total_size += block.block_size
+
+	def get_state(self) -> dict:
+		return {
+			'block_count': self.block_count,
+			'transaction_count': self.transaction_count,
+			'total_size': self.total_size
+		}
+
+	def set_state(self, state: dict):
+		self.block_count = state['block_count']
+		self.transaction_count = state['transaction_count']
+		self.total_size = state['total_size']
@@ -0,0 +1,288 @@
+from block import Block, WITNESS_SCALE_FACTOR
+from sink import BlockSink
+from opcodes import *
+
+import json
+import os
+import utils
+
+# The names and semantics of the fields follow Bitcoin Core's getblockstats
+# RPC wherever this parser has the data needed to compute them. Fee related
+# fields require the spent outputs (i.e., undo.attach_undo()) and are None
+# otherwise. Sizes include witness data, weights are as defined in BIP141.
+NUM_GETBLOCKSTATS_PERCENTILES = 5
+GETBLOCKSTATS_PERCENTILES = (10, 25, 50, 75, 90)
+
+BLOCK_STATS_FIELDS = (
+	'blockhash', 'time', 'txs', 'ins', 'outs', 'total_out', 'total_size',
+	'total_weight', 'utxo_increase', 'subsidy', 'totalfee', 'avgfee', 'minfee',
+	'maxfee', 'medianfee', 'avgfeerate', 'minfeerate', 'maxfeerate',
+	'feerate_percentiles', 'avgtxsize', 'mintxsize', 'maxtxsize', 'mediantxsize',
+	'script_types', 'coinbase_text'
+)
+"""
+Every field compute_block_stats() knows about. The last two are not part of
+getblockstats: script_types counts outputs by utils.classify_script_pubkey()
+type and coinbase_text is the printable part of the coinbase's scriptSig.
+"""
+
+COIN = 100_000_000
+SUBSIDY_HALVING_INTERVALS = {'regtest': 150}
+"""
+nSubsidyHalvingInterval of networks other than mainnet, testnets and signet,
+see Bitcoin Core's src/kernel/chainparams.cpp
+"""
+DEFAULT_SUBSIDY_HALVING_INTERVAL = 210_000
+
+FILE_STATS_FIELDS = ('blocks', 'txs', 'ins', 'outs', 'total_out', 'total_size', 'totalfee')
+SUMMED_FIELDS = ('txs', 'ins', 'outs', 'total_out', 'total_size', 'totalfee')
+
+
+def get_truncated_median(values: list):
+	"""
+	The same as CalculateTruncatedMedian() in Bitcoin Core's src/rpc/blockchain.cpp
+	"""
+	if len(values) == 0:
+		return 0
+	values = sorted(values)
+	size = len(values)
+	if size % 2 == 0:
+		return (values[size // 2 - 1] + values[size // 2]) // 2
+	return values[size // 2]
+
+
+def get_percentiles_by_weight(scores: list, total_weight: int):
+	"""
+	The same as CalculatePercentilesByWeight() in Bitcoin Core's
+	src/rpc/blockchain.cpp. scores is a list of (feerate, weight).
+	"""
+	result = [0] * NUM_GETBLOCKSTATS_PERCENTILES
+	if len(scores) == 0:
+		return result
+	scores = sorted(scores)
+	weights = [total_weight / 100.0 * p for p in GETBLOCKSTATS_PERCENTILES]
+	next_percentile_index = 0
+	cumulative_weight = 0
+	for feerate, weight in scores:
+		cumulative_weight += weight
+		while (next_percentile_index < NUM_GETBLOCKSTATS_PERCENTILES and
+			cumulative_weight >= weights[next_percentile_index]):
+			result[next_percentile_index] = feerate
+			next_percentile_index += 1
+	for i in range(next_percentile_index, NUM_GETBLOCKSTATS_PERCENTILES):
+		result[i] = scores[-1][0]
+	return result
+
+
+def get_block_subsidy(height: int, halving_interval: int = DEFAULT_SUBSIDY_HALVING_INTERVAL) -> int:
+	"""
+	The same as GetBlockSubsidy() in Bitcoin Core's src/validation.cpp
+	"""
+	halvings = height // halving_interval
+	# Shifting by 64 or more bits is undefined in C++, Bitcoin Core returns 0
+	if halvings >= 64:
+		return 0
+	return (50 * COIN) >> halvings
+
+
+def get_bip34_height(block: Block):
+	"""
+	Return the height that BIP34 requires blocks of version 2 and above to push
+	first in their coinbase's scriptSig, or None for older blocks.
+	"""
+	if block.block_header.version < 2:
+		return None
+	script_sig = block.transactions[0].inputs[0].script_sig
+	if len(script_sig) == 0:
+		return None
+	# Like CScript() << nHeight: OP_0 and OP_1...OP_16 for small heights,
+	# a little-endian number push otherwise
+	if script_sig[0] == OP_0:
+		return 0
+	if OP_1 <= script_sig[0] <= OP_16:
+		return script_sig[0] - OP_1 + 1
+	if 1 <= script_sig[0] <= 8 and len(script_sig) > script_sig[0]:
+		return int.from_bytes(script_sig[1:1 + script_sig[0]], byteorder='little')
+	return None
+
+
+def get_coinbase_text(block: Block) -> str:
+	script_sig = block.transactions[0].inputs[0].script_sig
+	return ''.join(chr(b) for b in script_sig if 0x20 <= b < 0x7f)
+
+
+def compute_block_stats(block: Block, fields=BLOCK_STATS_FIELDS, height: int = None) -> dict:
+	"""
+	Compute the requested fields of a block in a single pass over its
+	transactions. Like getblockstats, the coinbase transaction is excluded from
+	every transaction-level aggregate except outs. The subsidy depends on the
+	block's height: pass it if it is known (e.g., from the block index),
+	otherwise it is read from the coinbase (see get_bip34_height()) and subsidy
+	is None for blocks older than BIP34.
+	"""
+	ins = 0
+	outs = 0
+	total_out = 0
+	total_size = 0
+	fees = []
+	feerate_scores = []
+	tx_sizes = []
+	script_types = {}
+	total_weight = 0
+	for transaction in block.transactions:
+		outs += transaction.outCount
+		for tx_output in transaction.outputs:
+			script_type, _ = tx_output.get_script_type()
+			script_types[script_type] = script_types.get(script_type, 0) + 1
+		if transaction.seq == 0:
+			continue
+		ins += transaction.input_count
+		total_out += sum(o.value for o in transaction.outputs)
+		weight = transaction.get_weight()
+		total_size += transaction.size
+		total_weight += weight
+		tx_sizes.append(transaction.size)
+		if transaction.fee is not None:
+			fees.append(transaction.fee)
+			feerate_scores.append((transaction.fee * WITNESS_SCALE_FACTOR // weight, weight))
+
+	# Fees are only known if every non-coinbase transaction has its spent outputs
+	has_fees = len(fees) == len(tx_sizes)
+	tx_count = len(tx_sizes)
+	totalfee = sum(fees) if has_fees else None
+	feerates = [feerate for feerate, _ in feerate_scores]
+
+	stats = {}
+	for field in fields:
+		if field == 'blockhash':
+			stats[field] = utils.convert_endianness(block.curr_block_hash).hex()
+		elif field == 'time':
+			stats[field] = block.block_header.timestamp
+		elif field == 'txs':
+			stats[field] = block.transaction_count
+		elif field == 'ins':
+			stats[field] = ins
+		elif field == 'outs':
+			stats[field] = outs
+		elif field == 'total_out':
+			stats[field] = total_out
+		elif field == 'total_size':
+			stats[field] = total_size
+		elif field == 'total_weight':
+			stats[field] = total_weight
+		elif field == 'utxo_increase':
+			stats[field] = outs - ins
+		elif field == 'subsidy':
+			if height is None:
+				height = get_bip34_height(block)
+			halving_interval = SUBSIDY_HALVING_INTERVALS.get(
+				utils.NETWORK_MAGICS.get(block.magic_number), DEFAULT_SUBSIDY_HALVING_INTERVAL)
+			stats[field] = get_block_subsidy(height, halving_interval) if height is not None else None
+		elif field == 'totalfee':
+			stats[field] = totalfee
+		elif field == 'avgfee':
+			stats[field] = (totalfee // tx_count if tx_count > 0 else 0) if has_fees else None
+		elif field == 'minfee':
+			stats[field] = min(fees, default=0) if has_fees else None
+		elif field == 'maxfee':
+			stats[field] = max(fees, default=0) if has_fees else None
+		elif field == 'medianfee':
+			stats[field] = get_truncated_median(fees) if has_fees else None
+		elif field == 'avgfeerate':
+			stats[field] = (totalfee * WITNESS_SCALE_FACTOR // total_weight if total_weight > 0 else 0
+				) if has_fees else None
+		elif field == 'minfeerate':
+			stats[field] = min(feerates, default=0) if has_fees else None
+		elif field == 'maxfeerate':
+			stats[field] = max(feerates, default=0) if has_fees else None
+		elif field == 'feerate_percentiles':
+			stats[field] = get_percentiles_by_weight(feerate_scores, total_weight) if has_fees else None
+		elif field == 'avgtxsize':
+			stats[field] = total_size // tx_count if tx_count > 0 else 0
+		elif field == 'mintxsize':
+			stats[field] = min(tx_sizes, default=0)
+		elif field == 'maxtxsize':
+			stats[field] = max(tx_sizes, default=0)
+		elif field == 'mediantxsize':
+			stats[field] = get_truncated_median(tx_sizes)
+		elif field == 'script_types':
+			stats[field] = script_types
+		elif field == 'coinbase_text':
+			stats[field] = get_coinbase_text(block)
+		else:
+			raise ValueError(f'Unknown block statistics field [{field}]')
+	return stats
+
+
+class StatsSink(BlockSink):
+	"""
+	Write one JSON line of compute_block_stats() per block and, after the last
+	block of each blk*.dat file, one JSON line of per-file totals. Lines of the
+	two kinds are told apart by their 'file'/'offset' keys and 'blocks' key
+	respectively, so queries can run against this output instead of raw blocks.
+	"""
+
+	def __init__(self, output_path: str, fields=BLOCK_STATS_FIELDS):
+		for field in fields:
+			if field not in BLOCK_STATS_FIELDS:
+				raise ValueError(f'Unknown block statistics field [{field}]')
+		self.output_path = output_path
+		self.fields = tuple(fields)
+		# The per-file totals need a few fields even if they are not requested
+		self.computed_fields = self.fields + tuple(f for f in SUMMED_FIELDS if f not in fields)
+		# Not truncated here: a resumed scan keeps the lines up to its checkpoint,
+		# see set_state() and reset()
+		self.output = open(output_path, 'a')
+		self.current_file = None
+		self.file_stats = None
+
+	def reset_file_stats(self, file_name: str):
+		self.current_file = file_name
+		self.file_stats = {field: 0 for field in FILE_STATS_FIELDS}
+
+	def write_file_stats(self):
+		if self.current_file is None:
+			return
+		self.output.write(json.dumps({'file': self.current_file, **self.file_stats}) + '\n')
+
+	def consume(self, block: Block, file_name: str, offset: int):
+		if file_name != self.current_file:
+			self.write_file_stats()
+			self.reset_file_stats(file_name)
+		stats = compute_block_stats(block, self.computed_fields)
+		self.file_stats['blocks'] += 1
+		for field in SUMMED_FIELDS:
+			if stats[field] is not None:
+				self.file_stats[field] += stats[field]
+		line = {'file': file_name, 'offset': offset}
+		for field in self.fields:
+			line[field] = stats[field]
+		self.output.write(json.dumps(line) + '\n')
+
+	def get_state(self) -> dict:
+		# Everything up to output_size is consistent with the scan position
+		self.output.flush()
+		os.fsync(self.output.fileno())
+		return {
+			'output_size': self.output.tell(),
+			'current_file': self.current_file,
+			'file_stats': self.file_stats
+		}
+
+	def set_state(self, state: dict):
+		# Drop lines written after the checkpoint, they will be written again
+		self.output.truncate(state['output_size'])
+		self.output.seek(state['output_size'])
+		self.current_file = state['current_file']
+		self.file_stats = state['file_stats']
+
+	def reset(self):
+		self.output.truncate(0)
+		self.output.seek(0)
+		self.current_file = None
+		self.file_stats = None
+
+	def close(self):
+		self.write_file_stats()
+		self.current_file = None
+		self.output.close()
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+from block import Block, Transaction
+
+import argparse
+import sys
+import time
+import utils
+
+# Decode blocks and transactions as soon as Bitcoin Core publishes them, e.g.
+# with bitcoind -zmqpubrawblock=tcp://127.0.0.1:28332 -zmqpubrawtx=tcp://127.0.0.1:28332
+# Every ZMQ message has three parts: topic, body and a 4-byte little-endian
+# sequence number. Bodies are decoded straight from the received buffer, in
+# the legacy or the segwit (BIP144) serialization.
+
+TOPIC_RAWBLOCK = 'rawblock'
+TOPIC_RAWTX = 'rawtx'
+
+
+def handle_message(topic: str, body, verbose: bool, sequence: int = None):
+	"""
+	Decode and print one message. A message that cannot be decoded is reported
+	on stderr with its topic and sequence number and then skipped, so that one
+	bad message does not end the subscription.
+	"""
+	try:
+		decode_message(topic, body, verbose)
+	except Exception as e:
+		print(f"Failed to decode message [{topic}] (sequence {sequence}): {type(e).__name__}: {e}",
+			file=sys.stderr)
+	sys.stdout.flush()
+
+
+def decode_message(topic: str, body, verbose: bool):
+	start = time.perf_counter()
+	if topic == TOPIC_RAWBLOCK:
+		block = Block.from_bytes(body)
+		elapsed = time.perf_counter() - start
+		print(f"rawblock {utils.convert_endianness(block.curr_block_hash).hex()} "
+			f"({block.transaction_count} transactions, {block.block_size} bytes, "
+			f"decoded in {elapsed * 1000:.3f} ms)")
+		if verbose:
+			block.stdout()
+	elif topic == TOPIC_RAWTX:
+		transaction = Transaction.from_bytes(body)
+		elapsed = time.perf_counter() - start
+		print(f"rawtx {transaction.tx_hash} ({transaction.input_count} inputs, "
+			f"{transaction.outCount} outputs, decoded in {elapsed * 1000:.3f} ms)")
+		if verbose:
+			transaction.stdout()
+	else:
+		print(f"Ignoring message of topic [{topic}]", file=sys.stderr)
+
+
+def subscribe_zmq(endpoint: str, verbose: bool):
+	# pyzmq is only needed for this mode
+	import zmq
+
+	context = zmq.Context()
+	socket = context.socket(zmq.SUB)
+	socket.setsockopt(zmq.RCVHWM, 0)
+	socket.setsockopt_string(zmq.SUBSCRIBE, TOPIC_RAWBLOCK)
+	socket.setsockopt_string(zmq.SUBSCRIBE, TOPIC_RAWTX)
+	socket.connect(endpoint)
+	print(f"Subscribed to {endpoint}")
+	try:
+		while True:
+			# copy=False gives zmq.Frame objects whose .buffer is a memoryview of
+			# the received message, so nothing is copied before decoding.
+			topic, body, sequence = socket.recv_multipart(copy=False)
+			handle_message(topic.bytes.decode(), body.buffer, verbose,
+				utils.uint32_struct.unpack(sequence.bytes)[0])
+	finally:
+		socket.close()
+		context.term()
+
+
+def subscribe_stdin(verbose: bool):
+	"""
+	A local stand-in for a ZMQ publisher: every line of stdin is a message in the
+	form of "<topic> <hex body>", e.g. "rawtx 0100000001...". Line numbers are
+	used as sequence numbers.
+	"""
+	for line_number, line in enumerate(sys.stdin, start=1):
+		line = line.strip()
+		if len(line) == 0:
+			continue
+		try:
+			topic, body_hex = line.split(maxsplit=1)
+			body = bytes.fromhex(body_hex)
+		except ValueError:
+			print(f"Skipping malformed line {line_number}", file=sys.stderr)
+			continue
+		handle_message(topic, body, verbose, line_number)
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument(
+		'--zmq-endpoint', dest='zmq-endpoint', default=None,
+		help="Bitcoin Core's -zmqpubrawblock/-zmqpubrawtx endpoint, e.g. tcp://127.0.0.1:28332"
+	)
+	ap.add_argument(
+		'--stdin', dest='stdin', action='store_true',
+		help="Read \"<rawblock|rawtx> <hex>\" lines from stdin instead of ZMQ."
+	)
+	ap.add_argument(
+		'--verbose', dest='verbose', action='store_true',
+		help="Print every decoded block/transaction in full."
+	)
+	args = vars(ap.parse_args())
+	if args['stdin']:
+		subscribe_stdin(args['verbose'])
+	elif args['zmq-endpoint'] is not None:
+		subscribe_zmq(str(args['zmq-endpoint']), args['verbose'])
+	else:
+		ap.error('either --zmq-endpoint or --stdin is required')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+
+from block import Block
+
+import argparse
+import mmap
+import multiprocessing
+import os
+import utils
+
+# Bitcoin Core stores, for every connected block, the outputs spent by the
+# block in rev*.dat files next to blk*.dat files. Each record is
+#   magic number (4 bytes) | undo size (4 bytes) | CBlockUndo | checksum (32 bytes)
+# where checksum is double_sha256(hash of the PREVIOUS block + CBlockUndo),
+# see WriteUndoDataForBlock() in Bitcoin Core's src/node/blockstorage.cpp
+# (the genesis block has no undo record). Amounts and scripts are compressed
+# as implemented in Bitcoin Core's src/compressor.cpp.
+# Note that records are written when a block is connected, so their order in
+# rev*.dat is NOT the same as the order of blocks in blk*.dat.
+
+# Parameters of secp256k1, needed to decompress uncompressed public keys
+SECP256K1_P = 0xfffffffffffffffffffffffffffffffffffffffffffffffffffffffefffffc2f
+SECP256K1_B = 7
+
+# nSize values of a compressed script smaller than this are special templates
+SPECIAL_SCRIPT_COUNT = 6
+
+
+class SpentOutput:
+	"""
+	An output spent by a transaction input, i.e., Bitcoin Core's Coin.
+	"""
+
+	def __init__(self, value: int, script_pubkey: bytes, height: int, is_coinbase: bool):
+		self.value = value
+		self.script_pubkey = script_pubkey
+		self.height = height
+		"""
+		Height of the block that created this output.
+		"""
+		self.is_coinbase = is_coinbase
+
+
+def decompress_amount(x: int) -> int:
+	"""
+	The reverse of CompressAmount() in Bitcoin Core's src/compressor.cpp
+	"""
+	if x == 0:
+		return 0
+	x -= 1
+	exponent = x % 10
+	x //= 10
+	if exponent < 9:
+		last_digit = x % 9 + 1
+		x //= 9
+		n = x * 10 + last_digit
+	else:
+		n = x + 1
+	while exponent > 0:
+		n *= 10
+		exponent -= 1
+	return n
+
+
+def decompress_pubkey(x: bytes, is_odd: bool) -> bytes:
+	"""
+	Recover the uncompressed public key (i.e., 04 + x + y) from its x coordinate
+	by solving y^2 = x^3 + 7 on secp256k1. As p % 4 == 3, the square root is
+	simply pow(y^2, (p + 1) / 4, p).
+	"""
+	x_int = int.from_bytes(x, byteorder='big')
+	y_square = (pow(x_int, 3, SECP256K1_P) + SECP256K1_B) % SECP256K1_P
+	y = pow(y_square, (SECP256K1_P + 1) // 4, SECP256K1_P)
+	if (y % 2 == 1) != is_odd:
+		y = SECP256K1_P - y
+	return b'\x04' + x + y.to_bytes(32, byteorder='big')
+
+
+def decompress_script(buffer, offset: int):
+	"""
+	Read a compressed script as written by ScriptCompression in Bitcoin Core.
+	Return the script and the offset after it.
+	"""
+	size, offset = utils.read_core_varint(buffer, offset)
+	if size == 0:  # P2PKH
+		script = b'\x76\xa9\x14' + bytes(buffer[offset:offset + 20]) + b'\x88\xac'
+		return script, offset + 20
+	if size == 1:  # P2SH
+		script = b'\xa9\x14' + bytes(buffer[offset:offset + 20]) + b'\x87'
+		return script, offset + 20
+	if size in (2, 3):  # P2PK with a compressed public key
+		script = b'\x21' + bytes([size]) + bytes(buffer[offset:offset + 32]) + b'\xac'
+		return script, offset + 32
+	if size in (4, 5):  # P2PK with an uncompressed public key
+		pubkey = decompress_pubkey(bytes(buffer[offset:offset + 32]), size == 5)
+		return b'\x41' + pubkey + b'\xac', offset + 32
+	size -= SPECIAL_SCRIPT_COUNT
+	return bytes(buffer[offset:offset + size]), offset + size
+
+
+class BlockUndo:
+	"""
+	The undo data of one block. The record is kept as a zero-copy memoryview of
+	the mmap-ed rev*.dat file and is only decoded when get_tx_undos() is called.
+	"""
+
+	def __init__(self, buffer, offset: int):
+		self.magic_number, self.undo_size = utils.magic_and_size_struct.unpack_from(buffer, offset)
+		self.offset = offset
+		self.data = buffer[offset + 8:offset + 8 + self.undo_size]
+		self.checksum = bytes(buffer[offset + 8 + self.undo_size:offset + 8 + self.undo_size + 32])
+		self.tx_undos = None
+
+	def get_record_size(self) -> int:
+		return 8 + self.undo_size + 32
+
+	def release(self):
+		"""
+		Release the view of the mapped file, e.g. before UndoFileReader.close()
+		while a traceback may still reference this object.
+		"""
+		self.data.release()
+
+	def verify(self, prev_block_hash: bytes) -> bool:
+		"""
+		Check that this record belongs to a block whose hashPrevBlock is the given
+		raw (i.e. little-endian) hash, e.g. BlockHeader.hash_prev_blk.
+		"""
+		return utils.double_sha256(prev_block_hash + bytes(self.data)) == self.checksum
+
+	def get_tx_undos(self):
+		"""
+		Return a list with one list of SpentOutput per non-coinbase transaction of
+		the block, in the same order as the transactions and their inputs.
+		"""
+		if self.tx_undos is not None:
+			return self.tx_undos
+		data = self.data
+		tx_count, pos = utils.unpack_variable_int_from(data, 0)
+		self.tx_undos = []
+		for i in range(tx_count):
+			spent_count, pos = utils.unpack_variable_int_from(data, pos)
+			spent_outputs = []
+			for j in range(spent_count):
+				code, pos = utils.read_core_varint(data, pos)
+				height = code >> 1
+				if height > 0:
+					# A dummy transaction version kept for backward compatibility
+					_, pos = utils.read_core_varint(data, pos)
+				compressed_amount, pos = utils.read_core_varint(data, pos)
+				script_pubkey, pos = decompress_script(data, pos)
+				spent_outputs.append(SpentOutput(
+					decompress_amount(compressed_amount), script_pubkey, height, code & 1 == 1
+				))
+			self.tx_undos.append(spent_outputs)
+		return self.tx_undos
+
+
+class UndoFileReader:
+	"""
+	Read a rev*.dat file through mmap, either sequentially with iter() or at an
+	offset known from the block index (BlockIndexEntry.undo_pos).
+	BlockUndo objects are views of the mapped file, so they must be released
+	before close() is called. SpentOutput objects are independent copies.
+	"""
+
+	def __init__(self, file_path: str):
+		self.file = open(file_path, 'rb')
+		self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		self.buffer = memoryview(self.mmap)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		self.buffer.release()
+		self.mmap.close()
+		self.file.close()
+
+	def __iter__(self):
+		offset = 0
+		while offset + 8 <= len(self.buffer):
+			magic_number, undo_size = utils.magic_and_size_struct.unpack_from(self.buffer, offset)
+			if magic_number == 0 or offset + 8 + undo_size + 32 > len(self.buffer):
+				# Zero-filled preallocated tail or an incomplete last record
+				return
+			block_undo = BlockUndo(self.buffer, offset)
+			yield block_undo
+			offset += block_undo.get_record_size()
+
+	def read_at(self, undo_pos: int) -> BlockUndo:
+		"""
+		Like BlockIndexEntry.data_pos, undo_pos points to the data right after the
+		magic number and size.
+		"""
+		return BlockUndo(self.buffer, undo_pos - 8)
+
+
+def attach_undo(block: Block, block_undo: BlockUndo):
+	"""
+	Set txInput.prev_output of every input and Transaction.fee of every
+	transaction of block. The coinbase transaction has no undo data, its fee is
+	left as None.
+	"""
+	if block_undo.verify(block.block_header.hash_prev_blk) is False:
+		raise ValueError('Undo data does not belong to block '
+			f'{utils.convert_endianness(block.curr_block_hash).hex()}')
+	tx_undos = block_undo.get_tx_undos()
+	if len(tx_undos) != len(block.transactions) - 1:
+		raise ValueError(f'Undo data has {len(tx_undos)} transactions but the block has '
+			f'{len(block.transactions) - 1} non-coinbase transactions')
+	for transaction, spent_outputs in zip(block.transactions[1:], tx_undos):
+		if len(spent_outputs) != len(transaction.inputs):
+			raise ValueError(f'Undo data has {len(spent_outputs)} spent outputs but transaction '
+				f'{transaction.tx_hash} has {len(transaction.inputs)} inputs')
+	for transaction, spent_outputs in zip(block.transactions[1:], tx_undos):
+		for tx_input, spent_output in zip(transaction.inputs, spent_outputs):
+			tx_input.prev_output = spent_output
+		transaction.fee = (sum(o.value for o in spent_outputs) -
+			sum(o.value for o in transaction.outputs))
+
+
+def get_block_fees(location: tuple):
+	"""
+	Parse one block and its undo data. location is (height, blk*.dat path,
+	data_pos, rev*.dat path, undo_pos), so that this function only depends on
+	picklable arguments and can be used by a multiprocessing.Pool.
+	"""
+	height, block_path, data_pos, undo_path, undo_pos = location
+	with open(block_path, 'rb') as block_reader:
+		block_reader.seek(data_pos - 8)
+		block = Block(block_reader)
+	with UndoFileReader(undo_path) as undo_reader:
+		attach_undo(block, undo_reader.read_at(undo_pos))
+		fees = [t.fee for t in block.transactions[1:]]
+	return height, utils.convert_endianness(block.curr_block_hash).hex(), sum(fees), len(fees)
+
+
+def compute_fees_in_parallel(blocks_dir: str, start_height: int, end_height: int, processes: int):
+	"""
+	Compute the total fees of blocks [start_height, end_height] on the active
+	chain. As each block comes with its own undo data, blocks are independent of
+	each other and no UTXO set replay is needed.
+	"""
+	from blockindex import BlockIndex
+
+	block_index = BlockIndex(blocks_dir)
+	locations = []
+	for height in range(start_height, end_height + 1):
+		entry = block_index.get_by_height(height)
+		if entry.undo_pos is None:
+			# The genesis block has no undo data as its output is unspendable
+			continue
+		locations.append((
+			height, block_index.get_block_file_path(entry), entry.data_pos,
+			block_index.get_undo_file_path(entry), entry.undo_pos
+		))
+	with multiprocessing.Pool(processes) as pool:
+		for result in pool.imap(get_block_fees, locations, chunksize=16):
+			yield result
+
+
+def main():
+
+	ap = argparse.ArgumentParser()
+	ap.add_argument(
+		'--blocks-dir', dest='blocks-dir', required=True,
+		help="The blocks/ directory as managed by Bitcoin Core."
+	)
+	ap.add_argument('--start-height', dest='start-height', default=0, help="First height to parse.")
+	ap.add_argument('--end-height', dest='end-height', required=True, help="Last height to parse.")
+	ap.add_argument(
+		'--processes', dest='processes', default=os.cpu_count(),
+		help="Number of worker processes."
+	)
+	args = vars(ap.parse_args())
+	blocks_dir = str(args['blocks-dir'])
+
+	if os.path.isdir(blocks_dir) is False:
+		raise FileNotFoundError(f"[{blocks_dir}] does not exist")
+	for height, block_hash, fee, tx_count in compute_fees_in_parallel(
+		blocks_dir, int(args['start-height']), int(args['end-height']), int(args['processes'])
+	):
+		print(f"{height} {block_hash} Fees: {fee:,} Satoshi ({tx_count} transactions)")
+
+
+if __name__ == '__main__':
+	main()
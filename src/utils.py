@@ -1,7 +1,9 @@
+from opcodes import *
+
 import io
 import struct
+import typing
 from hashlib import *
-import base58
 import hashlib
 
 # * Native byte order is big-endian or little-endian, depending on the host system.
@@ -10,6 +12,81 @@ import hashlib
 #   ARM and Intel Itanium feature switchable endianness (bi-endian).
 #   Use sys.byteorder to check the endianness of your system.
 
+# Precompiled structs of the fixed-layout parts of blk*.dat files. Compiling a
+# format string once instead of on every struct.unpack() call matters as
+# field decoding is the inner loop of every scan. '<' means little-endian
+# with standard sizes and no alignment, regardless of the host system.
+uint16_struct = struct.Struct('<H')
+uint32_struct = struct.Struct('<I')
+uint64_struct = struct.Struct('<Q')
+magic_and_size_struct = struct.Struct('<II')
+"""
+The magic number and block size in front of every block (and undo record).
+"""
+NETWORK_MAGICS = {
+	0xd9b4bef9: 'mainnet',
+	0x0709110b: 'testnet3',
+	0x283f161c: 'testnet4',
+	0x40cf030a: 'signet',
+	0xdab5bffa: 'regtest'
+}
+"""
+Magic numbers (as read by read_4bytes_as_uint()) of the networks supported by
+Bitcoin Core. Signet's is the one of the default signet.
+"""
+MAX_BLOCK_SERIALIZED_SIZE = 4000000
+block_header_struct = struct.Struct('<I32s32sIII')
+"""
+version, hashPrevBlock, hashMerkleRoot, timestamp, bits and nonce, 80 bytes
+"""
+outpoint_struct = struct.Struct('<32sI')
+"""
+The previous transaction hash and output index of a transaction input, 36 bytes
+"""
+
+class BytesReader:
+	"""
+	A minimal file-like reader over bytes, bytearray or memoryview, so that raw
+	blocks and transactions received over the network (e.g., ZMQ rawblock/rawtx
+	or RPC hex) are decoded by the same classes as blk*.dat files, without
+	being written to a file or copied into an io.BytesIO first.
+	"""
+
+	def __init__(self, buffer, offset: int = 0):
+		self.buffer = memoryview(buffer)
+		self.pos = offset
+
+	def read(self, size: int = -1) -> bytes:
+		if size < 0:
+			end = len(self.buffer)
+		else:
+			end = min(self.pos + size, len(self.buffer))
+		data = self.buffer[self.pos:end].tobytes()
+		self.pos = end
+		return data
+
+	def tell(self) -> int:
+		return self.pos
+
+	def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+		if whence == io.SEEK_SET:
+			self.pos = offset
+		elif whence == io.SEEK_CUR:
+			self.pos += offset
+		elif whence == io.SEEK_END:
+			self.pos = len(self.buffer) + offset
+		else:
+			raise ValueError(f'Invalid whence ({whence})')
+		return self.pos
+
+
+Reader = typing.Union[io.BufferedReader, BytesReader]
+READER_TYPES = (io.BufferedReader, BytesReader)
+"""
+Every class of block.py reads from one of these
+"""
+
+
 class SignatureParser:
 	@staticmethod
 	def parse_element(hex_str, offset, element_size):
@@ -68,6 +145,9 @@ class SignatureParser:
 class Pubkey2Address:
 	@staticmethod
 	def convert_public_key_hash_to_address(prefix, addr):
+			# Imported here so that tools that never print addresses start faster
+			import base58
+
 			data = prefix + addr
 			return base58.b58encode(data + double_sha256(data)[:4])
 
@@ -80,11 +160,16 @@ def get_pubkey_hash(pubkey_hex):
 	Implements the OP_HASH160 operation in Bitcoin script
 	"""
 	pubkey = bytearray.fromhex(pubkey_hex)
-	round1 = sha256(pubkey).digest()
+	return hash160(pubkey)
+
+def hash160(array: bytes) -> bytes:
+	"""
+	RIPEMD160(SHA256(array)), i.e., the OP_HASH160 operation on raw bytes
+	"""
+	round1 = sha256(array).digest()
 	h = new('ripemd160')
 	h.update(round1)
-	pubkey_hash = h.digest()
-	return pubkey_hash
+	return h.digest()
 
 def double_sha256(array: bytes) -> bytes:
 	"""
@@ -112,13 +197,26 @@ def difficulty(num):
   return 0x00ffff0000000000000000000000000000000000000000000000000000 / nbits(num)
 
 
+def read_struct(reader: Reader, struct_: struct.Struct) -> tuple:
+	"""
+	Unpack struct_ at the position of reader and move past it. From a
+	BytesReader this is struct_.unpack_from() on its buffer, so unlike
+	read() + unpack() no bytes object is allocated per field. Block() decodes
+	blocks of blk*.dat files from a BytesReader too, this is the hot path.
+	"""
+	if type(reader) is BytesReader:
+		pos = reader.pos
+		reader.pos = pos + struct_.size
+		return struct_.unpack_from(reader.buffer, pos)
+	return struct_.unpack(reader.read(struct_.size))
+
 def read_2bytes_as_uint(reader):
-	res = struct.unpack('<H', reader.read(2))[0]
+	res = read_struct(reader, uint16_struct)[0]
 	return res
 
-def read_4bytes_as_uint(reader: io.BufferedReader) -> int:
-	assert isinstance(reader, io.BufferedReader)
-	res = struct.unpack('<I', reader.read(4))[0]
+def read_4bytes_as_uint(reader: Reader) -> int:
+	assert isinstance(reader, READER_TYPES)
+	res = read_struct(reader, uint32_struct)[0]
 
 	# format string 'I' means unsigned int and '<' means read bytes following
 	# little-endian byte order.
@@ -135,10 +233,10 @@ def read_4bytes_as_uint(reader: io.BufferedReader) -> int:
 	return res
 
 def uint8(stream):
-	return struct.unpack('Q', stream.read(8))[0]
+	return read_struct(stream, uint64_struct)[0]
 
 def read_32bytes(reader, to_big_endian=False):
-	assert isinstance(reader, io.BufferedReader)
+	assert isinstance(reader, READER_TYPES)
 	# My understanding is that Bitcoin Core stores data in little-endian order,
 	# slice syntax: array[ <first element to include> : <first element to exclude> : <step>]
 	# so if we want Big Endian, we use step=-1
@@ -146,8 +244,8 @@ def read_32bytes(reader, to_big_endian=False):
 	assert isinstance(array, bytes)
 	return array
 
-def read_bytes_as_variable_int(reader: io.BufferedReader):
-	assert isinstance(reader, io.BufferedReader)
+def read_bytes_as_variable_int(reader: Reader):
+	assert isinstance(reader, READER_TYPES)
 	# seems the rule is like this:
 	# * If the number < 253 (0xFD), store it in 1 byte, left-padded with zeros.
   # * If the number fits in 16 bits (but is greater than 252), store it in 3 
@@ -157,8 +255,13 @@ def read_bytes_as_variable_int(reader: io.BufferedReader):
 	# * If the number fits in 64 bits (but not 8, 16, or 32), store it in 9 bytes:
 	#   a 1-byte value 255 (0xFF) followed by the 8 byte little-endian number
 	# reference: https://reference.cash/protocol/formats/variable-length-integer
-	size = ord(reader.read(1))
+	if type(reader) is BytesReader:
+		value, reader.pos = unpack_variable_int_from(reader.buffer, reader.pos)
+		return value
+	size = reader.read(1)[0]
 
+	# The single-byte case is by far the most common one (e.g., input/output
+	# counts and script lengths), so it is checked first.
 	if size < 0xfd: # decimal 253, binary 11111101
 		return size
 	if size == 0xfd: # decimal 253, binary 11111101
@@ -170,6 +273,66 @@ def read_bytes_as_variable_int(reader: io.BufferedReader):
 	raise ValueError('Datafile seems corrupt')
 
 
+def unpack_variable_int_from(buffer, offset: int):
+	"""
+	The same as read_bytes_as_variable_int() but reads from a bytes-like object
+	(e.g., a memoryview of an mmap-ed file) instead of a stream. Return the
+	value and the offset after it.
+	"""
+	size = buffer[offset]
+	if size < 0xfd:
+		return size, offset + 1
+	if size == 0xfd:
+		return uint16_struct.unpack_from(buffer, offset + 1)[0], offset + 3
+	if size == 0xfe:
+		return uint32_struct.unpack_from(buffer, offset + 1)[0], offset + 5
+	return uint64_struct.unpack_from(buffer, offset + 1)[0], offset + 9
+
+
+def read_core_varint(buffer, offset: int):
+	"""
+	Read Bitcoin Core's own VARINT as defined in its src/serialize.h. It is
+	big-endian base-128 and every continuation adds one so that each value has
+	exactly one encoding. It is used by the block index, the undo files and the
+	UTXO set but NOT by blocks and transactions, which use the variable-length
+	integer read by read_bytes_as_variable_int() instead.
+	Return the value and the offset after it.
+	"""
+	result = 0
+	while True:
+		byte = buffer[offset]
+		offset += 1
+		result = (result << 7) | (byte & 0x7f)
+		if byte & 0x80:
+			result += 1
+		else:
+			return result, offset
+
+
+def find_next_magic(buffer, start: int, magic_numbers, next_positions: dict = None):
+	"""
+	Return the offset of the first of magic_numbers at or after start in
+	buffer (e.g., an mmap-ed blk*.dat file), or None if there is none.
+	bytes.find()/mmap.find() do the searching, so skipping even hundreds of MB
+	of zero-filled or corrupt data is fast. Pass the same next_positions dict to
+	consecutive calls with increasing start, so that the search for a magic
+	number that is far ahead (or absent) is not repeated every time.
+	"""
+	if next_positions is None:
+		next_positions = {}
+	result = None
+	for magic_number in magic_numbers:
+		pos = next_positions.get(magic_number, -1)
+		if pos is not None and pos < start:
+			pos = buffer.find(uint32_struct.pack(magic_number), start)
+			if pos < 0:
+				pos = None
+			next_positions[magic_number] = pos
+		if pos is not None and (result is None or pos < result):
+			result = pos
+	return result
+
+
 def get_bytes_from_variable_int(varint: int) -> bytes:
 	'''
 	The reverse of read_bytes_as_variable_int(): we get the bytes representation
@@ -179,11 +342,11 @@ def get_bytes_from_variable_int(varint: int) -> bytes:
 	if varint < 0xfd:
 		varint_bytes = varint.to_bytes(1, byteorder='little')
 	elif varint < 2**16: # Not quite sure if there should be < or <= ...
-		varint_bytes = (0xfd).to_bytes(1, byteorder='little') + struct.pack("<H", varint)
+		varint_bytes = (0xfd).to_bytes(1, byteorder='little') + uint16_struct.pack(varint)
 	elif varint < 2**32:
-		varint_bytes = (0xfe).to_bytes(1, byteorder='little') + struct.pack("<I", varint) 
+		varint_bytes = (0xfe).to_bytes(1, byteorder='little') + uint32_struct.pack(varint)
 	elif varint < 2**64:
-		varint_bytes = (0xff).to_bytes(1, byteorder='little') + struct.pack("Q", varint)
+		varint_bytes = (0xff).to_bytes(1, byteorder='little') + uint64_struct.pack(varint)
 	else:
 		raise ValueError(f'{varint} seems invalid for the purpose of Bitcoin')
 	return varint_bytes
@@ -202,6 +365,50 @@ def get_target_hash_by_difficulty(difficulty: bytes) -> int:
 	assert isinstance(res, int)
 	return res
 
+def classify_script_pubkey(script: bytes):
+	"""
+	Match a scriptPubKey against the standard templates, following Solver() in
+	Bitcoin Core's src/script/solver.cpp. Return (type, payload) where type is
+	one of the TX_* constants in opcodes.py and payload is the part of the script
+	that identifies its owner (e.g., the PubkeyHash of a P2PKH script), or None.
+	"""
+	length = len(script)
+	if (length == 25 and script[0] == OP_DUP and script[1] == OP_HASH160 and
+		script[2] == 20 and script[23] == OP_EQUALVERIFY and script[24] == OP_CHECKSIG):
+		return TX_PUBKEYHASH, script[3:23]
+	if length == 23 and script[0] == OP_HASH160 and script[1] == 20 and script[22] == OP_EQUAL:
+		return TX_SCRIPTHASH, script[2:22]
+	if length in (35, 67) and script[0] == length - 2 and script[-1] == OP_CHECKSIG:
+		return TX_PUBKEY, script[1:-1]
+	if length == 22 and script[0] == OP_0 and script[1] == 20:
+		return TX_WITNESS_V0_KEYHASH, script[2:]
+	if length == 34 and script[0] == OP_0 and script[1] == 32:
+		return TX_WITNESS_V0_SCRIPTHASH, script[2:]
+	if length == 34 and script[0] == OP_1 and script[1] == 32:
+		return TX_WITNESS_V1_TAPROOT, script[2:]
+	if 4 <= length <= 42 and OP_1 <= script[0] <= OP_16 and script[1] == length - 2:
+		return TX_WITNESS_UNKNOWN, script[2:]
+	if length > 0 and script[0] == OP_RETURN:
+		return TX_NULLDATA, script[1:]
+	if (length >= 3 and OP_1 <= script[0] <= OP_16 and OP_1 <= script[-2] <= OP_16 and
+		script[-1] == OP_CHECKMULTISIG):
+		return TX_MULTISIG, None
+	return TX_NONSTANDARD, None
+
+def get_address_from_script_type(script_type: str, payload: bytes):
+	"""
+	Derive the legacy (i.e., Base58Check) address of an output from the
+	(type, payload) returned by classify_script_pubkey(). Return None for types
+	that have no such address.
+	"""
+	if script_type == TX_PUBKEYHASH:
+		return Pubkey2Address.convert_public_key_hash_to_address(b'\x00', bytes(payload)).decode()
+	if script_type == TX_SCRIPTHASH:
+		return Pubkey2Address.convert_public_key_hash_to_address(b'\x05', bytes(payload)).decode()
+	if script_type == TX_PUBKEY:
+		return Pubkey2Address.PubkeyToAddress(bytes(payload).hex()).decode()
+	return None
+
 def convert_endianness(array: bytes):
 	"""
 	Switch between big-endian order and little-endian order. 
@@ -0,0 +1,349 @@
+"""
+Build small chains in Bitcoin Core's on-disk formats: blocks as stored in
+blk*.dat, undo records as stored in rev*.dat and the values of the block
+index (blocks/index/). The builder does not import anything from src/, so
+that the tests compare the parsers against an independent implementation.
+"""
+
+import hashlib
+import struct
+
+MAINNET_MAGIC = 0xd9b4bef9
+REGTEST_BITS = 0x207fffff
+COIN = 100_000_000
+SUBSIDY = 50 * COIN
+FEE = 10_000
+GENESIS_TIME = 1296688602
+
+# Flags of CBlockIndex::nStatus, see Bitcoin Core's src/chain.h
+BLOCK_VALID_TREE = 2
+BLOCK_VALID_SCRIPTS = 5
+BLOCK_HAVE_DATA = 8
+BLOCK_HAVE_UNDO = 16
+BLOCK_FAILED_VALID = 32
+BLOCK_FAILED_CHILD = 64
+
+CLIENT_VERSION = 259900
+
+
+def double_sha256(data: bytes) -> bytes:
+	return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+
+def hash160(data: bytes) -> bytes:
+	return hashlib.new('ripemd160', hashlib.sha256(data).digest()).digest()
+
+
+def compact_size(n: int) -> bytes:
+	if n < 0xfd:
+		return bytes([n])
+	if n <= 0xffff:
+		return b'\xfd' + struct.pack('<H', n)
+	if n <= 0xffffffff:
+		return b'\xfe' + struct.pack('<I', n)
+	return b'\xff' + struct.pack('<Q', n)
+
+
+def core_varint(n: int) -> bytes:
+	"""
+	WriteVarInt() of Bitcoin Core's src/serialize.h
+	"""
+	out = [n & 0x7f]
+	while n > 0x7f:
+		n = (n >> 7) - 1
+		out.append((n & 0x7f) | 0x80)
+	return bytes(reversed(out))
+
+
+def compress_amount(n: int) -> int:
+	"""
+	CompressAmount() of Bitcoin Core's src/compressor.cpp
+	"""
+	if n == 0:
+		return 0
+	e = 0
+	while n % 10 == 0 and e < 9:
+		n //= 10
+		e += 1
+	if e < 9:
+		d = n % 10
+		n //= 10
+		return 1 + (n * 9 + d - 1) * 10 + e
+	return 1 + (n - 1) * 10 + 9
+
+
+def compress_script(script: bytes) -> bytes:
+	"""
+	ScriptCompression of Bitcoin Core's src/compressor.h
+	"""
+	if len(script) == 25 and script[:3] == b'\x76\xa9\x14' and script[23:] == b'\x88\xac':
+		return b'\x00' + script[3:23]
+	if len(script) == 23 and script[:2] == b'\xa9\x14' and script[22:] == b'\x87':
+		return b'\x01' + script[2:22]
+	if len(script) == 35 and script[0] == 33 and script[1] in (2, 3) and script[34] == 0xac:
+		return bytes([script[1]]) + script[2:34]
+	if len(script) == 67 and script[0] == 65 and script[1] == 4 and script[66] == 0xac:
+		return bytes([4 | (script[65] & 1)]) + script[2:34]
+	return core_varint(len(script) + 6) + script
+
+
+def p2pkh(pubkey: bytes) -> bytes:
+	return b'\x76\xa9\x14' + hash160(pubkey) + b'\x88\xac'
+
+
+def p2sh(script: bytes) -> bytes:
+	return b'\xa9\x14' + hash160(script) + b'\x87'
+
+
+def op_return(data: bytes) -> bytes:
+	return b'\x6a' + bytes([len(data)]) + data
+
+
+def make_pubkey(n: int) -> bytes:
+	"""
+	A compressed public key as far as the parsers are concerned, it does not
+	need to be on the curve.
+	"""
+	return b'\x02' + hashlib.sha256(b'key' + n.to_bytes(4, 'little')).digest()
+
+
+def make_script_sig(pubkey: bytes) -> bytes:
+	"""
+	<DER signature + SIGHASH_ALL> <pubkey>, as spending a P2PKH output
+	"""
+	r = hashlib.sha256(b'r' + pubkey).digest()
+	s = hashlib.sha256(b's' + pubkey).digest()
+	# Keep both integers positive, i.e., the top bit clear
+	r, s = b'\x01' + r[1:], b'\x01' + s[1:]
+	signature = b'\x30\x44\x02\x20' + r + b'\x02\x20' + s + b'\x01'
+	return bytes([len(signature)]) + signature + bytes([len(pubkey)]) + pubkey
+
+
+class Tx:
+
+	def __init__(self, inputs: list, outputs: list, lock_time: int = 0, version: int = 1,
+		witnesses: list = None):
+		"""
+		inputs are (raw prev txid, output index, scriptSig), outputs are (value,
+		scriptPubKey). witnesses, if given, holds the list of witness items of
+		every input and selects the BIP144 serialization.
+		"""
+		self.inputs = inputs
+		self.outputs = outputs
+		self.lock_time = lock_time
+		self.version = version
+		self.witnesses = witnesses
+
+	def serialize(self, include_witness: bool = True) -> bytes:
+		include_witness = include_witness and self.witnesses is not None
+		data = struct.pack('<I', self.version)
+		if include_witness:
+			data += b'\x00\x01'
+		data += compact_size(len(self.inputs))
+		for prev_txid, index, script_sig in self.inputs:
+			data += prev_txid + struct.pack('<I', index) + compact_size(len(script_sig)) + script_sig
+			data += b'\xff\xff\xff\xff'
+		data += compact_size(len(self.outputs))
+		for value, script in self.outputs:
+			data += struct.pack('<Q', value) + compact_size(len(script)) + script
+		if include_witness:
+			for items in self.witnesses:
+				data += compact_size(len(items))
+				for item in items:
+					data += compact_size(len(item)) + item
+		return data + struct.pack('<I', self.lock_time)
+
+	def txid(self) -> bytes:
+		"""
+		The raw (i.e. little-endian) txid
+		"""
+		return double_sha256(self.serialize(include_witness=False))
+
+
+def coinbase(height: int, value: int, script: bytes, tag: bytes = b'') -> Tx:
+	# BIP34 height push, so that coinbase transactions of different heights differ
+	script_sig = b'\x04' + struct.pack('<I', height) + tag
+	return Tx([(b'\x00' * 32, 0xffffffff, script_sig)], [(value, script)])
+
+
+def merkle_root(txids: list) -> bytes:
+	while len(txids) > 1:
+		if len(txids) % 2 == 1:
+			txids = txids + [txids[-1]]
+		txids = [double_sha256(txids[i] + txids[i + 1]) for i in range(0, len(txids), 2)]
+	return txids[0]
+
+
+def make_header(prev_hash: bytes, txs: list, timestamp: int) -> bytes:
+	"""
+	Return an 80-byte header whose hash meets the regtest target
+	"""
+	root = merkle_root([tx.txid() for tx in txs])
+	target = (REGTEST_BITS & 0xffffff) << (8 * ((REGTEST_BITS >> 24) - 3))
+	nonce = 0
+	while True:
+		header = struct.pack('<I32s32sIII', 1, prev_hash, root, timestamp, REGTEST_BITS, nonce)
+		if int.from_bytes(double_sha256(header), 'little') <= target:
+			return header
+		nonce += 1
+
+
+def serialize_block(header: bytes, txs: list) -> bytes:
+	return header + compact_size(len(txs)) + b''.join(tx.serialize() for tx in txs)
+
+
+def serialize_block_undo(spent_outputs: list) -> bytes:
+	"""
+	CBlockUndo of a block. spent_outputs has one list of (height, is coinbase,
+	value, scriptPubKey) per non-coinbase transaction.
+	"""
+	data = compact_size(len(spent_outputs))
+	for coins in spent_outputs:
+		data += compact_size(len(coins))
+		for height, is_coinbase, value, script in coins:
+			data += core_varint(height * 2 + (1 if is_coinbase else 0))
+			if height > 0:
+				data += core_varint(0)  # dummy transaction version
+			data += core_varint(compress_amount(value)) + compress_script(script)
+	return data
+
+
+def undo_record(prev_block_hash: bytes, block_undo: bytes, magic: int = MAINNET_MAGIC) -> bytes:
+	"""
+	A record of rev*.dat as written by WriteUndoDataForBlock(): the checksum
+	commits to the hash of the PREVIOUS block.
+	"""
+	return (struct.pack('<II', magic, len(block_undo)) + block_undo +
+		double_sha256(prev_block_hash + block_undo))
+
+
+def disk_block_index(height: int, status: int, tx_count: int, header: bytes,
+	file_number: int = None, data_pos: int = None, undo_pos: int = None) -> bytes:
+	"""
+	The value of a 'b' + hash entry of the block index, i.e. CDiskBlockIndex
+	"""
+	value = core_varint(CLIENT_VERSION) + core_varint(height) + core_varint(status) + core_varint(tx_count)
+	if status & (BLOCK_HAVE_DATA | BLOCK_HAVE_UNDO):
+		value += core_varint(file_number)
+	if status & BLOCK_HAVE_DATA:
+		value += core_varint(data_pos)
+	if status & BLOCK_HAVE_UNDO:
+		value += core_varint(undo_pos)
+	return value + header
+
+
+class FixtureBlock:
+
+	def __init__(self, name: str, height: int, prev_hash: bytes, txs: list, spent_outputs: list,
+		status: int, file_number: int = None):
+		self.name = name
+		self.height = height
+		self.prev_hash = prev_hash
+		self.txs = txs
+		self.spent_outputs = spent_outputs
+		self.status = status
+		self.file_number = file_number
+		self.header = make_header(prev_hash, txs, GENESIS_TIME + 600 * height + len(name))
+		self.hash = double_sha256(self.header)
+		self.data_pos = None
+		self.undo_pos = None
+
+	def serialize(self) -> bytes:
+		return serialize_block(self.header, self.txs)
+
+
+def build_fixture_chain() -> list:
+	"""
+	The chain of tests/data/blocks, see tests/data/make_blocks.py. Returns
+	FixtureBlock objects in the order they are stored in blk*.dat:
+	  - the active chain, heights 0 to 11: heights 0-6 in blk00000.dat and
+	    7-11 in blk00001.dat,
+	  - a stale branch s9, s10 on top of height 8, stored among the blocks of
+	    the active chain,
+	  - x12, a block on top of the tip that failed validation, and x13, a
+	    header-only child of it.
+	Coinbase outputs of height h pay to P2PKH(make_pubkey(h)). Spending
+	transactions merge input addresses as follows:
+	  - height 3 spends the coinbase outputs of heights 1 and 2,
+	  - height 5 spends those of heights 3 and 4,
+	  - height 7 spends the coinbase of height 6 and the output of height 3's
+	    transaction, which pays to make_pubkey(2) again,
+	  - height 9 spends the coinbase of height 7 alone,
+	  - height 10 spends the coinbase of height 8 and the output of height 9's
+	    transaction, which pays to make_pubkey(4).
+	The coinbase of height 10 claims 1 Satoshi less than it could.
+	"""
+	blocks = []
+	coinbase_outputs = {}  # height -> (txid, value, script)
+
+	def add_block(name, height, prev_hash, spends, status, file_number, claimed=0, coinbase_tag=b''):
+		spent_outputs = []
+		txs = []
+		fees = 0
+		for inputs, outputs in spends:
+			tx = Tx(
+				[(txid, index, make_script_sig(pubkey)) for txid, index, pubkey, _, _, _ in inputs],
+				outputs
+			)
+			spent_outputs.append([(h, is_coinbase, value, p2pkh(pubkey))
+				for _, _, pubkey, h, is_coinbase, value in inputs])
+			fees += sum(i[5] for i in inputs) - sum(value for value, _ in outputs)
+			txs.append(tx)
+		cb = coinbase(height, SUBSIDY + fees - claimed, p2pkh(make_pubkey(height)), coinbase_tag)
+		block = FixtureBlock(name, height, prev_hash, [cb] + txs, spent_outputs, status, file_number)
+		blocks.append(block)
+		return block
+
+	def coinbase_input(height):
+		return (chain[height].txs[0].txid(), 0, make_pubkey(height), height, True, chain[height].txs[0].outputs[0][0])
+
+	full = BLOCK_VALID_SCRIPTS | BLOCK_HAVE_DATA | BLOCK_HAVE_UNDO
+	chain = []
+	prev_hash = b'\x00' * 32
+	for height in range(12):
+		spends = []
+		if height == 3:
+			spends = [([coinbase_input(1), coinbase_input(2)],
+				[(2 * SUBSIDY - FEE, p2pkh(make_pubkey(2))), (0, op_return(b'hello'))])]
+		elif height == 5:
+			spends = [([coinbase_input(3), coinbase_input(4)], [(SUBSIDY, p2sh(b'\x51')), (SUBSIDY, p2pkh(make_pubkey(4)))])]
+		elif height == 7:
+			tx3 = chain[3].txs[1]
+			spends = [([coinbase_input(6), (tx3.txid(), 0, make_pubkey(2), 3, False, tx3.outputs[0][0])],
+				[(3 * SUBSIDY - 3 * FEE, p2pkh(make_pubkey(100)))])]
+		elif height == 9:
+			spends = [([coinbase_input(7)], [(SUBSIDY - FEE, p2pkh(make_pubkey(4)))])]
+		elif height == 10:
+			tx9 = chain[9].txs[1]
+			spends = [([coinbase_input(8), (tx9.txid(), 0, make_pubkey(4), 9, False, tx9.outputs[0][0])],
+				[(2 * SUBSIDY - 3 * FEE, p2pkh(make_pubkey(101)))])]
+		block = add_block(f'{height}', height, prev_hash, spends,
+			BLOCK_VALID_SCRIPTS | BLOCK_HAVE_DATA if height == 0 else full, 0 if height < 7 else 1,
+			claimed=1 if height == 10 else 0)
+		chain.append(block)
+		prev_hash = block.hash
+		if height == 8:
+			# The stale branch was connected once, so it has undo data as well
+			s9 = add_block('s9', 9, block.hash, [([coinbase_input(7)], [(SUBSIDY - FEE, p2pkh(make_pubkey(200)))])],
+				full, 1, coinbase_tag=b'stale')
+		if height == 9:
+			add_block('s10', 10, s9.hash, [], full, 1, coinbase_tag=b'stale')
+	x12 = add_block('x12', 12, prev_hash, [], BLOCK_VALID_TREE | BLOCK_FAILED_VALID | BLOCK_HAVE_DATA, 1)
+	add_block('x13', 13, x12.hash, [], BLOCK_VALID_TREE | BLOCK_FAILED_CHILD, None)
+
+	# Lay out blk*.dat and rev*.dat in storage order
+	sizes = {}
+	undo_sizes = {}
+	for block in blocks:
+		if block.status & BLOCK_HAVE_DATA:
+			block.data_pos = sizes.get(block.file_number, 0) + 8
+			sizes[block.file_number] = block.data_pos + len(block.serialize())
+		if block.status & BLOCK_HAVE_UNDO:
+			block.undo_pos = undo_sizes.get(block.file_number, 0) + 8
+			undo_sizes[block.file_number] = (block.undo_pos +
+				len(serialize_block_undo(block.spent_outputs)) + 32)
+	return blocks
+
+
+def get_active_chain(blocks: list) -> list:
+	return [block for block in blocks if block.name.isdigit()]
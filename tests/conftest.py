@@ -0,0 +1,38 @@
+import json
+import os
+import pytest
+import shutil
+import sys
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# The modules of src/ import each other by name, as they do when run as scripts
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'src'))
+
+import builder
+
+FIXTURE_BLOCKS_DIR = os.path.join(TESTS_DIR, 'data', 'blocks')
+
+# A subset of Bitcoin Core's src/test/data/blockfilters.json (testnet3 blocks):
+# (height, hash, block, spent scripts, previous filter header, filter, filter
+# header, notes). The first row of the file describes the columns.
+with open(os.path.join(TESTS_DIR, 'data', 'blockfilters.json')) as f:
+	BLOCK_FILTER_VECTORS = json.load(f)[1:]
+WITNESS_BLOCK_VECTOR = next(v for v in BLOCK_FILTER_VECTORS if v[-1] == 'Includes witness data')
+
+
+@pytest.fixture(scope='session')
+def fixture_chain():
+	"""
+	FixtureBlock objects of tests/data/blocks, see builder.build_fixture_chain()
+	"""
+	return builder.build_fixture_chain()
+
+
+@pytest.fixture
+def blocks_dir(tmp_path):
+	"""
+	A copy of tests/data/blocks that a test may modify
+	"""
+	path = tmp_path / 'blocks'
+	shutil.copytree(FIXTURE_BLOCKS_DIR, path)
+	return str(path)
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+"""
+Write tests/data/blocks, a blocks/ directory as managed by Bitcoin Core with
+the chain of builder.build_fixture_chain(), and tests/data/indexes/txindex,
+the txindex of its connected blocks. LevelDB databases are written with the
+LevelDB library (pip install plyvel) and without compression, as Bitcoin
+Core does. The output is committed, so this only needs to run again if the
+chain changes.
+"""
+
+import os
+import shutil
+import struct
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import builder
+
+
+def main():
+	import plyvel
+
+	data_dir = os.path.dirname(os.path.abspath(__file__))
+	blocks_dir = os.path.join(data_dir, 'blocks')
+	txindex_dir = os.path.join(data_dir, 'indexes', 'txindex')
+	shutil.rmtree(blocks_dir, ignore_errors=True)
+	shutil.rmtree(txindex_dir, ignore_errors=True)
+	os.makedirs(blocks_dir)
+	os.makedirs(txindex_dir)
+	blocks = builder.build_fixture_chain()
+	block_files = {}
+	undo_files = {}
+	for block in blocks:
+		if block.data_pos is not None:
+			raw = block.serialize()
+			block_files.setdefault(block.file_number, b'')
+			block_files[block.file_number] += struct.pack('<II', builder.MAINNET_MAGIC, len(raw)) + raw
+		if block.undo_pos is not None:
+			undo_files.setdefault(block.file_number, b'')
+			undo_files[block.file_number] += builder.undo_record(
+				block.prev_hash, builder.serialize_block_undo(block.spent_outputs)
+			)
+	for file_number, data in block_files.items():
+		if file_number == 0:
+			# Bitcoin Core preallocates blk*.dat files
+			data += b'\x00' * 4096
+		with open(os.path.join(blocks_dir, f'blk{file_number:05d}.dat'), 'wb') as f:
+			f.write(data)
+	for file_number, data in undo_files.items():
+		with open(os.path.join(blocks_dir, f'rev{file_number:05d}.dat'), 'wb') as f:
+			f.write(data)
+
+	db = plyvel.DB(os.path.join(blocks_dir, 'index'), create_if_missing=True, compression=None, block_size=256)
+	for i, block in enumerate(blocks):
+		db.put(b'b' + block.hash, builder.disk_block_index(
+			block.height, block.status, len(block.txs), block.header,
+			block.file_number, block.data_pos, block.undo_pos
+		))
+		if i == len(blocks) // 2:
+			# Half of the entries end up in a table (.ldb) file, the rest in the log
+			db.compact_range()
+	# Other records of the block index, which BlockIndex must skip
+	db.put(b'l', struct.pack('<I', 1))
+	db.put(b'R', b'0')
+	db.close()
+
+	# CDiskTxPos of every transaction of the blocks that were connected (i.e.
+	# have undo data), except the genesis block's, as TxIndex::CustomAppend()
+	db = plyvel.DB(txindex_dir, create_if_missing=True, compression=None)
+	for block in blocks:
+		if block.undo_pos is None:
+			continue
+		tx_offset = len(builder.compact_size(len(block.txs)))
+		for tx in block.txs:
+			db.put(b't' + tx.txid(), builder.core_varint(block.file_number) +
+				builder.core_varint(block.data_pos) + builder.core_varint(tx_offset))
+			tx_offset += len(tx.serialize())
+	db.close()
+
+	# Not needed to read the databases, LOG changes on every run
+	for db_dir in (os.path.join(blocks_dir, 'index'), txindex_dir):
+		for name in ('LOCK', 'LOG'):
+			os.remove(os.path.join(db_dir, name))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,100 @@
+from addrindex import AddressIndex, FUNDING, SPEND, build, funding_struct
+from blockindex import BlockIndex
+from conftest import FIXTURE_BLOCKS_DIR
+
+import builder
+import os
+import pytest
+
+
+def index_chain(index_dir: str, start_height: int = 0):
+	block_index = BlockIndex(FIXTURE_BLOCKS_DIR)
+	# A tiny buffer and merge factor, so that most blocks cause a flush and merges
+	address_index = AddressIndex(index_dir, buffer_size=1, merge_factor=2)
+	for height in range(start_height, block_index.get_height() + 1):
+		address_index.add_block(block_index.read_block(block_index.get_by_height(height)), height)
+	address_index.flush()
+	return address_index
+
+
+def test_history(fixture_chain, tmp_path):
+	active_chain = builder.get_active_chain(fixture_chain)
+	address_index = index_chain(str(tmp_path))
+	key = b'\x00' + builder.hash160(builder.make_pubkey(2))
+	history = address_index.get_history(key)
+	# The coinbase of height 2 is spent at height 3, which pays to the same
+	# address again, and that output is spent at height 7
+	assert [(posting['height'], posting['spent_by']['height']) for posting in history] == [(2, 3), (3, 7)]
+	assert history[1]['txid'] == active_chain[3].txs[1].txid()[::-1].hex()
+	assert history[1]['spent_by']['txid'] == active_chain[7].txs[1].txid()[::-1].hex()
+	assert len(address_index.meta['runs'][FUNDING]) <= 3
+	runs = set(address_index.meta['runs'][FUNDING] + address_index.meta['runs'][SPEND])
+	assert set(name for name in os.listdir(tmp_path) if name.endswith('.run')) == runs
+
+
+def test_flush_saves_meta_once(tmp_path, monkeypatch):
+	address_index = index_chain(str(tmp_path / 'expected'))
+	expected = address_index.get_history(b'\x00' + builder.hash160(builder.make_pubkey(4)))
+
+	index_dir = str(tmp_path / 'interrupted')
+	saved = []
+
+	def save_meta(self):
+		# Every run listed by the new meta.json is complete and the merged runs
+		# listed by the previous one still exist
+		assert self.meta['height'] == self.pending_height
+		for name in self.meta['runs'][FUNDING] + self.meta['runs'][SPEND]:
+			assert os.path.isfile(os.path.join(self.index_dir, name))
+		if self.meta['height'] == 6:
+			raise KeyboardInterrupt()
+		saved.append(self.meta['height'])
+		original_save_meta(self)
+
+	original_save_meta = AddressIndex.save_meta
+	monkeypatch.setattr(AddressIndex, 'save_meta', save_meta)
+	with pytest.raises(KeyboardInterrupt):
+		index_chain(index_dir)
+	assert saved == [0, 1, 2, 3, 4, 5]
+	monkeypatch.undo()
+
+	# Runs written after the last saved meta.json are dropped, indexing
+	# continues after the last saved height
+	address_index = AddressIndex(index_dir)
+	assert address_index.meta['height'] == 5
+	address_index = index_chain(index_dir, address_index.meta['height'] + 1)
+	assert address_index.get_history(b'\x00' + builder.hash160(builder.make_pubkey(4))) == expected
+
+
+def test_build(tmp_path, capsys):
+	build(FIXTURE_BLOCKS_DIR, str(tmp_path), 1000)
+	assert AddressIndex(str(tmp_path)).meta['height'] == 11
+	assert 'Indexed up to height 11' in capsys.readouterr().out
+
+
+def test_size_tiered_merges(tmp_path, monkeypatch):
+	written = []
+
+	def write_run(self, kind, records, level):
+		records = list(records)
+		written.append(len(records))
+		original_write_run(self, kind, records, level)
+
+	original_write_run = AddressIndex.write_run
+	monkeypatch.setattr(AddressIndex, 'write_run', write_run)
+	address_index = AddressIndex(str(tmp_path), buffer_size=1, merge_factor=2)
+	keys = [bytes([i % 3]) * 21 for i in range(64)]
+	for i, key in enumerate(keys):
+		address_index.buffers[FUNDING].append(funding_struct.pack(key, i, b'\x00' * 32, 0, i))
+		address_index.flush()
+		# Like a binary counter: one run per bit set in the number of flushes
+		assert len(address_index.meta['runs'][FUNDING]) == bin(i + 1).count('1')
+	# Every record is written by its flush and once per level, 6 levels for 64
+	assert sum(written) == 64 * 7
+	assert list(address_index.meta['levels'].values()) == [6]
+	# The spend runs are mapped once per query, not once per funding posting
+	mapped = []
+	original_map_runs = AddressIndex.map_runs
+	monkeypatch.setattr(AddressIndex, 'map_runs', lambda self, kind: mapped.append(kind) or original_map_runs(self, kind))
+	assert [p['height'] for p in address_index.get_history(keys[1])] == list(range(1, 64, 3))
+	assert sorted(mapped) == [FUNDING, SPEND]
+	assert set(os.listdir(tmp_path)) == set(address_index.meta['runs'][FUNDING] + ['meta.json'])
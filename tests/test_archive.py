@@ -0,0 +1,124 @@
+from conftest import FIXTURE_BLOCKS_DIR
+
+import archive
+import gzip
+import io
+import lzma
+import os
+import pytest
+import scan
+import struct
+import zlib
+
+FIXTURE_FILES = ['blk00000.dat', 'blk00001.dat']
+
+
+class OneByteRaw(io.RawIOBase):
+	"""
+	Deliver data one byte per read, like a slow pipe.
+	"""
+
+	def __init__(self, data: bytes):
+		self.data = data
+		self.pos = 0
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		if self.pos == len(self.data) or len(buffer) == 0:
+			return 0
+		buffer[0] = self.data[self.pos]
+		self.pos += 1
+		return 1
+
+
+def read_fixture_file(file_name: str) -> bytes:
+	with open(os.path.join(FIXTURE_BLOCKS_DIR, file_name), 'rb') as f:
+		return f.read()
+
+
+def split(data: bytes, size: int) -> list:
+	return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def bgzf_compress(data: bytes, member_size: int = 1000) -> bytes:
+	"""
+	Members as written by bgzip, followed by its empty EOF member
+	"""
+	members = []
+	for chunk in split(data, member_size) + [b'']:
+		compressor = zlib.compressobj(wbits=-15)
+		deflated = compressor.compress(chunk) + compressor.flush()
+		header = b'\x1f\x8b\x08\x04\0\0\0\0\0\xff' + struct.pack('<H', 6) + b'BC' + struct.pack('<H', 2)
+		trailer = struct.pack('<II', zlib.crc32(chunk), len(chunk))
+		block_size = len(header) + 2 + len(deflated) + len(trailer)
+		members.append(header + struct.pack('<H', block_size - 1) + deflated + trailer)
+	return b''.join(members)
+
+
+def zstd_compress(data: bytes) -> bytes:
+	zstandard = pytest.importorskip('zstandard')
+	return zstandard.ZstdCompressor().compress(data)
+
+
+def zstd_compress_frames(data: bytes) -> bytes:
+	zstandard = pytest.importorskip('zstandard')
+	compressor = zstandard.ZstdCompressor(write_checksum=True)
+	frames = [compressor.compress(chunk) for chunk in split(data, 1000)]
+	# A skippable frame and a frame without content size, as written from a pipe
+	skippable = struct.pack('<II', archive.ZSTD_SKIPPABLE_MAGIC + 3, 4) + b'skip'
+	stream = compressor.compressobj()
+	return b''.join(frames[:2]) + skippable + stream.compress(b''.join(split(data, 1000)[2:])) + stream.flush()
+
+
+COMPRESSORS = {
+	'raw': lambda data: data,
+	'gzip': gzip.compress,
+	# Concatenated members, e.g. `cat a.gz b.gz`
+	'gzip-members': lambda data: b''.join(gzip.compress(chunk) for chunk in split(data, 1500)),
+	'bgzf': bgzf_compress,
+	'xz': lzma.compress,
+	'zstd': zstd_compress,
+	'zstd-frames': zstd_compress_frames,
+}
+
+
+def get_summary(blocks) -> list:
+	return [(offset, block.curr_block_hash, [t.tx_hash for t in block.transactions]) for offset, block in blocks]
+
+
+@pytest.mark.parametrize('file_name', FIXTURE_FILES)
+@pytest.mark.parametrize('compressor', sorted(COMPRESSORS))
+@pytest.mark.parametrize('workers', [1, 4])
+def test_round_trip(tmp_path, file_name, compressor, workers):
+	data = read_fixture_file(file_name)
+	path = tmp_path / (file_name + '.' + compressor)
+	path.write_bytes(COMPRESSORS[compressor](data))
+	with open(os.path.join(FIXTURE_BLOCKS_DIR, file_name), 'rb') as block_reader:
+		expected = get_summary(scan.iterate_blocks(block_reader))
+	assert len(expected) > 0
+	assert get_summary(archive.iterate_archive_blocks(str(path), workers)) == expected
+
+
+@pytest.mark.parametrize('compressor, format_name', [
+	('raw', 'raw'), ('gzip', 'gzip'), ('bgzf', 'bgzf'), ('xz', 'xz'), ('zstd', 'zstd')
+])
+def test_detect_format_of_slow_input(compressor, format_name):
+	data = read_fixture_file(FIXTURE_FILES[0])
+	compressed_reader = io.BufferedReader(OneByteRaw(COMPRESSORS[compressor](data)))
+	# peek() would only see the first byte
+	assert len(compressed_reader.peek(18)) < 18
+	reader = archive.DecompressingReader(compressed_reader, workers=2)
+	try:
+		assert reader.format_name == format_name
+		blocks = list(archive.iterate_blocks(reader))
+	finally:
+		reader.close()
+	with open(os.path.join(FIXTURE_BLOCKS_DIR, FIXTURE_FILES[0]), 'rb') as block_reader:
+		assert get_summary(blocks) == get_summary(scan.iterate_blocks(block_reader))
+
+
+def test_unknown_format():
+	with pytest.raises(ValueError):
+		archive.DecompressingReader(io.BufferedReader(OneByteRaw(b'\x01' * 100)))
@@ -0,0 +1,81 @@
+from block import Transaction
+
+import builder
+import io
+import pytest
+import utils
+
+
+def make_witness_tx(witnesses: list) -> builder.Tx:
+	inputs = [
+		(builder.double_sha256(bytes([i])), i, b'') for i in range(len(witnesses))
+	]
+	return builder.Tx(inputs, [(builder.FEE, builder.p2pkh(builder.make_pubkey(1)))],
+		witnesses=witnesses)
+
+
+def decode_from_stream(data: bytes) -> Transaction:
+	return Transaction(io.BufferedReader(io.BytesIO(data)))
+
+
+@pytest.mark.parametrize('witnesses', [
+	# An input without witness next to one with witness, e.g. a legacy input
+	# spent together with a segwit one
+	[[], [b'\x30' * 71, b'\x02' * 33]],
+	[[b'\x02' * 33], []],
+	# Zero-length items, e.g. the dummy element of CHECKMULTISIG or an empty
+	# signature
+	[[b'', b'\x30' * 71, b'']],
+	# An item long enough for a 3-byte length field
+	[[b'\x51' * 300]],
+])
+def test_witness_stacks(witnesses):
+	tx = make_witness_tx(witnesses)
+	data = tx.serialize()
+	for transaction in (Transaction.from_bytes(data), decode_from_stream(data)):
+		assert transaction.has_witness()
+		assert [tx_input.witness for tx_input in transaction.inputs] == witnesses
+		assert transaction.tx_hash == utils.convert_endianness(tx.txid()).hex()
+		assert transaction.get_wtxid() == utils.convert_endianness(builder.double_sha256(data)).hex()
+		assert transaction.size == len(data)
+		assert transaction.base_size == len(tx.serialize(include_witness=False))
+		assert transaction.get_bytes() == data
+
+
+def test_superfluous_witness_record():
+	# Flag 1 with only empty witness stacks is rejected by Bitcoin Core
+	data = make_witness_tx([[], []]).serialize()
+	with pytest.raises(ValueError):
+		Transaction.from_bytes(data)
+	with pytest.raises(ValueError):
+		decode_from_stream(data)
+
+
+def test_truncated_witness_item():
+	data = make_witness_tx([[b'\x02' * 33]]).serialize()
+	# Cut the transaction in the middle of the witness item
+	truncated = data[:-4 - 10]
+	with pytest.raises(ValueError):
+		Transaction.from_bytes(truncated)
+	with pytest.raises(ValueError):
+		decode_from_stream(truncated)
+
+
+def test_witness_item_length_beyond_transaction():
+	data = make_witness_tx([[b'\x02' * 33]]).serialize()
+	# Claim a longer item than the rest of the transaction
+	length_pos = len(data) - 4 - 33 - 1
+	assert data[length_pos] == 33
+	data = data[:length_pos] + bytes([0xfc]) + data[length_pos + 1:]
+	with pytest.raises(ValueError):
+		Transaction.from_bytes(data)
+
+
+def test_legacy_transaction_is_unchanged():
+	tx = builder.Tx([(builder.double_sha256(b'p'), 0, b'\x51')], [(builder.FEE, b'\x51')])
+	data = tx.serialize()
+	transaction = Transaction.from_bytes(data)
+	assert transaction.has_witness() is False
+	assert all(tx_input.witness == () for tx_input in transaction.inputs)
+	assert transaction.base_size == transaction.size == len(data)
+	assert transaction.get_bytes() == data
@@ -0,0 +1,114 @@
+from blockindex import (
+	BlockIndex, BlockIndexEntry, BLOCK_FAILED_VALID, BLOCK_HAVE_DATA, BLOCK_HAVE_UNDO, BLOCK_VALID_SCRIPTS,
+	get_block_proof
+)
+from conftest import FIXTURE_BLOCKS_DIR
+
+import builder
+import pytest
+import struct
+
+
+def test_entry_decoding():
+	header = builder.make_header(b'\x11' * 32, [builder.coinbase(700000, 625_000_000, b'\x51')], 1631333672)
+	status = BLOCK_VALID_SCRIPTS | BLOCK_HAVE_DATA | BLOCK_HAVE_UNDO
+	# Offsets above 2 ** 21 take four bytes of VARINT
+	value = builder.disk_block_index(700000, status, 1276, header, 2681, 134_150_683, 19_876_543)
+	entry = BlockIndexEntry(b'\x22' * 32, value)
+	assert (entry.height, entry.status, entry.transaction_count) == (700000, status, 1276)
+	assert (entry.file_number, entry.data_pos, entry.undo_pos) == (2681, 134_150_683, 19_876_543)
+	assert entry.hash_prev_blk == b'\x11' * 32
+	assert entry.timestamp == 1631333672
+	assert entry.bits == builder.REGTEST_BITS
+	assert entry.has_data() and entry.is_valid()
+
+
+def test_entry_decoding_without_data():
+	header = builder.make_header(b'\x11' * 32, [builder.coinbase(1, 1, b'\x51')], 1631333672)
+	entry = BlockIndexEntry(b'\x22' * 32, builder.disk_block_index(1, builder.BLOCK_VALID_TREE, 0, header))
+	assert entry.file_number is None and entry.data_pos is None and entry.undo_pos is None
+	assert entry.hash_prev_blk == b'\x11' * 32
+	assert entry.has_data() is False and entry.is_valid() is False
+
+
+def test_fixture_entries(fixture_chain):
+	block_index = BlockIndex(FIXTURE_BLOCKS_DIR)
+	# Entries from both the table file and the log, other records are skipped
+	assert len(block_index.entries) == len(fixture_chain)
+	for block in fixture_chain:
+		entry = block_index.get_by_hash(block.hash)
+		assert (entry.height, entry.status, entry.transaction_count) == (block.height, block.status, len(block.txs))
+		assert (entry.file_number, entry.data_pos, entry.undo_pos) == (block.file_number, block.data_pos, block.undo_pos)
+		assert entry.hash_prev_blk == block.prev_hash
+		if entry.has_data():
+			assert block_index.read_block(entry).curr_block_hash == block.hash
+
+
+def test_active_chain(fixture_chain):
+	block_index = BlockIndex(FIXTURE_BLOCKS_DIR)
+	active_chain = builder.get_active_chain(fixture_chain)
+	# Neither the stale branch nor the failed block x12 are on it
+	assert block_index.get_height() == 11
+	assert block_index.active_chain == [block.hash for block in active_chain]
+	assert block_index.get_by_height(9).hash == active_chain[9].hash
+	with pytest.raises(IndexError):
+		block_index.get_by_height(12)
+	with pytest.raises(KeyError):
+		block_index.get_by_hash(b'\x00' * 32)
+
+
+def test_active_chain_with_failed_ancestor(fixture_chain):
+	block_index = BlockIndex(FIXTURE_BLOCKS_DIR)
+	active_chain = builder.get_active_chain(fixture_chain)
+	stale_branch = [block for block in fixture_chain if block.name in ('s9', 's10')]
+	# Blocks 10 and 11 are still valid on their own, but they descend from 9
+	block_index.entries[active_chain[9].hash].status |= BLOCK_FAILED_VALID
+	block_index.build_active_chain()
+	assert block_index.get_height() == 10
+	assert block_index.active_chain == [block.hash for block in active_chain[:9] + stale_branch]
+
+
+def test_block_proof():
+	# The genesis block of mainnet and the highest target of regtest
+	assert get_block_proof(0x1d00ffff) == 0x100010001
+	assert get_block_proof(builder.REGTEST_BITS) == 2
+	assert get_block_proof(0x2100ffff) == 1
+	# Zero, negative and overflowing targets
+	for bits in (0x1d000000, 0x1d800001, 0x2300ffff, 0x22010000):
+		assert get_block_proof(bits) == 0
+
+
+def add_entry(block_index: BlockIndex, name: bytes, prev_hash: bytes, bits: int, file_number: int, data_pos: int):
+	"""
+	Add a fully-validated entry with data to block_index and return its hash.
+	"""
+	header = struct.pack('<I32s32sIII', 1, prev_hash, b'\x00' * 32, 1631333672, bits, 0)
+	status = BLOCK_VALID_SCRIPTS | BLOCK_HAVE_DATA | BLOCK_HAVE_UNDO
+	height = block_index.entries[prev_hash].height + 1
+	block_hash = name * 32
+	block_index.entries[block_hash] = BlockIndexEntry(
+		block_hash, builder.disk_block_index(height, status, 1, header, file_number, data_pos, 0)
+	)
+	return block_hash
+
+
+def test_active_chain_by_chain_work(fixture_chain):
+	block_index = BlockIndex(FIXTURE_BLOCKS_DIR)
+	active_chain = builder.get_active_chain(fixture_chain)
+	assert block_index.entries[active_chain[11].hash].chain_work == 12 * 2
+	# A longer branch from height 9 with less work: 3 blocks of work 1 against 2
+	# blocks of work 2
+	prev_hash = active_chain[9].hash
+	for name in (b'\x01', b'\x02', b'\x03'):
+		prev_hash = add_entry(block_index, name, prev_hash, 0x2100ffff, 2, 0)
+	block_index.build_active_chain()
+	assert block_index.get_height() == 11
+	assert block_index.active_chain == [block.hash for block in active_chain]
+
+	# A tip of the same work as the active one wins if it was received first
+	tip_hash = add_entry(block_index, b'\x04', active_chain[10].hash, builder.REGTEST_BITS, 2, 0)
+	block_index.build_active_chain()
+	assert block_index.active_chain[11] == active_chain[11].hash
+	block_index.entries[tip_hash].file_number = 0
+	block_index.build_active_chain()
+	assert block_index.active_chain == [block.hash for block in active_chain[:11]] + [tip_hash]
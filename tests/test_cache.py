@@ -0,0 +1,79 @@
+from cache import BlockCache
+from conftest import FIXTURE_BLOCKS_DIR
+
+import builder
+import cache
+import os
+import shutil
+
+
+def get_summary(records) -> list:
+	return [(r.offset, r.block_hash, [t.tx_hash for t in r.transactions]) for r in records]
+
+
+def test_cache_hit(fixture_chain, tmp_path, monkeypatch):
+	block_cache = BlockCache(str(tmp_path / 'cache'))
+	file_path = os.path.join(FIXTURE_BLOCKS_DIR, 'blk00000.dat')
+	records = list(block_cache.iterate_blocks(file_path))
+	active_chain = builder.get_active_chain(fixture_chain)
+	assert [r.block_hash for r in records] == [block.hash for block in active_chain[:7]]
+	assert records[3].transactions[1].tx_hash == active_chain[3].txs[1].txid()
+
+	# A second run reads every record from the cache without parsing a block
+	def fail(*args):
+		raise AssertionError('Block parsed on a cache hit')
+
+	monkeypatch.setattr(cache, 'Block', fail)
+	assert get_summary(block_cache.iterate_blocks(file_path)) == get_summary(records)
+	assert len(os.listdir(block_cache.cache_dir)) == 1
+
+
+def test_changed_file(tmp_path):
+	block_cache = BlockCache(str(tmp_path / 'cache'))
+	file_path = str(tmp_path / 'blk00000.dat')
+	shutil.copy(os.path.join(FIXTURE_BLOCKS_DIR, 'blk00000.dat'), file_path)
+	records = get_summary(block_cache.iterate_blocks(file_path))
+	cache_path = block_cache.get_cache_path(file_path)
+
+	# Touched: same blocks, but another cache file
+	os.utime(file_path, ns=(0, 0))
+	assert block_cache.get_cache_path(file_path) != cache_path
+	assert get_summary(block_cache.iterate_blocks(file_path)) == records
+
+	# Appended to: the new block is found
+	with open(os.path.join(FIXTURE_BLOCKS_DIR, 'blk00001.dat'), 'rb') as f:
+		magic_and_size = f.read(8)
+		first_block = magic_and_size + f.read(int.from_bytes(magic_and_size[4:], 'little'))
+	with open(file_path, 'r+b') as f:
+		# Over the zero-filled tail of the fixture file
+		f.seek(records[-1][0] + 4)
+		f.seek(records[-1][0] + 8 + int.from_bytes(f.read(4), 'little'))
+		f.write(first_block)
+	os.utime(file_path, ns=(1, 1))
+	new_records = get_summary(block_cache.iterate_blocks(file_path))
+	assert new_records[:-1] == records and len(new_records) == len(records) + 1
+	assert len(os.listdir(block_cache.cache_dir)) == 3
+
+
+def test_eviction(tmp_path):
+	cache_dir = tmp_path / 'cache'
+	block_cache = BlockCache(str(cache_dir))
+	# Other files and directories in the cache directory are left alone
+	shutil.copy(os.path.join(FIXTURE_BLOCKS_DIR, 'blk00000.dat'), cache_dir / 'blk00000.dat')
+	os.utime(cache_dir / 'blk00000.dat', ns=(0, 0))
+	(cache_dir / 'subdirectory').mkdir()
+	(cache_dir / 'subdirectory' / 'a.0123456789abcdef.cache').write_bytes(b'\x00' * 100)
+	os.utime(cache_dir / 'subdirectory', ns=(0, 0))
+
+	paths = [os.path.join(FIXTURE_BLOCKS_DIR, name) for name in ('blk00000.dat', 'blk00001.dat')]
+	list(block_cache.iterate_blocks(paths[0]))
+	list(block_cache.iterate_blocks(paths[1]))
+	cache_paths = [block_cache.get_cache_path(path) for path in paths]
+	sizes = [os.path.getsize(path) for path in cache_paths]
+	os.utime(cache_paths[1], ns=(1, 1))
+	# Reading the first file again makes the second one the least recently used
+	list(block_cache.iterate_blocks(paths[0]))
+	block_cache.max_size = sum(sizes) - 1
+	block_cache.evict()
+	assert sorted(os.listdir(cache_dir)) == sorted(['blk00000.dat', 'subdirectory', os.path.basename(cache_paths[0])])
+	assert os.path.getsize(cache_dir / 'blk00000.dat') == os.path.getsize(paths[0])
@@ -0,0 +1,66 @@
+from block import Block
+from blockindex import BlockIndex, BlockIndexEntry
+from chainindex import BlockTxIndex, ChainIndex, read_block_with_undo, update_index
+from conftest import FIXTURE_BLOCKS_DIR
+
+import builder
+import pytest
+
+
+def test_update_index(fixture_chain, tmp_path):
+	active_chain = builder.get_active_chain(fixture_chain)
+	block_index = BlockIndex(FIXTURE_BLOCKS_DIR)
+	index = BlockTxIndex(str(tmp_path / 'chain.sqlite'))
+	committed = []
+	assert update_index(index, block_index, commit_interval=4, on_commit=committed.append) == (0, 12)
+	assert committed == [3, 7, 11]
+	assert index.get_tip_height() == 11
+	block_hash, file_number, _, block_stats = index.get_block(10)
+	assert (block_hash, file_number) == (active_chain[10].hash, 1)
+	# Fees need the undo data attached by read_block_with_undo()
+	assert block_stats['totalfee'] == 2 * builder.FEE
+	assert index.get_transaction(active_chain[7].txs[1].txid()) == (7, 1)
+
+	# The index has another block at the tip, which is disconnected first
+	index.connection.execute('UPDATE blocks SET hash = ? WHERE height = 11', (b'\x00' * 32,))
+	assert update_index(index, block_index) == (1, 1)
+	assert index.get_block_hash(11) == active_chain[11].hash
+	assert index.get_transaction(active_chain[11].txs[0].txid()) == (11, 0)
+	index.close()
+
+
+def test_duplicate_txid(fixture_chain, tmp_path):
+	active_chain = builder.get_active_chain(fixture_chain)
+	block_index = BlockIndex(FIXTURE_BLOCKS_DIR)
+	index = BlockTxIndex(str(tmp_path / 'chain.sqlite'))
+	for height in range(3):
+		index.connect_block(read_block_with_undo(block_index, block_index.get_by_height(height)),
+			block_index.get_by_height(height))
+	# A block at height 3 whose coinbase is the one of height 1 again, as the
+	# coinbases of heights 91842 and 91880 on mainnet (see BIP30)
+	duplicate = active_chain[1].txs[0]
+	header = builder.make_header(active_chain[2].hash, [duplicate], 1_300_000_000)
+	block = Block.from_bytes(builder.serialize_block(header, [duplicate]))
+	entry = BlockIndexEntry(block.curr_block_hash, builder.disk_block_index(3, builder.BLOCK_VALID_TREE, 1, header))
+	index.connect_block(block, entry)
+	assert index.get_transaction(duplicate.txid()) == (3, 0)
+	index.commit()
+
+	index.disconnect_block(block, entry)
+	assert index.get_transaction(duplicate.txid()) == (1, 0)
+	index.connect_block(block, entry)
+	index.disconnect_block(block, entry)
+	index.disconnect_block(None, None)
+	assert index.get_transaction(duplicate.txid()) == (1, 0)
+	assert index.get_transaction(active_chain[2].txs[0].txid()) is None
+	assert index.connection.execute('SELECT COUNT(*) FROM replaced_transactions').fetchone()[0] == 0
+	index.close()
+
+
+def test_incomplete_chain_index():
+	class TipOnlyIndex(ChainIndex):
+		def get_tip_height(self) -> int:
+			return -1
+
+	with pytest.raises(TypeError):
+		TipOnlyIndex()
@@ -0,0 +1,39 @@
+from cluster import AddressClusters, build
+from conftest import FIXTURE_BLOCKS_DIR
+
+import builder
+import io
+import json
+
+
+def get_key(n: int) -> bytes:
+	return b'\x00' + builder.hash160(builder.make_pubkey(n))
+
+
+def test_build(tmp_path):
+	events = io.StringIO()
+	clusters = AddressClusters(str(tmp_path), events=events)
+	build(FIXTURE_BLOCKS_DIR, clusters, checkpoint_interval=4)
+	# Height 3 spends the coinbases of 1 and 2, height 7 those of 6 and 2 (the
+	# output of height 3), height 5 those of 3 and 4 and height 10 those of 8
+	# and 4 (the output of height 9). Height 9 only spends the coinbase of 7.
+	expected = [{1, 2, 6}, {3, 4, 8}, {7}]
+	cluster_ids = {n: clusters.get_cluster(get_key(n)) for group in expected for n in group}
+	for group in expected:
+		assert len(set(cluster_ids[n] for n in group)) == 1
+	assert len(set(cluster_ids.values())) == len(expected)
+	# Addresses that are only paid to, and the stale branch, are not clustered
+	for n in (0, 5, 11, 100, 101, 200):
+		assert clusters.get_cluster(get_key(n)) is None
+	assert clusters.meta == {'height': 11, 'count': 7}
+	lines = [json.loads(line) for line in events.getvalue().splitlines()]
+	assert sum(1 for event in lines if 'merge' in event) == 4
+	clusters.close()
+
+	# Reopened from the state dir, there is nothing left to process
+	events = io.StringIO()
+	clusters = AddressClusters(str(tmp_path), events=events)
+	build(FIXTURE_BLOCKS_DIR, clusters)
+	assert events.getvalue() == ''
+	assert sorted(cluster_id for _, cluster_id in clusters.iterate_assignments()) == sorted(cluster_ids.values())
+	clusters.close()
@@ -0,0 +1,102 @@
+from examine import END_OF_RESPONSE, Examiner, build_argument_parser
+
+import blockindex
+import builder
+import os
+import pytest
+import shutil
+
+
+def get_txid(tx: builder.Tx) -> str:
+	return tx.txid()[::-1].hex()
+
+
+def test_replaced_file(fixture_chain, blocks_dir):
+	active_chain = builder.get_active_chain(fixture_chain)
+	file_path = os.path.join(blocks_dir, 'blk00000.dat')
+	examiner = Examiner()
+	assert examiner.get_block(file_path, 3).curr_block_hash == active_chain[3].hash
+	txid = get_txid(active_chain[3].txs[1])
+	assert examiner.find_transaction(txid)[:2] == (file_path, 3)
+	assert all(len(key) == 32 for key in examiner.txids)
+
+	# A reindex writes the file again, here with the blocks of blk00001.dat
+	other_path = os.path.join(blocks_dir, 'blk00001.dat')
+	other_examiner = Examiner()
+	expected = other_examiner.get_block(other_path, 3)
+	other_examiner.close()
+	shutil.copy(other_path, file_path + '.new')
+	os.replace(file_path + '.new', file_path)
+	with pytest.raises(ValueError):
+		examiner.find_transaction(txid)
+	assert examiner.get_block(file_path, 3).curr_block_hash == expected.curr_block_hash
+	other_txid = expected.transactions[0].tx_hash
+	assert examiner.find_transaction(other_txid)[:2] == (file_path, 3)
+
+	os.remove(file_path)
+	with pytest.raises(ValueError):
+		examiner.find_transaction(other_txid)
+	assert len(examiner.blocks) == len(examiner.txids) == len(examiner.block_files) == 0
+	examiner.close()
+
+
+def test_txid_cache_is_bounded(fixture_chain, blocks_dir):
+	active_chain = builder.get_active_chain(fixture_chain)
+	file_path = os.path.join(blocks_dir, 'blk00000.dat')
+	examiner = Examiner(max_cached_txids=2)
+	for number in range(7):
+		examiner.get_block(file_path, number)
+	assert list(examiner.txids.values()) == [(file_path, 5), (file_path, 6)]
+	# Found again by decoding the blocks of the file
+	assert examiner.find_transaction(get_txid(active_chain[3].txs[1]), file_path)[:2] == (file_path, 3)
+	examiner.close()
+
+
+def test_start_past_the_end(fixture_chain, blocks_dir):
+	examiner = Examiner()
+	examiner.argument_parser = build_argument_parser()
+	file_path = os.path.join(blocks_dir, 'blk00000.dat')
+	response = examiner.answer(f'--file-path {file_path} --start 9').splitlines()
+	assert response == [
+		'Parsing blk00000.dat[9: 8]', 'Start 9 is past the last block, blk00000.dat has 7 blocks', END_OF_RESPONSE
+	]
+	response = examiner.answer(f'--file-path {file_path} --start 5 --offset 5').splitlines()
+	assert response[-3:] == ['Reached End of Field', 'Parsed 7 blocks', END_OF_RESPONSE]
+	examiner.close()
+
+
+def test_print_by_height(fixture_chain, blocks_dir, monkeypatch, capsys):
+	active_chain = builder.get_active_chain(fixture_chain)
+	loads = []
+
+	class CountingBlockIndex(blockindex.BlockIndex):
+		def __init__(self, blocks_dir: str):
+			loads.append(blocks_dir)
+			super().__init__(blocks_dir)
+
+	monkeypatch.setattr(blockindex, 'BlockIndex', CountingBlockIndex)
+	examiner = Examiner()
+	examiner.print_by_height(blocks_dir, 3)
+	assert active_chain[3].hash[::-1].hex() in capsys.readouterr().out
+	examiner.print_by_height(blocks_dir, 4)
+	assert len(loads) == 1
+
+	# bitcoind writes to the index, e.g. on a reorg
+	index_dir = os.path.join(blocks_dir, 'index')
+	log_name = next(name for name in os.listdir(index_dir) if name.endswith('.log'))
+	stat = os.stat(os.path.join(index_dir, log_name))
+	os.utime(os.path.join(index_dir, log_name), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+	examiner.print_by_height(blocks_dir, 4)
+	assert len(loads) == 2
+
+	# The block table of the file stops at a zeroed prefix, later blocks are
+	# read at their position in the index
+	with open(os.path.join(blocks_dir, 'blk00000.dat'), 'r+b') as f:
+		f.seek(active_chain[3].data_pos - 8)
+		f.write(b'\0' * 8)
+	examiner.close()
+	capsys.readouterr()
+	examiner.print_by_height(blocks_dir, 5)
+	assert active_chain[5].hash[::-1].hex() in capsys.readouterr().out
+	assert len(examiner.get_block_file(os.path.join(blocks_dir, 'blk00000.dat')).offsets) == 3
+	examiner.close()
@@ -0,0 +1,135 @@
+from block import Block
+from conftest import FIXTURE_BLOCKS_DIR, WITNESS_BLOCK_VECTOR
+from extract import PayloadWriter, extract_file, get_op_return_spans, iterate_transactions
+from opcodes import *
+
+import builder
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+TESTNET3_MAGIC = 0x0709110b
+PNG = b'\x89PNG\r\n\x1a\n' + bytes(range(100))
+
+
+def push(data: bytes) -> bytes:
+	if len(data) < OP_PUSHDATA1:
+		return bytes([len(data)]) + data
+	return bytes([OP_PUSHDATA1, len(data)]) + data
+
+
+def envelope(fields: bytes, body: list = None) -> bytes:
+	"""
+	An inscription envelope, without the OP_0 separator if body is None
+	"""
+	script = bytes([OP_FALSE, OP_IF]) + push(b'ord') + fields
+	if body is not None:
+		script += bytes([OP_0]) + b''.join(push(p) for p in body)
+	return script + bytes([OP_ENDIF])
+
+
+def tapscript(*envelopes) -> bytes:
+	return push(b'\x02' * 32) + bytes([OP_CHECKSIG]) + b''.join(envelopes)
+
+
+def write_blk_file(path: str, blocks: list, magic: int = builder.MAINNET_MAGIC):
+	with open(path, 'wb') as f:
+		for block in blocks:
+			f.write(struct.pack('<II', magic, len(block)) + block)
+
+
+def read_index(output_dir: str) -> list:
+	with open(os.path.join(output_dir, 'index.jsonl')) as f:
+		return [json.loads(line) for line in f]
+
+
+def read_payload(output_dir: str, record: dict) -> bytes:
+	with open(os.path.join(output_dir, record['sha256'][:2], record['sha256']), 'rb') as f:
+		return f.read()
+
+
+def test_fixture_op_return(fixture_chain, tmp_path):
+	output_dir = str(tmp_path / 'payloads')
+	for run in range(2):
+		writer = PayloadWriter(output_dir)
+		for file_name in ('blk00000.dat', 'blk00001.dat'):
+			extract_file(os.path.join(FIXTURE_BLOCKS_DIR, file_name), writer)
+		writer.close()
+		# A second run rewrites the index instead of appending to it
+		records = read_index(output_dir)
+		block = builder.get_active_chain(fixture_chain)[3]
+		assert records == [{
+			'block': block.hash[::-1].hex(), 'txid': block.txs[1].txid()[::-1].hex(), 'output': 1,
+			'kind': 'op_return', 'mime': 'text/plain;charset=utf-8', 'size': 5,
+			'sha256': hashlib.sha256(b'hello').hexdigest()
+		}]
+		assert read_payload(output_dir, records[0]) == b'hello'
+		assert (writer.payload_count, writer.file_count) == (1, 1 if run == 0 else 0)
+
+
+def test_witness_block(tmp_path):
+	raw_block = bytes.fromhex(WITNESS_BLOCK_VECTOR[2])
+	path = str(tmp_path / 'blk00000.dat')
+	write_blk_file(path, [raw_block], TESTNET3_MAGIC)
+	block = Block.from_bytes(raw_block)
+	with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+		# The walker's txids exclude witnesses, like those of block.py
+		assert [spans.txid for _, spans in iterate_transactions(file_map)] == [
+			t.tx_hash for t in block.transactions]
+	expected = []
+	for transaction in block.transactions:
+		for vout, output in enumerate(transaction.outputs):
+			script = output.pubkey
+			push_spans = get_op_return_spans(script, 0, len(script))
+			if push_spans is not None:
+				expected.append((transaction.tx_hash, vout, b''.join(script[s:e] for s, e in push_spans)))
+	# At least the witness commitment of the coinbase transaction
+	assert len(expected) > 0
+
+	output_dir = str(tmp_path / 'payloads')
+	writer = PayloadWriter(output_dir)
+	extract_file(path, writer)
+	writer.close()
+	records = read_index(output_dir)
+	assert [(r['txid'], r['output'], read_payload(output_dir, r)) for r in records] == expected
+	assert all(r['block'] == block.curr_block_hash[::-1].hex() for r in records)
+
+
+def test_envelopes(tmp_path):
+	text_envelope = envelope(push(b'\x01') + push(b'text/plain;charset=utf-8'), [b'Hello, ', b'world'])
+	witnesses = [
+		# Two envelopes in one script, the second without a body
+		[b'\x01' * 64, tapscript(text_envelope, envelope(push(b'\x01') + push(b'text/plain'))), b'\xc0' * 33],
+		# The content type tag as OP_1, and a push longer than 75 bytes
+		[b'\x01' * 64, tapscript(envelope(bytes([OP_1]) + push(b'image/png'), [PNG])), b'\xc0' * 33],
+		# No content type: the MIME type is sniffed. Then the same text again.
+		[b'\x01' * 64, tapscript(envelope(b'', [b'{"p": "brc-20"}']), text_envelope), b'\xc0' * 33],
+	]
+	tx = builder.Tx(
+		[(builder.double_sha256(bytes([i])), 0, b'') for i in range(len(witnesses))],
+		[(330, b'\x51\x20' + b'\x03' * 32)], witnesses=witnesses
+	)
+	cb = builder.coinbase(1, builder.COIN, builder.p2pkh(builder.make_pubkey(1)))
+	header = builder.make_header(b'\x00' * 32, [cb, tx], builder.GENESIS_TIME)
+	path = str(tmp_path / 'blk00000.dat')
+	write_blk_file(path, [builder.serialize_block(header, [cb, tx])])
+
+	output_dir = str(tmp_path / 'payloads')
+	writer = PayloadWriter(output_dir)
+	extract_file(path, writer)
+	writer.close()
+	records = read_index(output_dir)
+	block_hash = builder.double_sha256(header)[::-1].hex()
+	txid = tx.txid()[::-1].hex()
+	assert all(r['block'] == block_hash and r['txid'] == txid and r['kind'] == 'inscription' for r in records)
+	assert [(r['input'], r['mime'], r['size']) for r in records] == [
+		(0, 'text/plain;charset=utf-8', 12), (0, 'text/plain', 0), (1, 'image/png', len(PNG)),
+		(2, 'application/json', 15), (2, 'text/plain;charset=utf-8', 12)
+	]
+	assert records[1]['sha256'] is None
+	assert records[0]['sha256'] == records[4]['sha256'] == hashlib.sha256(b'Hello, world').hexdigest()
+	assert [read_payload(output_dir, records[i]) for i in (0, 2, 3)] == [b'Hello, world', PNG, b'{"p": "brc-20"}']
+	# Every payload is stored once
+	assert (writer.payload_count, writer.file_count) == (5, 3)
@@ -0,0 +1,114 @@
+from block import Block, Transaction
+from conftest import BLOCK_FILTER_VECTORS, FIXTURE_BLOCKS_DIR, WITNESS_BLOCK_VECTOR
+from filters import build_basic_filter, build_file_filters, get_filter_header, match_any
+from undo import SpentOutput
+
+import builder
+import io
+import os
+import pytest
+import utils
+
+
+def read_vector_block(block_hex: str, prev_scripts: list) -> Block:
+	block = Block.from_bytes(bytes.fromhex(block_hex))
+	# The vectors list the spent scripts in the order of the block's inputs
+	prev_scripts = iter(prev_scripts)
+	for transaction in block.transactions[1:]:
+		for tx_input in transaction.inputs:
+			tx_input.prev_output = SpentOutput(0, bytes.fromhex(next(prev_scripts)), 0, False)
+	assert next(prev_scripts, None) is None
+	return block
+
+
+@pytest.mark.parametrize('vector', BLOCK_FILTER_VECTORS, ids=[v[-1] or str(v[0]) for v in BLOCK_FILTER_VECTORS])
+def test_basic_filter_vectors(vector):
+	height, block_hash, block_hex, prev_scripts, prev_header, filter_hex, header, notes = vector
+	block = read_vector_block(block_hex, prev_scripts)
+	assert utils.convert_endianness(block.curr_block_hash).hex() == block_hash
+	filter_bytes = build_basic_filter(block)
+	assert filter_bytes.hex() == filter_hex
+	filter_header = get_filter_header(filter_bytes, utils.convert_endianness(bytes.fromhex(prev_header)))
+	assert utils.convert_endianness(filter_header).hex() == header
+
+
+def test_witness_transactions():
+	raw_block = bytes.fromhex(WITNESS_BLOCK_VECTOR[2])
+	# The merkle root is checked while parsing, so txids exclude witnesses
+	block = Block.from_bytes(raw_block)
+	witness_transactions = [t for t in block.transactions if t.has_witness()]
+	assert len(witness_transactions) > 0
+	assert (utils.block_header_struct.size + 1 + sum(t.size for t in block.transactions)) == len(raw_block)
+	assert b''.join(t.get_bytes() for t in block.transactions) == raw_block[utils.block_header_struct.size + 1:]
+	for transaction in witness_transactions:
+		assert any(len(tx_input.witness) > 0 for tx_input in transaction.inputs)
+		assert transaction.base_size == len(transaction.get_bytes(include_witness=False)) < transaction.size
+		assert transaction.get_weight() == transaction.base_size * 3 + transaction.size
+		assert transaction.get_wtxid() != transaction.tx_hash
+		# Decoding from a stream hashes the re-serialized transaction instead
+		stream = io.BufferedReader(io.BytesIO(transaction.get_bytes()))
+		decoded = Transaction(stream)
+		assert (decoded.tx_hash, decoded.size, decoded.base_size) == (
+			transaction.tx_hash, transaction.size, transaction.base_size)
+		assert [i.witness for i in decoded.inputs] == [i.witness for i in transaction.inputs]
+	legacy = Block.from_bytes(bytes.fromhex(BLOCK_FILTER_VECTORS[0][2])).transactions[0]
+	assert legacy.has_witness() is False and legacy.base_size == legacy.size
+	assert legacy.get_wtxid() == legacy.tx_hash and legacy.get_weight() == legacy.size * 4
+
+
+def test_unknown_witness_flag():
+	transaction = bytes.fromhex(BLOCK_FILTER_VECTORS[0][2])[utils.block_header_struct.size + 1:]
+	with pytest.raises(ValueError):
+		Transaction.from_bytes(transaction[:4] + b'\x00\x02' + transaction[4:])
+
+
+def test_fixture_file_filters(fixture_chain):
+	active_chain = builder.get_active_chain(fixture_chain)
+	filters = list(build_file_filters(FIXTURE_BLOCKS_DIR, 0))
+	assert [(height, block_hash) for height, block_hash, _, _ in filters] == [
+		(block.height, block.hash) for block in active_chain[:7]
+	]
+	assert all(header is not None for _, _, _, header in filters)
+	height, block_hash, filter_bytes, _ = filters[3]
+	# Block 3 pays to pubkey 2 and spends the coinbases of blocks 1 and 2
+	assert match_any(filter_bytes, block_hash, [builder.p2pkh(builder.make_pubkey(2))])
+	assert match_any(filter_bytes, block_hash, [active_chain[1].txs[0].outputs[0][1]])
+	assert match_any(filter_bytes, block_hash, [builder.op_return(b'hello')]) is False
+
+	# Headers of blk00001.dat chain from the last header of blk00000.dat
+	assert all(header is None for _, _, _, header in build_file_filters(FIXTURE_BLOCKS_DIR, 1))
+	next_filters = list(build_file_filters(FIXTURE_BLOCKS_DIR, 1, filters[-1][3]))
+	assert [height for height, _, _, _ in next_filters] == [7, 8, 9, 10, 11]
+	prev_header = filters[-1][3]
+	for _, _, filter_bytes, header in next_filters:
+		assert header == get_filter_header(filter_bytes, prev_header)
+		prev_header = header
+
+
+def test_file_filters_close_undo_reader(blocks_dir, monkeypatch):
+	import undo
+
+	readers = []
+
+	class TrackedUndoFileReader(undo.UndoFileReader):
+		def __init__(self, file_path: str):
+			super().__init__(file_path)
+			readers.append(self)
+
+	monkeypatch.setattr(undo, 'UndoFileReader', TrackedUndoFileReader)
+	# Stopped after the first block
+	filters = build_file_filters(blocks_dir, 0)
+	next(filters)
+	filters.close()
+	assert readers[-1].mmap.closed
+
+	# Undo data that does not belong to block 2
+	rev_path = os.path.join(blocks_dir, 'rev00000.dat')
+	with open(rev_path, 'r+b') as f:
+		data = bytearray(f.read())
+		data[-1] ^= 1
+		f.seek(0)
+		f.write(data)
+	with pytest.raises(ValueError):
+		list(build_file_filters(blocks_dir, 0))
+	assert readers[-1].mmap.closed
@@ -0,0 +1,147 @@
+from blockindex import BlockIndex, get_block_proof
+from conftest import FIXTURE_BLOCKS_DIR
+
+import builder
+import headers
+import numpy
+import pytest
+import random
+
+MAINNET_POW_LIMIT_BITS = headers.NETWORK_PARAMS['mainnet']['pow_limit_bits']
+REALISTIC_BITS = [0x1d00ffff, 0x1d00d86a, 0x1c05a3f4, 0x1c0168fd, 0x1b0404cb, 0x1a05db8b, 0x17053894, 0x207fffff]
+
+
+def make_headers(bits: list, timestamps: list):
+	result = numpy.zeros(len(bits), dtype=headers.HEADER_DTYPE)
+	result['bits'] = bits
+	result['timestamp'] = timestamps
+	return result
+
+
+@pytest.mark.parametrize('bits, target', [
+	(0x1d00ffff, 0xffff << 208),
+	# Exponents of 3 or less shift the mantissa right, see arith_uint256::SetCompact()
+	(0x01123456, 0x12),
+	(0x02123456, 0x1234),
+	(0x03123456, 0x123456),
+	(0x04123456, 0x12345600),
+	(0x05009234, 0x92340000),
+	(0x20123456, 0x123456 << 232),
+	(0x207fffff, 0x7fffff << 232),
+])
+def test_get_target(bits, target):
+	assert headers.get_target(bits) == target
+	assert headers.limbs_to_int(numpy.array(headers.int_to_limbs(target), dtype=numpy.uint64)) == target
+
+
+@pytest.mark.parametrize('bits, compact', [
+	(0x1d00ffff, 0x1d00ffff), (0x01123456, 0x01120000), (0x02123456, 0x02123400),
+	(0x04123456, 0x04123456), (0x05009234, 0x05009234), (0x20123456, 0x20123456),
+])
+def test_get_compact(bits, compact):
+	assert headers.get_compact(headers.get_target(bits)) == compact
+
+
+def test_chainwork_limbs():
+	# Mainnet's genesis block and block 1
+	chainwork = headers.get_chainwork(numpy.array([MAINNET_POW_LIMIT_BITS] * 2, dtype=numpy.uint32))
+	assert headers.get_chainwork_hex(chainwork, 0) == f'{0x100010001:064x}'
+	assert headers.get_chainwork_hex(chainwork, 1) == f'{0x200020002:064x}'
+	# Enough blocks of high work that every limb carries into the next one
+	rng = random.Random(0)
+	bits = [rng.choice(REALISTIC_BITS) for i in range(5000)]
+	chainwork = headers.get_chainwork(numpy.array(bits, dtype=numpy.uint32))
+	total = 0
+	for height, b in enumerate(bits):
+		total += get_block_proof(b)
+		assert headers.limbs_to_int(chainwork[height]) == total
+	assert total.bit_length() > 64 and (chainwork <= 0xffffffff).all()
+
+
+def test_fixture_headers():
+	block_index = BlockIndex(FIXTURE_BLOCKS_DIR)
+	fixture_headers = headers.load_headers_from_index(FIXTURE_BLOCKS_DIR)
+	assert headers.get_block_hashes(fixture_headers) == block_index.active_chain
+	chainwork = headers.get_chainwork(fixture_headers['bits'])
+	for height, block_hash in enumerate(block_index.active_chain):
+		assert headers.limbs_to_int(chainwork[height]) == block_index.entries[block_hash].chain_work
+	median_time_past = headers.get_median_time_past(fixture_headers['timestamp'])
+	assert headers.check_timestamps(fixture_headers['timestamp'], median_time_past).all()
+	assert headers.check_retargets(fixture_headers, 'regtest').all()
+	assert (fixture_headers['bits'] == builder.REGTEST_BITS).all()
+
+
+@pytest.mark.parametrize('count', [1, 5, 11, 12, 40])
+def test_median_time_past(count):
+	rng = random.Random(count)
+	# Timestamps do not have to increase
+	timestamps = numpy.array([1231006505 + i * 600 + rng.randint(-3600, 3600) for i in range(count)], dtype=numpy.uint32)
+	median_time_past = headers.get_median_time_past(timestamps)
+	for height in range(count):
+		window = sorted(timestamps[max(0, height - 10):height + 1].tolist())
+		assert median_time_past[height] == window[len(window) // 2]
+	valid = headers.check_timestamps(timestamps, median_time_past)
+	assert valid[0]
+	assert valid[1:].tolist() == [int(timestamps[h]) > median_time_past[h - 1] for h in range(1, count)]
+
+
+@pytest.mark.parametrize('first_time, last_time, bits, expected', [
+	# The vectors of Bitcoin Core's src/test/pow_tests.cpp: blocks 30240 to 32255
+	(1261130161, 1262152739, 0x1d00ffff, 0x1d00d86a),
+	# Blocks 0 to 2015: limited by the proof-of-work limit
+	(1231006505, 1233061996, 0x1d00ffff, 0x1d00ffff),
+	# Blocks 66528 to 68543: limited to a quarter of the timespan
+	(1279008237, 1279297671, 0x1c05a3f4, 0x1c0168fd),
+	# Blocks 46368 to 48383: limited to four times the timespan
+	(1263163443, 1269211443, 0x1c387f6f, 0x1d00e1fd),
+])
+def test_next_retarget_bits(first_time, last_time, bits, expected):
+	assert headers.get_next_retarget_bits(
+		bits, bits, first_time, last_time, MAINNET_POW_LIMIT_BITS, False) == expected
+
+
+def test_mainnet_retarget_boundary():
+	# Heights 30240 to 32256 of mainnet, shifted to heights 0 to 2016
+	timestamps = [1261130161 + i * 500 for i in range(headers.RETARGET_INTERVAL)]
+	timestamps[-1] = 1262152739
+	mainnet_headers = make_headers(
+		[0x1d00ffff] * headers.RETARGET_INTERVAL + [0x1d00d86a], timestamps + [1262153464])
+	assert headers.check_retargets(mainnet_headers).all()
+	# The old difficulty at the boundary
+	mainnet_headers['bits'][-1] = 0x1d00ffff
+	assert numpy.nonzero(~headers.check_retargets(mainnet_headers))[0].tolist() == [2016]
+	# A change off the boundary
+	mainnet_headers['bits'][-1] = 0x1d00d86a
+	mainnet_headers['bits'][1000] = 0x1d00d86a
+	assert numpy.nonzero(~headers.check_retargets(mainnet_headers))[0].tolist() == [1000, 1001]
+
+
+def test_testnet_min_difficulty():
+	bits = [0x1c05a3f4] * 6
+	timestamps = [1600000000 + i * 600 for i in range(6)]
+	# More than 20 minutes after its parent, block 3 may use the minimum
+	# difficulty, and block 4 returns to the last normal difficulty
+	timestamps[3:] = [t + 601 for t in timestamps[3:]]
+	bits[3] = MAINNET_POW_LIMIT_BITS
+	testnet_headers = make_headers(bits, timestamps)
+	assert headers.check_retargets(testnet_headers, 'testnet3').all()
+	assert numpy.nonzero(~headers.check_retargets(testnet_headers, 'mainnet'))[0].tolist() == [3, 4]
+	# Exactly 20 minutes is not late enough
+	testnet_headers['timestamp'][3:] -= 1
+	assert numpy.nonzero(~headers.check_retargets(testnet_headers, 'testnet3'))[0].tolist() == [3]
+
+
+def test_bip94_retarget():
+	# The last block of the period is a min-difficulty block. Testnet3 scales
+	# its target, BIP94 the one of the first block of the period.
+	bits = [0x1c05a3f4] * (headers.RETARGET_INTERVAL + 1)
+	timestamps = [1279008237 + i * 100 for i in range(headers.RETARGET_INTERVAL + 1)]
+	last = headers.RETARGET_INTERVAL - 1
+	bits[last] = MAINNET_POW_LIMIT_BITS
+	timestamps[last:] = [t + 1201 for t in timestamps[last:]]
+	bits[-1] = 0x1c0168fd
+	bip94_headers = make_headers(bits, timestamps)
+	assert headers.check_retargets(bip94_headers, 'testnet4').all()
+	assert numpy.nonzero(~headers.check_retargets(bip94_headers, 'testnet3'))[0].tolist() == [2016]
+	bip94_headers['bits'][-1] = headers.get_compact(headers.get_target(MAINNET_POW_LIMIT_BITS) // 4)
+	assert headers.check_retargets(bip94_headers, 'testnet3').all()
@@ -0,0 +1,37 @@
+from blockindex import BlockIndex
+from conftest import FIXTURE_BLOCKS_DIR
+
+import builder
+import interning
+
+
+def read_blocks(interner: interning.ScriptInterner) -> list:
+	block_index = BlockIndex(FIXTURE_BLOCKS_DIR)
+	with interner:
+		return [block_index.read_block(block_index.get_by_height(h)) for h in range(block_index.get_height() + 1)]
+
+
+def test_intern_outputs_and_pubkeys(fixture_chain):
+	interner = interning.ScriptInterner()
+	blocks = read_blocks(interner)
+	assert interning.active_interner is None
+	# make_pubkey(2) is spent from at heights 3 and 7
+	pubkey_3, pubkey_7 = blocks[3].transactions[1].inputs[1].pubkey, blocks[7].transactions[1].inputs[1].pubkey
+	assert pubkey_3 == builder.make_pubkey(2).hex() and pubkey_3 is pubkey_7
+	# and paid to at heights 2 and 3
+	payload_2, payload_3 = blocks[2].transactions[0].outputs[0].payload, blocks[3].transactions[1].outputs[0].payload
+	assert payload_2 == builder.hash160(builder.make_pubkey(2)) and payload_2 is payload_3
+	for block, expected in zip(blocks, builder.get_active_chain(fixture_chain)):
+		for transaction, tx in zip(block.transactions, expected.txs):
+			assert [o.pubkey for o in transaction.outputs] == [script for _, script in tx.outputs]
+			# scriptSigs are unique, they are kept as parsed
+			assert [i.script_sig for i in transaction.inputs] == [script_sig for _, _, script_sig in tx.inputs]
+	# Only the OP_RETURN output is not a template
+	assert interner.get_stats()['scripts']['size'] == 1
+
+
+def test_intern_outputs_only():
+	blocks = read_blocks(interning.ScriptInterner(intern_inputs=False))
+	pubkey_3, pubkey_7 = blocks[3].transactions[1].inputs[1].pubkey, blocks[7].transactions[1].inputs[1].pubkey
+	assert pubkey_3 == pubkey_7 and pubkey_3 is not pubkey_7
+	assert blocks[2].transactions[0].outputs[0].payload is blocks[3].transactions[1].outputs[0].payload
@@ -0,0 +1,83 @@
+from block import Block
+
+import builder
+import hashlib
+import itertools
+import merkle
+import pytest
+import struct
+
+
+def make_txids(count: int) -> list:
+	return [hashlib.sha256(bytes([i])).digest() for i in range(count)]
+
+
+def make_proof(txids: list, matches: list) -> bytes:
+	header = struct.pack('<I32s32sIII', 1, b'\x00' * 32, builder.merkle_root(txids), 0, builder.REGTEST_BITS, 0)
+	hashes, bits = merkle.MerkleTree(txids).get_partial_tree(matches)
+	return merkle.serialize_tx_out_proof(header, len(txids), hashes, bits)
+
+
+def test_single_transaction(fixture_chain):
+	block = Block.from_bytes(builder.get_active_chain(fixture_chain)[0].serialize())
+	txid = block.get_raw_txids()[0]
+	tree = merkle.MerkleTree([txid])
+	assert tree.get_height() == 0 and tree.get_root() == txid == block.block_header.hash_merkle_root
+	assert block.get_merkle_branch(block.transactions[0].tx_hash) == []
+	assert merkle.verify_tx_out_proof(block.get_tx_out_proof([block.transactions[0].tx_hash])) == [txid]
+
+
+def test_odd_number_of_leaves():
+	for count in (3, 5, 7):
+		txids = make_txids(count)
+		tree = merkle.MerkleTree(txids)
+		assert tree.get_root() == merkle.get_root(txids) == builder.merkle_root(txids)
+		# The last leaf is paired with itself
+		assert tree.get_branch(count - 1)[0] == txids[-1]
+		for index, txid in enumerate(txids):
+			assert merkle.get_root_from_branch(txid, index, tree.get_branch(index)) == tree.get_root()
+	assert merkle.get_root([]) is None and merkle.MerkleTree([]).get_root() is None
+
+
+def test_partial_trees():
+	for count in range(1, 8):
+		txids = make_txids(count)
+		for matches in itertools.product((False, True), repeat=count):
+			expected = [txid for txid, match in zip(txids, matches) if match]
+			assert merkle.verify_tx_out_proof(make_proof(txids, list(matches))) == expected
+
+
+def test_malformed_proofs():
+	txids = make_txids(5)
+	proof = make_proof(txids, [False, True, False, False, True])
+	hash_count, pos = proof[84], 85
+	flags_pos = pos + hash_count * 32
+	# A flipped flag bit changes the shape of the tree
+	with pytest.raises(ValueError):
+		merkle.verify_tx_out_proof(proof[:flags_pos + 1] + bytes([proof[flags_pos + 1] ^ 1]) + proof[flags_pos + 2:])
+	# An extra hash is left over
+	extra = bytes([hash_count + 1]) + proof[pos:flags_pos] + b'\x11' * 32 + proof[flags_pos:]
+	with pytest.raises(ValueError, match='unused'):
+		merkle.verify_tx_out_proof(proof[:84] + extra)
+	# An extra flag byte
+	with pytest.raises(ValueError, match='unused'):
+		merkle.verify_tx_out_proof(proof[:flags_pos] + bytes([proof[flags_pos] + 1]) + proof[flags_pos + 1:] + b'\x00')
+	# Flag bits that run out
+	with pytest.raises(ValueError):
+		merkle.verify_tx_out_proof(proof[:flags_pos] + b'\x00')
+	# Another header
+	with pytest.raises(ValueError, match='merkle root'):
+		merkle.verify_tx_out_proof(make_proof(make_txids(6), [True] * 6)[:80] + make_proof(txids, [True] * 5)[80:])
+	with pytest.raises(ValueError, match='Malformed'):
+		merkle.verify_tx_out_proof(proof[:80] + b'\x00\x00\x00\x00' + proof[84:])
+
+
+def test_merkle_tree_is_built_lazily(fixture_chain):
+	fixture_block = builder.get_active_chain(fixture_chain)[10]
+	block = Block.from_bytes(fixture_block.serialize())
+	# The root is checked while parsing, without keeping the tree
+	assert block.merkle_tree is None
+	txid = block.transactions[1].tx_hash
+	branch = block.get_merkle_branch(txid)
+	assert block.merkle_tree is not None
+	assert merkle.get_root_from_branch(fixture_block.txs[1].txid(), 1, branch) == block.get_merkle_root()
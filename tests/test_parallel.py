@@ -0,0 +1,45 @@
+from cache import BlockRecord
+from conftest import FIXTURE_BLOCKS_DIR
+from parallel import iterate_records_in_parallel
+
+import os
+import pytest
+import scan
+
+SHARED_MEMORY_DIR = '/dev/shm'
+
+
+def list_segments() -> set:
+	return set(name for name in os.listdir(SHARED_MEMORY_DIR) if name.startswith('psm_'))
+
+
+def parse_serially(blocks_dir: str) -> dict:
+	records = {}
+	for file_name in scan.list_block_files(blocks_dir):
+		with open(os.path.join(blocks_dir, file_name), 'rb') as block_reader:
+			records[file_name] = [
+				(offset, BlockRecord.from_block(block, offset).to_bytes())
+				for offset, block in scan.iterate_blocks(block_reader)
+			]
+	return records
+
+
+@pytest.mark.skipif(os.path.isdir(SHARED_MEMORY_DIR) is False, reason='No POSIX shared memory directory')
+@pytest.mark.parametrize('processes, arena_size, max_arenas_in_flight', [
+	(2, 32 * 1024 * 1024, 2),
+	# Several arenas per file, and records larger than an arena
+	(2, 256, 2),
+	# Fewer slots than files
+	(1, 256, 1),
+])
+def test_parallel_matches_serial(fixture_chain, processes, arena_size, max_arenas_in_flight):
+	segments = list_segments()
+	records = {}
+	for file_name, record in iterate_records_in_parallel(
+		FIXTURE_BLOCKS_DIR, processes, arena_size, max_arenas_in_flight=max_arenas_in_flight
+	):
+		records.setdefault(file_name, []).append((record.offset, record.to_bytes()))
+	assert records == parse_serially(FIXTURE_BLOCKS_DIR)
+	assert sum(len(r) for r in records.values()) == 15
+	# Every segment has been unlinked by the parent
+	assert list_segments() == segments
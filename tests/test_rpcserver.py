@@ -0,0 +1,164 @@
+from block import Block
+from conftest import FIXTURE_BLOCKS_DIR, TESTS_DIR, WITNESS_BLOCK_VECTOR
+from leveldb import LevelDBReader
+from rpcserver import (
+	RPCClient, RPCError, ReadOnlyNode, RPC_INVALID_ADDRESS_OR_KEY, RPC_INVALID_PARAMETER, RPC_MISC_ERROR,
+	get_transaction_json, make_server
+)
+
+import builder
+import http.client
+import json
+import merkle
+import os
+import pytest
+import rpcserver
+import threading
+import time
+
+TXINDEX_DIR = os.path.join(TESTS_DIR, 'data', 'indexes', 'txindex')
+
+
+@pytest.fixture
+def node():
+	return ReadOnlyNode(FIXTURE_BLOCKS_DIR, TXINDEX_DIR)
+
+
+@pytest.fixture
+def server(node):
+	server = make_server(node, '127.0.0.1', 0)
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	yield server
+	server.shutdown()
+	server.server_close()
+
+
+@pytest.fixture
+def client(server):
+	client = RPCClient(*server.server_address)
+	yield client
+	client.close()
+
+
+def test_getblock(fixture_chain, client):
+	active_chain = builder.get_active_chain(fixture_chain)
+	block = active_chain[3]
+	block_hash = block.hash[::-1].hex()
+	assert client.call('getblockcount') == 11
+	assert client.call('getblockhash', 3) == block_hash
+	assert client.call('getblock', block_hash, 0) == block.serialize().hex()
+	result = client.call('getblock', block_hash, 2)
+	assert (result['height'], result['confirmations'], result['nTx']) == (3, 9, 2)
+	assert result['size'] == result['strippedsize'] == len(block.serialize())
+	assert result['weight'] == 4 * result['size']
+	assert result['previousblockhash'] == active_chain[2].hash[::-1].hex()
+	transaction = result['tx'][1]
+	assert transaction['txid'] == transaction['hash'] == block.txs[1].txid()[::-1].hex()
+	assert transaction['hex'] == block.txs[1].serialize().hex()
+	assert [v['scriptPubKey']['type'] for v in transaction['vout']] == ['pubkeyhash', 'nulldata']
+	# A block of the stale branch
+	stale = next(b for b in fixture_chain if b.name == 's9')
+	assert client.call('getblock', stale.hash[::-1].hex())['confirmations'] == -1
+	with pytest.raises(RPCError) as e:
+		client.call('getblock', '00' * 32)
+	assert e.value.code == RPC_INVALID_ADDRESS_OR_KEY
+
+
+def test_getrawtransaction(fixture_chain, client):
+	block = builder.get_active_chain(fixture_chain)[7]
+	txid = block.txs[1].txid()[::-1].hex()
+	# Found through the txindex
+	assert client.call('getrawtransaction', txid) == block.txs[1].serialize().hex()
+	result = client.call('getrawtransaction', txid, True)
+	assert (result['blockhash'], result['confirmations']) == (block.hash[::-1].hex(), 5)
+	assert [i['txid'] for i in result['vin']] == [h[::-1].hex() for h, _, _ in block.txs[1].inputs]
+	# Found in the given block, whatever the case of the hex strings
+	block_hash = block.hash[::-1].hex().upper()
+	assert client.call('getrawtransaction', txid.upper(), False, block_hash) == block.txs[1].serialize().hex()
+	with pytest.raises(RPCError) as e:
+		client.call('getrawtransaction', txid, False, builder.get_active_chain(fixture_chain)[6].hash[::-1].hex())
+	assert e.value.code == RPC_INVALID_ADDRESS_OR_KEY
+
+
+def test_slow_refresh_does_not_stall_requests(node, monkeypatch):
+	monkeypatch.setattr(rpcserver, 'REFRESH_WAIT', 0.05)
+	reloads = []
+	reloaded = threading.Event()
+
+	def slow_reload():
+		reloads.append(time.monotonic())
+		reloaded.wait(5)
+
+	monkeypatch.setattr(node, 'reload', slow_reload)
+	node.last_refresh = 0
+	bogus_hash = 'ab' * 32
+	start = time.monotonic()
+	for i in range(3):
+		with pytest.raises(RPCError) as e:
+			node.getblock(bogus_hash)
+		assert e.value.code == RPC_INVALID_ADDRESS_OR_KEY
+	# Only the first request started a reload, and nobody waited for all of it
+	assert len(reloads) == 1 and time.monotonic() - start < 1
+	reloaded.set()
+	node.refresh_thread.join()
+	# Rate limited once it has finished
+	assert node.refresh() is False and len(reloads) == 1
+
+
+def test_gettxoutproof(fixture_chain, client):
+	active_chain = builder.get_active_chain(fixture_chain)
+	block = active_chain[10]
+	txids = [tx.txid()[::-1].hex() for tx in block.txs]
+	proof = bytes.fromhex(client.call('gettxoutproof', [txids[1]]))
+	assert merkle.verify_tx_out_proof(proof) == [block.txs[1].txid()]
+	assert proof[:80] == block.header
+	assert client.call('gettxoutproof', txids, block.hash[::-1].hex()) == (
+		client.call('gettxoutproof', txids[::-1]))
+	with pytest.raises(RPCError) as e:
+		client.call('gettxoutproof', [txids[1]], active_chain[9].hash[::-1].hex())
+	assert e.value.code == RPC_INVALID_ADDRESS_OR_KEY
+	with pytest.raises(RPCError) as e:
+		client.call('gettxoutproof', [txids[1], txids[1]])
+	assert e.value.code == RPC_INVALID_PARAMETER
+
+
+def test_unexpected_error(node, server, monkeypatch, capsys):
+	def getblockcount():
+		raise RuntimeError('Disk is on fire')
+
+	monkeypatch.setattr(node, 'getblockcount', getblockcount)
+	connection = http.client.HTTPConnection(*server.server_address)
+	for version, expected_status in (('1.0', 500), ('2.0', 200)):
+		request = {'jsonrpc': version, 'id': 1, 'method': 'getblockcount', 'params': []}
+		connection.request('POST', '/', json.dumps(request))
+		response = connection.getresponse()
+		assert response.status == expected_status
+		error = json.loads(response.read())['error']
+		assert error == {'code': RPC_MISC_ERROR, 'message': 'Disk is on fire'}
+	connection.close()
+	assert 'RuntimeError: Disk is on fire' in capsys.readouterr().err
+
+
+def test_reload_keeps_tables_of_old_snapshots(fixture_chain):
+	reader = LevelDBReader(os.path.join(FIXTURE_BLOCKS_DIR, 'index'))
+	key = b'b' + fixture_chain[0].hash
+	snapshot = reader.get_snapshot()
+	value = reader.get(key)
+	assert value is not None and len(snapshot[1]) == 1
+	# Another thread may still be reading through the old snapshot
+	reader.reload()
+	table = next(iter(snapshot[1].values()))
+	assert table.get(key)[2] == value
+	assert reader.get(key) == value and reader.get_snapshot() is not snapshot
+
+
+def test_witness_transaction_json():
+	block = Block.from_bytes(bytes.fromhex(WITNESS_BLOCK_VECTOR[2]))
+	transaction = block.transactions[1]
+	result = get_transaction_json(transaction)
+	assert result['txid'] == '2c21d40599523d6d24ed1cfe06346d0080362dc1d13f86d4a7f06931c73ce0e0'
+	assert result['hash'] == transaction.get_wtxid() != result['txid']
+	assert (result['size'], result['weight'], result['vsize']) == (234, 480, 120)
+	assert len(result['vin'][0]['txinwitness']) == 3
+	assert result['hex'] == transaction.get_bytes().hex()
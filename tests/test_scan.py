@@ -0,0 +1,52 @@
+from conftest import FIXTURE_BLOCKS_DIR
+from scan import iterate_blocks, scan_directory
+from sink import BlockCounterSink
+from stats import StatsSink
+
+import builder
+import json
+import struct
+
+
+def read_lines(path) -> list:
+	with open(path, 'r') as f:
+		return [json.loads(line) for line in f]
+
+
+def test_fresh_scan_truncates_stats(tmp_path):
+	output_path = tmp_path / 'stats.jsonl'
+	checkpoint_path = str(tmp_path / 'checkpoint.json')
+	assert scan_directory(FIXTURE_BLOCKS_DIR, StatsSink(str(output_path), ('txs',)), checkpoint_path) == 15
+	expected = read_lines(output_path)
+	# 15 blocks, stale ones included, and the totals of 2 files
+	assert len(expected) == 17
+	# A resumed scan has nothing left to do and keeps the output
+	assert scan_directory(FIXTURE_BLOCKS_DIR, StatsSink(str(output_path), ('txs',)), checkpoint_path) == 15
+	assert read_lines(output_path) == expected
+	# Without a checkpoint, the output of earlier runs is dropped
+	scan_directory(FIXTURE_BLOCKS_DIR, StatsSink(str(output_path), ('txs',)))
+	assert read_lines(output_path) == expected
+
+
+def test_checkpoint_of_another_sink(tmp_path, capsys):
+	output_path = tmp_path / 'stats.jsonl'
+	checkpoint_path = str(tmp_path / 'checkpoint.json')
+	scan_directory(FIXTURE_BLOCKS_DIR, BlockCounterSink(), checkpoint_path, checkpoint_interval=5)
+	assert scan_directory(FIXTURE_BLOCKS_DIR, StatsSink(str(output_path), ('txs',)), checkpoint_path) == 15
+	assert 'starting from scratch' in capsys.readouterr().err
+	assert len(read_lines(output_path)) == 17
+
+
+def test_resynchronize(fixture_chain, tmp_path, capsys):
+	active_chain = builder.get_active_chain(fixture_chain)
+	records = [struct.pack('<II', builder.MAINNET_MAGIC, len(b.serialize())) + b.serialize() for b in active_chain[:7]]
+	# A zero-filled gap after block 1, and the length field of block 2 covers
+	# block 3 too, so that its last bytes are not part of any transaction
+	records[2] = records[2][:4] + struct.pack('<I', len(records[2]) - 8 + len(records[3])) + records[2][8:]
+	data = records[0] + records[1] + b'\x00' * 1000 + b''.join(records[2:])
+	(tmp_path / 'blk00000.dat').write_bytes(data)
+	with open(tmp_path / 'blk00000.dat', 'rb') as block_reader:
+		offsets, blocks = zip(*iterate_blocks(block_reader))
+	assert [block.curr_block_hash for block in blocks] == [b.hash for b in active_chain[:7] if b.height != 2]
+	assert offsets[2] == data.index(records[3])
+	assert 'Skipping corrupt block at offset' in capsys.readouterr().err
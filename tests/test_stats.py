@@ -0,0 +1,76 @@
+from block import Block
+from blockindex import BlockIndex
+from conftest import FIXTURE_BLOCKS_DIR, WITNESS_BLOCK_VECTOR
+from stats import compute_block_stats, get_bip34_height, get_block_subsidy
+from undo import UndoFileReader, attach_undo
+
+import builder
+
+
+def read_fixture_block(height: int, with_undo: bool) -> Block:
+	block_index = BlockIndex(FIXTURE_BLOCKS_DIR)
+	entry = block_index.get_by_height(height)
+	block = block_index.read_block(entry)
+	if with_undo:
+		with UndoFileReader(block_index.get_undo_file_path(entry)) as undo_reader:
+			block_undo = undo_reader.read_at(entry.undo_pos)
+			attach_undo(block, block_undo)
+			del block_undo
+	return block
+
+
+def test_block_subsidy():
+	assert get_block_subsidy(0) == 50 * builder.COIN
+	assert get_block_subsidy(209_999) == 50 * builder.COIN
+	assert get_block_subsidy(210_000) == 25 * builder.COIN
+	assert get_block_subsidy(840_000) == 312_500_000
+	assert get_block_subsidy(64 * 210_000) == 0
+	assert get_block_subsidy(300, 150) == 1_250_000_000
+
+
+def test_fixture_block_stats(fixture_chain):
+	expected = builder.get_active_chain(fixture_chain)[10]
+	block = read_fixture_block(10, True)
+	stats = compute_block_stats(block, height=10)
+	# Outputs of the coinbase are created too, its inputs spend nothing
+	assert (stats['ins'], stats['outs'], stats['utxo_increase']) == (2, 2, 0)
+	assert stats['totalfee'] == 2 * builder.FEE
+	# The coinbase claims 1 Satoshi less than subsidy + fees, which does not
+	# change the subsidy
+	assert stats['subsidy'] == builder.SUBSIDY
+	assert sum(o.value for o in block.transactions[0].outputs) == builder.SUBSIDY + stats['totalfee'] - 1
+	assert stats['total_size'] == len(expected.txs[1].serialize())
+	assert stats['total_weight'] == stats['total_size'] * 4
+	assert stats['avgfeerate'] == 2 * builder.FEE // stats['total_size']
+
+
+def test_fixture_block_stats_without_undo():
+	block = read_fixture_block(3, False)
+	stats = compute_block_stats(block, height=3)
+	assert stats['totalfee'] is None and stats['feerate_percentiles'] is None
+	assert stats['subsidy'] == builder.SUBSIDY
+	# Two coinbase outputs were spent, a payment and an OP_RETURN were created
+	# along with the coinbase output
+	assert (stats['ins'], stats['outs'], stats['utxo_increase']) == (2, 3, 1)
+	# Blocks of version 1 do not commit to their height
+	assert compute_block_stats(block, ('subsidy',)) == {'subsidy': None}
+
+
+def test_bip34_height():
+	block = read_fixture_block(3, False)
+	block.block_header.version = 2
+	assert get_bip34_height(block) == 3
+	assert compute_block_stats(block, ('subsidy',)) == {'subsidy': builder.SUBSIDY}
+
+
+def test_witness_block_stats():
+	vector = WITNESS_BLOCK_VECTOR
+	block = Block.from_bytes(bytes.fromhex(vector[2]))
+	stats = compute_block_stats(block, height=vector[0])
+	transactions = block.transactions[1:]
+	assert stats['total_size'] == sum(t.size for t in transactions)
+	assert stats['total_weight'] == sum(t.base_size * 3 + t.size for t in transactions)
+	assert stats['total_weight'] < stats['total_size'] * 4
+	# Testnet3 halves every 210,000 blocks as well
+	assert stats['subsidy'] == 50 * builder.COIN >> 6
+	assert get_bip34_height(block) == vector[0]
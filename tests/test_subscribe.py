@@ -0,0 +1,40 @@
+from conftest import TESTS_DIR, WITNESS_BLOCK_VECTOR
+
+import os
+import subprocess
+import sys
+
+SUBSCRIBE_PATH = os.path.join(os.path.dirname(TESTS_DIR), 'src', 'subscribe.py')
+
+
+def test_stdin_messages(fixture_chain):
+	block = fixture_chain[3]
+	witness_block = bytes.fromhex(WITNESS_BLOCK_VECTOR[2])
+	# The second transaction of the witness block is the last 234 bytes
+	witness_tx = witness_block[-234:]
+	lines = [
+		f'rawblock {block.serialize().hex()}',
+		f'rawtx {block.txs[1].serialize().hex()}',
+		f'rawtx {witness_tx[:-10].hex()}',  # truncated
+		'rawtx not-hex',
+		'',
+		f'hashtx {block.txs[1].txid().hex()}',
+		f'rawblock {witness_block.hex()}',
+		f'rawtx {witness_tx.hex()}',
+	]
+	result = subprocess.run(
+		[sys.executable, SUBSCRIBE_PATH, '--stdin'], input='\n'.join(lines) + '\n',
+		capture_output=True, text=True, check=True
+	)
+	stdout = result.stdout.splitlines()
+	assert len(stdout) == 4
+	assert stdout[0].startswith(f'rawblock {block.hash[::-1].hex()} (2 transactions, {len(block.serialize())} bytes')
+	assert stdout[1].startswith(f'rawtx {block.txs[1].txid()[::-1].hex()} (2 inputs, 2 outputs')
+	assert stdout[2].startswith(f'rawblock {WITNESS_BLOCK_VECTOR[1]} (2 transactions')
+	assert stdout[3].startswith('rawtx 2c21d40599523d6d24ed1cfe06346d0080362dc1d13f86d4a7f06931c73ce0e0 (1 inputs')
+	# Bad messages are reported with their sequence (i.e. line) number
+	stderr = result.stderr.splitlines()
+	assert len(stderr) == 3
+	assert stderr[0].startswith('Failed to decode message [rawtx] (sequence 3): ')
+	assert stderr[1] == 'Skipping malformed line 4'
+	assert stderr[2] == 'Ignoring message of topic [hashtx]'
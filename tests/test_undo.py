@@ -0,0 +1,84 @@
+from block import Block
+from conftest import FIXTURE_BLOCKS_DIR, TESTS_DIR
+from undo import UndoFileReader, attach_undo, compute_fees_in_parallel, decompress_amount
+
+import builder
+import os
+import pytest
+
+# Block 170 of mainnet, the first transaction between two people, and its
+# rev*.dat record as Bitcoin Core writes it. Its only input spends the coinbase
+# output of block 9: 50 BTC to an uncompressed P2PK script, which the undo
+# record stores compressed, i.e. as the x coordinate and the parity of y.
+BLOCK_170_PATH = os.path.join(TESTS_DIR, 'data', 'blk00170.dat')
+UNDO_170_PATH = os.path.join(TESTS_DIR, 'data', 'rev00170.dat')
+BLOCK_9_PUBKEY = bytes.fromhex(
+	'0411db93e1dcdb8a016b49840f8c53bc1eb68a382e97b1482ecad7b148a6909a5c'
+	'b2e0eaddfb84ccf9744464f82e160bfa9b8b64f9d4c03f999b8643f656b412a3'
+)
+
+
+def read_block_170() -> Block:
+	with open(BLOCK_170_PATH, 'rb') as block_reader:
+		return Block(block_reader)
+
+
+def test_block_170():
+	block = read_block_170()
+	assert block.curr_block_hash[::-1].hex() == '00000000d1145790a8694403d4063f323d499e655c83426834d4ce2f8dd4a2ee'
+	with UndoFileReader(UNDO_170_PATH) as undo_reader:
+		block_undo = list(undo_reader)[0]
+		# The checksum commits to the previous block, not to block 170 itself
+		assert block_undo.verify(block.block_header.hash_prev_blk)
+		assert block_undo.verify(block.curr_block_hash) is False
+		attach_undo(block, block_undo)
+		del block_undo
+	spent_output = block.transactions[1].inputs[0].prev_output
+	assert spent_output.script_pubkey == bytes([65]) + BLOCK_9_PUBKEY + b'\xac'
+	assert (spent_output.value, spent_output.height, spent_output.is_coinbase) == (50 * builder.COIN, 9, True)
+	# 10 BTC to Hal Finney and 40 BTC back
+	assert block.transactions[1].fee == 0
+	assert block.transactions[0].fee is None
+
+
+def test_attach_undo_to_another_block(fixture_chain):
+	block = Block.from_bytes(fixture_chain[1].serialize())
+	with UndoFileReader(UNDO_170_PATH) as undo_reader:
+		block_undo = list(undo_reader)[0]
+		with pytest.raises(ValueError):
+			attach_undo(block, block_undo)
+		del block_undo
+
+
+def test_attach_undo_with_missing_inputs(fixture_chain, tmp_path):
+	block = builder.get_active_chain(fixture_chain)[3]
+	# The undo data of the only transaction has one spent output for two inputs
+	spent_outputs = [block.spent_outputs[0][:1]]
+	undo_path = tmp_path / 'rev00000.dat'
+	undo_path.write_bytes(builder.undo_record(block.prev_hash, builder.serialize_block_undo(spent_outputs)))
+	parsed = Block.from_bytes(block.serialize())
+	with UndoFileReader(str(undo_path)) as undo_reader:
+		block_undo = list(undo_reader)[0]
+		with pytest.raises(ValueError, match='1 spent outputs'):
+			attach_undo(parsed, block_undo)
+		del block_undo
+	assert parsed.transactions[1].inputs[0].prev_output is None
+
+
+def test_compressed_amounts():
+	for amount in (0, 1, 1234, 5_000_000_000, 21_000_000 * builder.COIN, 100_000_001):
+		assert decompress_amount(builder.compress_amount(amount)) == amount
+
+
+def test_fixture_fees(fixture_chain):
+	active_chain = builder.get_active_chain(fixture_chain)
+	expected = {}
+	for block in active_chain[1:]:
+		fees = [
+			sum(coin[2] for coin in coins) - sum(value for value, _ in tx.outputs)
+			for tx, coins in zip(block.txs[1:], block.spent_outputs)
+		]
+		expected[block.height] = (block.hash[::-1].hex(), sum(fees), len(fees))
+	results = {height: rest for height, *rest in compute_fees_in_parallel(FIXTURE_BLOCKS_DIR, 0, 11, 2)}
+	assert results == {height: list(value) for height, value in expected.items()}
+	assert results[3][1] == builder.FEE